@@ -0,0 +1,811 @@
+"""オフラインのエンドツーエンドベンチマーク
+
+Reddit / AI エンジン (OpenAI・Cohere・Gemini) / Slack の API を模したローカルの
+スタブサーバーを起動し、main.py のクライアントをそこへ向けて各ステージの
+所要時間・ピークメモリ・リクエスト数を計測する。実際の API クォータは消費しない。
+
+使用例:
+    python benchmark.py
+    python benchmark.py --engine gemini --dataset large --llm-latency 0.5 --stream
+    python benchmark.py --all --json bench.json
+    python benchmark.py --batch-api --llm-latency 2
+    python benchmark.py --dataset large --reddit-fetcher both
+"""
+import argparse
+import email.policy
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# 合成データセット (投稿数, 1 投稿あたりのトップレベルコメント数, 本文の文字数)
+DATASETS = {
+    "small": (3, 20, 500),
+    "medium": (5, 200, 2000),
+    "large": (10, 1000, 8000),
+}
+
+WORDS = (
+    "python rust release performance memory async typing compiler library "
+    "パフォーマンス 改善 リリース メモリ 非同期 型 コンパイラ ライブラリ 議論 質問"
+).split()
+
+
+def build_dataset(name: str, seed: int = 0) -> Dict[str, Any]:
+    """合成サブレディットのデータセットを作成する
+
+    Args:
+        name: DATASETS のキー
+        seed: 乱数シード (同じ値なら同じデータを生成する)
+
+    Returns:
+        {"posts": [...], "comments": {post_id: [...]}} 形式の辞書
+    """
+    num_posts, num_comments, body_chars = DATASETS[name]
+    rng = random.Random(seed)
+
+    def sentence(length: int) -> str:
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(rng.choice(WORDS))
+        return " ".join(words)
+
+    now = time.time()
+    posts = []
+    comments = {}
+    for i in range(num_posts):
+        post_id = f"bench{i}"
+        posts.append({
+            "id": post_id,
+            "name": f"t3_{post_id}",
+            "title": f"Benchmark topic {i}: {sentence(40)}",
+            "url": f"https://www.reddit.com/r/bench/comments/{post_id}/",
+            "permalink": f"/r/bench/comments/{post_id}/",
+            "created_utc": now - 3600 * (i + 1),
+            "score": 1000 - i,
+            "num_comments": num_comments,
+            "selftext": sentence(body_chars),
+            "subreddit": "bench",
+            "author": f"author{i}",
+        })
+        comments[post_id] = [
+            {
+                "id": f"{post_id}c{j}",
+                "name": f"t1_{post_id}c{j}",
+                "author": "AutoModerator" if j == 0 else f"user{rng.randrange(10000)}",
+                "body": "[deleted]" if j % 50 == 1 else sentence(rng.randrange(20, 400)),
+                "score": rng.randrange(-5, 500),
+                "created_utc": now - rng.randrange(3600),
+                "distinguished": None,
+                "parent_id": f"t3_{post_id}",
+                "link_id": f"t3_{post_id}",
+                "replies": "",
+            }
+            for j in range(num_comments)
+        ]
+    return {"posts": posts, "comments": comments}
+
+
+def fake_summary(prompt_chars: int) -> str:
+    """入力サイズに応じた長さの要約 JSON を作成する"""
+    topics = max(1, prompt_chars // 4000)
+    lines = "\n".join(
+        f"【ずんだもん】トピック{t}の{n}個目の発言なのだ。" for t in range(topics) for n in range(10)
+    )
+    return json.dumps(
+        {
+            "digest": ["要点その1", "要点その2", "要点その3"],
+            "details": f"【めたん】今週の話題を紹介していくわ。\n---\n{lines}\n---\n【ずんだもん】おしまいなのだ",
+        },
+        ensure_ascii=False,
+    )
+
+
+def split_tokens(text: str, size: int = 8) -> List[str]:
+    """ストリーミング用にテキストを擬似トークンに分割する"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubState:
+    """スタブサーバーの設定と計測値"""
+
+    def __init__(self, dataset: Dict[str, Any], llm_latency: float, token_latency: float):
+        self.dataset = dataset
+        self.llm_latency = llm_latency
+        self.token_latency = token_latency
+        self.requests: Counter = Counter()
+        self.bytes_sent: Counter = Counter()
+        self.lock = threading.Lock()
+        self.slack_ts = 0
+        # 最初の chat.postMessage (digest の投稿) を受けた時刻 [time.perf_counter()]
+        self.first_post_at: Optional[float] = None
+        # OpenAI Batch API のスタブ用 (アップロードされたファイルと登録されたバッチ)
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    def count(self, endpoint: str, size: int) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.bytes_sent[endpoint] += size
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Reddit / OpenAI / Cohere / Gemini / Slack の API を模したハンドラー"""
+
+    protocol_version = "HTTP/1.1"
+    state: StubState
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if not body:
+            return {}
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        return json.loads(body)
+
+    def _send_json(self, endpoint: str, data: Any, status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.state.count(endpoint, len(body))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Ratelimit-Remaining", "600")
+        self.send_header("X-Ratelimit-Used", "0")
+        self.send_header("X-Ratelimit-Reset", "600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, endpoint: str, content_type: str, events: Iterator[bytes]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = 0
+        for event in events:
+            time.sleep(self.state.token_latency)
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+            size += len(event)
+        self.wfile.write(b"0\r\n\r\n")
+        self.state.count(endpoint, size)
+
+    # --- Reddit -------------------------------------------------------------
+
+    def _reddit_listing(self, limit: int) -> Dict[str, Any]:
+        posts = self.state.dataset["posts"][:limit]
+        return {
+            "kind": "Listing",
+            "data": {
+                "after": None,
+                "before": None,
+                "children": [{"kind": "t3", "data": post} for post in posts],
+            },
+        }
+
+    def _reddit_comments(self, post_id: str) -> List[Dict[str, Any]]:
+        post = next(p for p in self.state.dataset["posts"] if p["id"] == post_id)
+        comments = self.state.dataset["comments"][post_id]
+        return [
+            {"kind": "Listing", "data": {"children": [{"kind": "t3", "data": post}]}},
+            {
+                "kind": "Listing",
+                "data": {"children": [{"kind": "t1", "data": comment} for comment in comments]},
+            },
+        ]
+
+    # --- AI エンジン ---------------------------------------------------------
+
+    @staticmethod
+    def _openai_completion(request: Dict[str, Any]) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+        """chat.completions のリクエストに対する (共通フィールド, 生成テキスト, usage) を作成する"""
+        prompt_chars = sum(len(m.get("content") or "") for m in request.get("messages", []))
+        content = fake_summary(prompt_chars)
+        usage = {
+            "prompt_tokens": prompt_chars // 2,
+            "completion_tokens": len(content) // 2,
+            "total_tokens": (prompt_chars + len(content)) // 2,
+            "prompt_tokens_details": {"cached_tokens": 1024},
+        }
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model")}
+        return base, content, usage
+
+    @staticmethod
+    def _openai_response(base: Dict[str, Any], content: str, usage: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            **base,
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": usage,
+        }
+
+    def _openai(self, request: Dict[str, Any]) -> None:
+        time.sleep(self.state.llm_latency)
+        base, content, usage = self._openai_completion(request)
+        if not request.get("stream"):
+            self._send_json("openai.chat", self._openai_response(base, content, usage))
+            return
+
+        def events() -> Iterator[bytes]:
+            for token in split_tokens(content):
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+            final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            yield f"data: {json.dumps(final)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        self._send_stream("openai.chat", "text/event-stream", events())
+
+    def _openai_file_upload(self) -> None:
+        """files.create (multipart/form-data) を受け取り、ファイルの内容を保存する"""
+        length = int(self.headers.get("Content-Length") or 0)
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode() + self.rfile.read(length)
+        )
+        content = next(
+            part.get_payload(decode=True)
+            for part in message.iter_parts()
+            if part.get_param("name", header="content-disposition") == "file"
+        )
+        with self.state.lock:
+            file_id = f"file-bench-{len(self.state.files)}"
+            self.state.files[file_id] = content
+        self._send_json("openai.files", {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": "summaries.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        })
+
+    def _openai_batch(self, batch_id: str) -> Dict[str, Any]:
+        """バッチの状態を返す (登録から --llm-latency 秒後に完了し、出力ファイルを作成する)"""
+        with self.state.lock:
+            batch = self.state.batches[batch_id]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.state.llm_latency:
+                lines = []
+                for line in self.state.files[batch["input_file_id"]].decode("utf-8").splitlines():
+                    request = json.loads(line)
+                    response = self._openai_response(*self._openai_completion(request["body"]))
+                    lines.append(json.dumps({
+                        "id": f"batch-req-{len(lines)}",
+                        "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "request_id": "bench", "body": response},
+                        "error": None,
+                    }, ensure_ascii=False))
+                output_file_id = f"file-bench-{len(self.state.files)}"
+                self.state.files[output_file_id] = "\n".join(lines).encode("utf-8")
+                batch.update(
+                    status="completed",
+                    output_file_id=output_file_id,
+                    completed_at=int(time.time()),
+                    request_counts={"total": len(lines), "completed": len(lines), "failed": 0},
+                )
+            return dict(batch)
+
+    def _cohere(self, request: Dict[str, Any]) -> None:
+        time.sleep(self.state.llm_latency)
+        prompt_chars = len(request.get("preamble") or "") + sum(
+            len(m.get("message") or m.get("text") or "") for m in request.get("chat_history", [])
+        )
+        content = fake_summary(prompt_chars)
+        meta = {"billed_units": {"input_tokens": prompt_chars // 2, "output_tokens": len(content) // 2}}
+        response = {
+            "response_id": "bench",
+            "generation_id": "bench",
+            "text": content,
+            "finish_reason": "COMPLETE",
+            "meta": meta,
+        }
+        if not request.get("stream"):
+            self._send_json("cohere.chat", response)
+            return
+
+        def events() -> Iterator[bytes]:
+            yield json.dumps({"event_type": "stream-start", "generation_id": "bench"}).encode() + b"\n"
+            for token in split_tokens(content):
+                event = {"event_type": "text-generation", "text": token}
+                yield json.dumps(event, ensure_ascii=False).encode() + b"\n"
+            end = {"event_type": "stream-end", "finish_reason": "COMPLETE", "response": response}
+            yield json.dumps(end, ensure_ascii=False).encode() + b"\n"
+
+        self._send_stream("cohere.chat", "application/stream+json", events())
+
+    def _gemini(self, request: Dict[str, Any], stream: bool) -> None:
+        time.sleep(self.state.llm_latency)
+        prompt_chars = len(json.dumps(request, ensure_ascii=False))
+        content = fake_summary(prompt_chars)
+        generation_config = request.get("generationConfig") or {}
+        schema = generation_config.get("responseSchema")
+        if schema and not schema.get("propertyOrdering"):
+            # 実際の Gemini と同様、responseSchema のプロパティはアルファベット順に出力する
+            content = json.dumps(dict(sorted(json.loads(content).items())), ensure_ascii=False)
+        usage = {
+            "promptTokenCount": prompt_chars // 2,
+            "candidatesTokenCount": len(content) // 2,
+            "totalTokenCount": (prompt_chars + len(content)) // 2,
+            "cachedContentTokenCount": 0,
+        }
+
+        def response_for(text: str) -> Dict[str, Any]:
+            return {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": text}]},
+                    "finishReason": "STOP",
+                    "index": 0,
+                }],
+                "usageMetadata": usage,
+            }
+
+        if not stream:
+            self._send_json("gemini.generate", response_for(content))
+            return
+
+        def events() -> Iterator[bytes]:
+            # REST トランスポートのストリーミングは JSON 配列を逐次送る形式
+            for index, token in enumerate(split_tokens(content)):
+                prefix = "[" if index == 0 else ","
+                yield (prefix + json.dumps(response_for(token), ensure_ascii=False)).encode()
+            yield b"]"
+
+        self._send_stream("gemini.generate", "application/json", events())
+
+    # --- ルーティング -------------------------------------------------------
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        match = re.match(r"^/r/[^/]+/top/?$", url.path)
+        if match:
+            limit = int(query.get("limit", ["3"])[0])
+            self._send_json("reddit.listing", self._reddit_listing(limit))
+            return
+        match = re.match(r"^/comments/([^/.]+)", url.path)
+        if match:
+            self._send_json("reddit.comments", self._reddit_comments(match.group(1)))
+            return
+        match = re.match(r"^/v1/batches/([^/]+)$", url.path)
+        if match:
+            self._send_json("openai.batches", self._openai_batch(match.group(1)))
+            return
+        match = re.match(r"^/v1/files/([^/]+)/content$", url.path)
+        if match:
+            body = self.state.files[match.group(1)]
+            self.state.count("openai.files", len(body))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._send_json("unknown", {"error": f"not found: {url.path}"}, status=404)
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path == "/v1/files":
+            self._openai_file_upload()
+            return
+        request = self._read_json()
+        if url.path == "/api/v1/access_token":
+            self._send_json("reddit.token", {
+                "access_token": "bench-token",
+                "token_type": "bearer",
+                "expires_in": 86400,
+                "scope": "*",
+            })
+        elif url.path.endswith("/chat/completions"):
+            self._openai(request)
+        elif url.path == "/v1/batches":
+            with self.state.lock:
+                batch_id = f"batch_bench{len(self.state.batches)}"
+                self.state.batches[batch_id] = {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": request["endpoint"],
+                    "input_file_id": request["input_file_id"],
+                    "completion_window": request["completion_window"],
+                    "status": "in_progress",
+                    "created_at": int(time.time()),
+                    "output_file_id": None,
+                    "error_file_id": None,
+                }
+            self._send_json("openai.batches", self._openai_batch(batch_id))
+        elif url.path in ("/v1/chat", "/chat"):
+            self._cohere(request)
+        elif ":generateContent" in url.path:
+            self._gemini(request, stream=False)
+        elif ":streamGenerateContent" in url.path:
+            self._gemini(request, stream=True)
+        elif url.path.endswith("/chat.postMessage"):
+            with self.state.lock:
+                self.state.slack_ts += 1
+                ts = f"{int(time.time())}.{self.state.slack_ts:06d}"
+                if self.state.first_post_at is None:
+                    self.state.first_post_at = time.perf_counter()
+            self._send_json("slack.postMessage", {"ok": True, "channel": "CBENCH", "ts": ts})
+        elif url.path.endswith("/chat.update"):
+            self._send_json("slack.update", {"ok": True, "channel": "CBENCH", "ts": request.get("ts")})
+        else:
+            self._send_json("unknown", {"error": f"not found: {url.path}"}, status=404)
+
+
+def start_stub_server(state: StubState) -> ThreadingHTTPServer:
+    """スタブサーバーをバックグラウンドスレッドで起動する"""
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_environment(base_url: str, engine: str, stream: bool, fetcher: str = "praw") -> None:
+    """main.py のクライアントがスタブサーバーを向くよう環境変数を設定する"""
+    os.environ.update({
+        "REDDIT_FETCHER": fetcher,
+        "REDDIT_CLIENT_ID": "bench",
+        "REDDIT_CLIENT_SECRET": "bench",
+        "REDDIT_USER_AGENT": "reddit-summarizer-benchmark",
+        "REDDIT_OAUTH_URL": base_url,
+        "REDDIT_URL": base_url,
+        "REDDIT_CACHE_ENABLED": "false",
+        "SEEN_INDEX_ENABLED": "false",
+        "SUMMARY_CACHE_ENABLED": "false",
+        "AI_ENGINE": engine,
+        "AI_MODEL": "bench-model",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "COHERE_API_KEY": "bench",
+        "COHERE_BASE_URL": base_url,
+        "GOOGLE_API_KEY": "bench",
+        "GEMINI_API_ENDPOINT": base_url,
+        "SLACK_BOT_TOKEN": "bench",
+        "SLACK_CHANNEL": "#bench",
+        "SLACK_API_BASE_URL": f"{base_url}/api",
+        "SLACK_RATE_PER_SECOND": "1000",
+        "SLACK_RATE_BURST": "1000",
+        "SLACK_UPDATE_INTERVAL": "0.05",
+        "SLACK_STREAMING": "true" if stream else "false",
+    })
+
+
+class StageTimer:
+    """ステージごとの所要時間とピークメモリを計測する"""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def measure(self, name: str, func: Callable[[], Any]) -> Any:
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        self.stages[name] = {"seconds": elapsed, "peak_mib": peak / (1024 * 1024)}
+        return result
+
+
+def parse_cases(summary: Any, placeholder: List[str]) -> List[Tuple[str, str, Callable[[Any], bool]]]:
+    """parse ステージに与える、崩れたモデル出力のパターンを作成する
+
+    正しい JSON に加え、コードフェンス・前後の説明文・文字列中の生の改行・余分なカンマ・
+    途中で途切れた出力・digest の欠落・JSON でない出力を含め、補修・digest の再生成・
+    テキストへのフォールバックの各経路を通す。
+
+    Args:
+        summary: 要約ステージで得た RedditSummary (崩す前の正解)
+        placeholder: digest を補えなかった場合のプレースホルダー
+
+    Returns:
+        (パターン名, モデル出力, パース結果の検証関数) のリスト
+    """
+    data = summary.model_dump()
+    raw = json.dumps(data, ensure_ascii=False)
+    pretty = json.dumps(data, ensure_ascii=False, indent=2)
+    details_start = raw.index('"details"')
+    truncated_at = details_start + (len(raw) - details_start) // 2
+
+    def same(result: Any) -> bool:
+        return result.digest == summary.digest and result.details == summary.details
+
+    def digest_regenerated(result: Any) -> bool:
+        return len(result.digest) == 3 and result.digest != placeholder
+
+    return [
+        ("valid", raw, same),
+        ("fenced", f"```json\n{pretty}\n```", same),
+        ("prose", f"以下が要約です。\n{raw}\n以上です。", same),
+        ("raw_newlines", raw.replace("\\n", "\n"), same),
+        ("trailing_commas", pretty.replace('"\n  ]', '",\n  ]').replace('"\n}', '",\n}'), same),
+        (
+            "string_digest",
+            json.dumps({**data, "digest": "\n".join(summary.digest)}, ensure_ascii=False),
+            same,
+        ),
+        (
+            "truncated_details", raw[:truncated_at],
+            lambda result: result.digest == summary.digest
+            and bool(result.details) and summary.details.startswith(result.details),
+        ),
+        ("truncated_digest", raw[:raw.index(summary.digest[1])], digest_regenerated),
+        (
+            "missing_digest", json.dumps({"details": summary.details}, ensure_ascii=False),
+            lambda result: digest_regenerated(result) and result.details == summary.details,
+        ),
+        (
+            "plain_text", summary.details,
+            lambda result: digest_regenerated(result) and result.details == summary.details,
+        ),
+    ]
+
+
+def run_parse_cases(client: Any, summary: Any, placeholder: List[str]) -> List[str]:
+    """parse_cases の各出力を client.parse_summary_text でパースし、期待と異なったパターン名を返す"""
+    failures = []
+    for name, content, check in parse_cases(summary, placeholder):
+        try:
+            ok = check(client.parse_summary_text(content))
+        except Exception:
+            ok = False
+        if not ok:
+            failures.append(name)
+    return failures
+
+
+def run_batch_api_benchmark(dataset_name: str, llm_latency: float, fetcher: str = "praw") -> Dict[str, Any]:
+    """AI_BATCH_API モードの submit → poll → post を OpenAI Batch API のスタブで計測する"""
+    import tempfile
+
+    state = StubState(build_dataset(dataset_name), llm_latency, 0.0)
+    server = start_stub_server(state)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    configure_environment(base_url, "openai", False, fetcher)
+    state_dir = tempfile.mkdtemp()
+    os.environ.update({
+        "AI_BATCH_API": "true",
+        "AI_BATCH_STATE_PATH": os.path.join(state_dir, "summary_batches.sqlite3"),
+        "METRICS_JSONL_PATH": "",
+    })
+
+    import main
+
+    limit = len(state.dataset["posts"])
+    jobs = [main.BatchJob(subreddit=f"bench{i}", limit=limit) for i in range(3)]
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        app = timer.measure("startup", main.Application)
+        timer.measure("submit", lambda: app.run_batch(jobs))
+
+        def poll() -> None:
+            while app.batch_store.pending_batches():
+                app.poll_summary_batches()
+                time.sleep(0.05)
+
+        timer.measure("poll+post", poll)
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+
+    return {
+        "engine": "openai",
+        "dataset": dataset_name,
+        "stream": False,
+        "batch_api": True,
+        "fetcher": fetcher,
+        "llm_latency": llm_latency,
+        "stages": timer.stages,
+        "total_seconds": sum(stage["seconds"] for stage in timer.stages.values()),
+        "requests": dict(state.requests),
+        "bytes_received": dict(state.bytes_sent),
+    }
+
+
+def run_benchmark(
+    engine: str,
+    dataset_name: str,
+    llm_latency: float,
+    token_latency: float,
+    stream: bool,
+    fetcher: str = "praw",
+) -> Dict[str, Any]:
+    """1 つの組み合わせについて fetch → build → summarize → parse → post を計測する"""
+    state = StubState(build_dataset(dataset_name), llm_latency, token_latency)
+    server = start_stub_server(state)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    configure_environment(base_url, engine, stream, fetcher)
+
+    import main
+
+    limit = len(state.dataset["posts"])
+    timer = StageTimer()
+    parse_failures: List[str] = []
+    digest_seconds: Optional[float] = None
+    tracemalloc.start()
+    try:
+        app = timer.measure("startup", main.Application)
+        posts = timer.measure("fetch", lambda: app.reddit_client.fetch_posts("bench", limit))
+        text, report = timer.measure("build", lambda: main.PromptInputBuilder().build(posts))
+        if stream:
+            stream_started = time.perf_counter()
+            timer.measure(
+                "summarize+post",
+                lambda: app.summarize_and_post_streaming("bench", text),
+            )
+            if state.first_post_at is not None:
+                digest_seconds = state.first_post_at - stream_started
+        else:
+            summary, model_name = timer.measure("summarize", lambda: app.summarize("bench", text))
+            # 崩れた出力の補修・digest の再生成 (スタブへの追加呼び出しを含む) まで計測する
+            parse_failures = timer.measure(
+                "parse",
+                lambda: run_parse_cases(
+                    app.ai_client, summary, list(main.AIClient.PLACEHOLDER_DIGEST)
+                ),
+            )
+            timer.measure("post", lambda: app.post("bench", summary, model_name))
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+
+    return {
+        "engine": engine,
+        "dataset": dataset_name,
+        "stream": stream,
+        "fetcher": fetcher,
+        "llm_latency": llm_latency,
+        "prompt_tokens": report.tokens_used,
+        "comments_kept": report.comments_kept,
+        "comments_dropped": report.comments_dropped,
+        "parse_failures": parse_failures,
+        # ストリーミング開始から digest が投稿されるまでの時間 [秒]
+        "digest_seconds": digest_seconds,
+        "stages": timer.stages,
+        "total_seconds": sum(stage["seconds"] for stage in timer.stages.values()),
+        "requests": dict(state.requests),
+        "bytes_received": dict(state.bytes_sent),
+    }
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    """計測結果を 1 行の表形式に整形する"""
+    stages = " ".join(
+        f"{name}={values['seconds'] * 1000:.1f}ms/{values['peak_mib']:.1f}MiB"
+        for name, values in result["stages"].items()
+    )
+    requests = " ".join(f"{name}={count}" for name, count in sorted(result["requests"].items()))
+    mode = "batch" if result.get("batch_api") else "stream" if result["stream"] else "sync"
+    failures = result.get("parse_failures")
+    if result.get("digest_seconds") is not None:
+        stages += f" digest_at={result['digest_seconds'] * 1000:.1f}ms"
+    return (
+        f"{result['engine']:<7} {result['dataset']:<7} {mode:<6} {result.get('fetcher', 'praw'):<4} "
+        f"total={result['total_seconds']:.3f}s {stages} | {requests}"
+        + (f" | parse_failures={','.join(failures)}" if failures else "")
+    )
+
+
+def run_isolated(args: List[str]) -> Dict[str, Any]:
+    """組み合わせごとに新しいプロセスで計測する (モジュールの状態を持ち越さないため)"""
+    import subprocess
+
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--single", *args],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip())
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="reddit-summarizer のオフラインベンチマーク")
+    parser.add_argument("--engine", default="openai", choices=["openai", "cohere", "gemini"])
+    parser.add_argument("--dataset", default="medium", choices=sorted(DATASETS))
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="LLM 応答までの遅延 [秒]")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="ストリーミングのトークン間隔 [秒]")
+    parser.add_argument("--stream", action="store_true", help="ストリーミング経路を計測する")
+    parser.add_argument(
+        "--batch-api", action="store_true",
+        help="AI_BATCH_API モード (OpenAI Batch API のスタブ) の登録から投稿までを計測する",
+    )
+    parser.add_argument(
+        "--reddit-fetcher", default="praw", choices=["praw", "raw", "both"],
+        help="Reddit の取得経路 (REDDIT_FETCHER)。both は両方を計測して比較する",
+    )
+    parser.add_argument("--all", action="store_true", help="全エンジン × 全データセットを計測する")
+    parser.add_argument("--json", help="計測結果を書き出す JSON ファイル")
+    parser.add_argument("--max-seconds", type=float, help="いずれかの合計時間がこれを超えたら失敗扱いにする")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.single:
+        if args.batch_api:
+            result = run_batch_api_benchmark(args.dataset, args.llm_latency, args.reddit_fetcher)
+        else:
+            result = run_benchmark(
+                args.engine, args.dataset, args.llm_latency, args.token_latency, args.stream,
+                args.reddit_fetcher,
+            )
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    combinations: List[Tuple[str, str, bool]]
+    if args.all and args.batch_api:
+        # Batch API モードは OpenAI の非ストリーミング経路のみ
+        combinations = [("openai", dataset, False) for dataset in sorted(DATASETS)]
+    elif args.all:
+        combinations = [
+            (engine, dataset, stream)
+            for engine in ("openai", "cohere", "gemini")
+            for dataset in sorted(DATASETS)
+            for stream in (False, True)
+        ]
+    else:
+        combinations = [(args.engine, args.dataset, args.stream)]
+
+    fetchers = ["praw", "raw"] if args.reddit_fetcher == "both" else [args.reddit_fetcher]
+
+    results = []
+    for (engine, dataset, stream), fetcher in itertools.product(combinations, fetchers):
+        single_args = [
+            "--engine", engine,
+            "--dataset", dataset,
+            "--llm-latency", str(args.llm_latency),
+            "--token-latency", str(args.token_latency),
+            "--reddit-fetcher", fetcher,
+        ]
+        if stream:
+            single_args.append("--stream")
+        if args.batch_api:
+            single_args.append("--batch-api")
+        result = run_isolated(single_args)
+        print(format_result(result))
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    broken = [r for r in results if r.get("parse_failures")]
+    if broken:
+        print(f"{len(broken)} 件の計測で、崩れた出力のパースが期待どおりになりませんでした")
+        failed = True
+    if args.max_seconds is not None:
+        slow = [r for r in results if r["total_seconds"] > args.max_seconds]
+        if slow:
+            print(f"{len(slow)} 件の計測が {args.max_seconds} 秒を超えました")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
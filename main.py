@@ -1,23 +1,187 @@
+import asyncio
+import contextvars
+import hashlib
+import html
+import importlib
+import json
 import os
 import praw
+import queue
+import re
 import requests
+import signal
+import sqlite3
+import subprocess
 import sys
+import threading
+import time
+import unicodedata
+import weakref
 from abc import ABC, abstractmethod
-from datetime import datetime, timezone
-from typing import List, Dict, Any, Optional, Tuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Callable, ContextManager, Iterator, Optional, Tuple, Type
+from urllib.parse import parse_qsl, urlencode, urlsplit
 from pydantic import BaseModel, Field
 
-# AI エンジンサポート
-import cohere
-from openai import OpenAI
-import google.generativeai as genai
-
 # dotenv サポート
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
+def _env_flag(name: str, default: str = "") -> bool:
+    """環境変数が truthy ("true", "1", "yes") かどうかを判定する"""
+    return os.getenv(name, default).lower() in ("true", "1", "yes")
+
+
+class RunMetrics:
+    """1 回の実行 (1 サブレディット分) のステージごとの所要時間とカウンターを集計する
+
+    ステージ (fetch_listing / fetch_post / build / summarize / parse / post など) は
+    呼び出し回数・合計秒数・最大秒数を、カウンターは取得バイト数・コメント数・
+    トークン数・再試行回数・フォールバック回数などを保持する。
+    """
+
+    def __init__(self, subreddit: str, engine: str = "", model: str = ""):
+        self.subreddit = subreddit
+        self.engine = engine
+        self.model = model
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.ok: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """with ブロックの所要時間をステージ name として記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.add(f"{name}_errors")
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                stats = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+                stats["count"] += 1
+                stats["seconds"] += elapsed
+                stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+    def add(self, name: str, value: float = 1) -> None:
+        """カウンター name に value を加算する"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, ok: bool, error: Optional[str] = None) -> None:
+        """実行結果を記録する"""
+        self.finished_at = time.time()
+        self.ok = ok
+        self.error = error
+
+    def to_record(self) -> Dict[str, Any]:
+        """JSON Lines に書き出すレコードを返す"""
+        finished_at = self.finished_at or time.time()
+        with self._lock:
+            return {
+                "timestamp": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+                "subreddit": self.subreddit,
+                "engine": self.engine,
+                "model": self.model,
+                "ok": self.ok,
+                "error": self.error,
+                "duration_seconds": round(finished_at - self.started_at, 6),
+                "stages": {
+                    name: {key: round(value, 6) for key, value in stats.items()}
+                    for name, stats in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def describe(self) -> str:
+        """ログ出力用の要約文字列を返す"""
+        with self._lock:
+            stages = ", ".join(
+                f"{name} {stats['seconds']:.2f} 秒" for name, stats in self.stages.items()
+            )
+        return f"所要時間 {stages or 'なし'}"
+
+
+# 実行中の RunMetrics (計測対象外の呼び出しでは None)
+_CURRENT_METRICS: contextvars.ContextVar[Optional[RunMetrics]] = contextvars.ContextVar(
+    "current_metrics", default=None
+)
+
+
+# RoutingAIClient が 1 回のルーティングで消費したトークン数を集計するための [入力, 出力] (集計しない場合は None)
+_USAGE_COLLECTOR: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "usage_collector", default=None
+)
+
+
+# 出力を生成したモデル名を集計するためのリスト (集計しない場合は None)
+_MODEL_COLLECTOR: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "model_collector", default=None
+)
+
+
+# True の間は parse_summary_text が digest の補修 (追加呼び出し) を行わない
+# (HedgedAIClient / RoutingAIClient が補修の要否と補修に使うモデルを自分で決める間)
+_DEFER_DIGEST_REPAIR: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "defer_digest_repair", default=False
+)
+
+
+def record_metric(name: str, value: float = 1) -> None:
+    """実行中の RunMetrics があればカウンターに加算する"""
+    metrics = _CURRENT_METRICS.get()
+    if metrics is not None:
+        metrics.add(name, value)
+
+
+def metric_stage(name: str) -> ContextManager[None]:
+    """実行中の RunMetrics があればステージとして計測するコンテキストマネージャーを返す"""
+    metrics = _CURRENT_METRICS.get()
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+
+def record_model(model_name: str) -> None:
+    """collect_models で集計中であれば、出力を生成したモデル名を記録する"""
+    models = _MODEL_COLLECTOR.get()
+    if models is not None:
+        models.append(model_name)
+
+
+@contextmanager
+def collect_models() -> Iterator[List[str]]:
+    """ブロック内で出力を生成したモデル名 (記録順) を集計するリストを返す
+
+    ワーカースレッドでも _in_current_context で実行すれば同じリストに記録される。
+    """
+    models: List[str] = []
+    token = _MODEL_COLLECTOR.set(models)
+    try:
+        yield models
+    finally:
+        _MODEL_COLLECTOR.reset(token)
+
+
+def models_label(models: List[str]) -> str:
+    """collect_models で集計したモデル名を重複を除いて "+" で連結する"""
+    return "+".join(dict.fromkeys(models))
+
+
+def _in_current_context(func: Callable[..., Any]) -> Callable[..., Any]:
+    """ワーカースレッドでも呼び出し元の RunMetrics に記録されるよう、現在のコンテキストで func を実行するラッパーを返す"""
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(func, *args)
+
+
 class RedditSummary(BaseModel):
     """Reddit要約のレスポンス構造"""
     digest: List[str] = Field(
@@ -29,23 +193,988 @@ class RedditSummary(BaseModel):
         description="キャラクター会話形式の詳細内容"
     )
 
+    @classmethod
+    def response_schema(cls, strict: bool = False) -> Dict[str, Any]:
+        """LLM の構造化出力に渡す JSON Schema を返す
+
+        OpenAI / Cohere / Gemini が共通して対応するキーワードのみで構成する。
+        digest の件数は全プロバイダーで制約できないため、パース時に検証する。
+
+        Args:
+            strict: True の場合は OpenAI の strict モードが要求する
+                additionalProperties: false を付与する
+
+        Returns:
+            JSON Schema (dict)
+        """
+        schema: Dict[str, Any] = {
+            "type": "object",
+            "properties": {
+                "digest": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": cls.model_fields["digest"].description,
+                },
+                "details": {
+                    "type": "string",
+                    "description": cls.model_fields["details"].description,
+                },
+            },
+            "required": ["digest", "details"],
+        }
+        if strict:
+            schema["additionalProperties"] = False
+        return schema
+
+
+class RedditComment:
+    """プロンプト構築に必要なフィールドのみを保持するコメントレコード"""
+
+    __slots__ = ("id", "author", "body", "score", "created_utc", "distinguished")
+
+    def __init__(
+        self,
+        id: str,
+        author: str,
+        body: str,
+        score: int,
+        created_utc: float,
+        distinguished: Optional[str] = None,
+    ):
+        self.id = id
+        self.author = author
+        self.body = body
+        self.score = score
+        self.created_utc = created_utc
+        self.distinguished = distinguished
+
+
+class RedditPost:
+    """プロンプト構築に必要なフィールドのみを保持する投稿レコード"""
+
+    __slots__ = (
+        "id", "title", "url", "created_utc", "score", "num_comments", "selftext", "comments",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        title: str,
+        url: str,
+        created_utc: float,
+        score: int,
+        num_comments: int,
+        selftext: str,
+        comments: Optional[List[RedditComment]] = None,
+    ):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.created_utc = created_utc
+        self.score = score
+        self.num_comments = num_comments
+        self.selftext = selftext
+        self.comments = comments if comments is not None else []
+
+
+class RedditCache:
+    """Reddit の取得結果を保持する SQLite キャッシュ
+
+    サブレディット × time_filter ごとの投稿一覧と、投稿 ID ごとのメタデータ・
+    トップレベルコメントを TTL 付きで保存する。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS listings (
+        subreddit TEXT NOT NULL,
+        time_filter TEXT NOT NULL,
+        post_ids TEXT NOT NULL,
+        fetched_at REAL NOT NULL,
+        requested_limit INTEGER,
+        PRIMARY KEY (subreddit, time_filter)
+    );
+    CREATE TABLE IF NOT EXISTS posts (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        url TEXT NOT NULL,
+        created_utc REAL NOT NULL,
+        score INTEGER NOT NULL,
+        num_comments INTEGER NOT NULL,
+        selftext TEXT NOT NULL,
+        fetched_at REAL NOT NULL,
+        comments_fetched_at REAL,
+        comments_num_comments INTEGER,
+        last_comment_utc REAL
+    );
+    CREATE TABLE IF NOT EXISTS comments (
+        id TEXT PRIMARY KEY,
+        post_id TEXT NOT NULL,
+        author TEXT NOT NULL,
+        body TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        created_utc REAL NOT NULL,
+        distinguished TEXT
+    );
+    CREATE INDEX IF NOT EXISTS comments_post_id ON comments (post_id);
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        listing_ttl: Optional[float] = None,
+        comments_ttl: Optional[float] = None,
+        max_age: Optional[float] = None,
+    ):
+        """キャッシュの初期化
+
+        Args:
+            path: SQLite ファイルのパス (省略時は REDDIT_CACHE_PATH)
+            listing_ttl: 投稿一覧の有効期間 [秒] (省略時は REDDIT_CACHE_LISTING_TTL。0 なら再利用しない)
+            comments_ttl: コメントの有効期間 [秒] (省略時は REDDIT_CACHE_COMMENTS_TTL。0 なら再利用しない)
+            max_age: コメント数が変わらない投稿のコメントを再利用する最大期間 [秒]
+        """
+        self.path = path or os.getenv("REDDIT_CACHE_PATH", ".cache/reddit_cache.sqlite3")
+        self.listing_ttl = (
+            listing_ttl if listing_ttl is not None
+            else float(os.getenv("REDDIT_CACHE_LISTING_TTL", "900"))
+        )
+        self.comments_ttl = (
+            comments_ttl if comments_ttl is not None
+            else float(os.getenv("REDDIT_CACHE_COMMENTS_TTL", "3600"))
+        )
+        self.max_age = (
+            max_age if max_age is not None
+            else float(os.getenv("REDDIT_CACHE_MAX_AGE", "86400"))
+        )
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 並列取得スレッドから共有するため、接続はロックで保護する
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+        # requested_limit 列がない古いキャッシュファイルには列を追加する
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(listings)")}
+        if "requested_limit" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE listings ADD COLUMN requested_limit INTEGER")
+
+    def get_listing(self, subreddit: str, time_filter: str, limit: int) -> Optional[List[str]]:
+        """有効期間内の投稿 ID 一覧を返す (なければ None)
+
+        保存された件数が limit に満たなくても、limit 件以上を要求して取得した一覧
+        (期間内の投稿がそれだけしかないサブレディット) であればそのまま返す。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT post_ids, fetched_at, requested_limit FROM listings "
+                "WHERE subreddit = ? AND time_filter = ?",
+                (subreddit.lower(), time_filter),
+            ).fetchone()
+        if row is None or self.listing_ttl <= 0 or time.time() - row[1] > self.listing_ttl:
+            return None
+        post_ids = json.loads(row[0])
+        if len(post_ids) < limit and (row[2] or 0) < limit:
+            return None
+        return post_ids[:limit]
+
+    def put_listing(
+        self, subreddit: str, time_filter: str, post_ids: List[str], requested_limit: int
+    ) -> None:
+        """投稿 ID 一覧を、取得時に要求した件数とともに保存する"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO listings "
+                "(subreddit, time_filter, post_ids, fetched_at, requested_limit) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (subreddit.lower(), time_filter, json.dumps(post_ids), time.time(), requested_limit),
+            )
+
+    def upsert_post(self, post: RedditPost) -> None:
+        """投稿のメタデータ (スコア・コメント数など) を保存・更新する"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO posts (id, title, url, created_utc, score, num_comments, selftext, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    title = excluded.title,
+                    score = excluded.score,
+                    num_comments = excluded.num_comments,
+                    selftext = excluded.selftext,
+                    fetched_at = excluded.fetched_at
+                """,
+                (
+                    post.id, post.title, post.url, post.created_utc, post.score,
+                    post.num_comments, post.selftext, time.time(),
+                ),
+            )
+
+    def get_post(self, post_id: str) -> Optional[RedditPost]:
+        """キャッシュ済みの投稿をコメント付きで返す (なければ None)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, title, url, created_utc, score, num_comments, selftext "
+                "FROM posts WHERE id = ?",
+                (post_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            comment_rows = self._conn.execute(
+                "SELECT id, author, body, score, created_utc, distinguished "
+                "FROM comments WHERE post_id = ? ORDER BY created_utc",
+                (post_id,),
+            ).fetchall()
+        comments = [RedditComment(*comment_row) for comment_row in comment_rows]
+        return RedditPost(*row, comments=comments)
+
+    def comments_fresh(self, post_id: str, num_comments: int) -> bool:
+        """キャッシュ済みコメントをそのまま使えるかどうかを判定する
+
+        TTL 内であるか、前回取得時からコメント数が変わっていなければ (max_age 以内に限り)
+        再取得は不要とみなす。TTL が 0 の場合は常に再取得する。
+        """
+        if self.comments_ttl <= 0:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT comments_fetched_at, comments_num_comments FROM posts WHERE id = ?",
+                (post_id,),
+            ).fetchone()
+        if row is None or row[0] is None:
+            return False
+        age = time.time() - row[0]
+        if age <= self.comments_ttl:
+            return True
+        return row[1] == num_comments and age <= self.max_age
+
+    def last_comment_utc(self, post_id: str) -> float:
+        """最後に保存したコメントの投稿時刻を返す"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_comment_utc FROM posts WHERE id = ?", (post_id,)
+            ).fetchone()
+        return row[0] if row and row[0] is not None else 0.0
+
+    def merge_comments(self, post: RedditPost) -> int:
+        """取得したコメントを差分としてマージする
+
+        既存コメントはスコアと本文 (削除済みへの変化を含む) のみ更新し、
+        前回の最終コメント時刻より新しいコメントを追加する。
+
+        Returns:
+            新たに追加されたコメント数
+        """
+        last_seen = self.last_comment_utc(post.id)
+        new_comments = sum(1 for comment in post.comments if comment.created_utc > last_seen)
+        latest = max([last_seen] + [comment.created_utc for comment in post.comments])
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """
+                INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    body = excluded.body,
+                    score = excluded.score
+                """,
+                [
+                    (
+                        comment.id, post.id, comment.author, comment.body,
+                        comment.score, comment.created_utc, comment.distinguished,
+                    )
+                    for comment in post.comments
+                ],
+            )
+            self._conn.execute(
+                "UPDATE posts SET comments_fetched_at = ?, comments_num_comments = ?, "
+                "last_comment_utc = ? WHERE id = ?",
+                (time.time(), post.num_comments, latest, post.id),
+            )
+        return new_comments
+
+    def close(self) -> None:
+        """SQLite の接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+
+class SeenPostIndex:
+    """要約済みの投稿を記録し、実行・サブレディットをまたいだ重複を検出する SQLite インデックス
+
+    投稿は Reddit の投稿 ID、正規化した URL、タイトルと本文の 64 bit simhash で照合する。
+    simhash はハミング距離が SEEN_INDEX_SIMHASH_DISTANCE 以下であれば同じ話題とみなす。
+    「Weekly Discussion – Oct 12」のような同じサブレディットの定期スレッドを
+    隠さないよう、simhash は別のサブレディットの投稿とのみ照合する。
+
+    同じプロセスで並行して処理しているサブレディット同士でも重複しないよう、
+    claim で選んだ投稿は mark で記録されるか release されるまで確保済みとして扱う。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS seen_posts (
+        id TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        simhash INTEGER,
+        subreddit TEXT NOT NULL,
+        seen_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS seen_posts_url ON seen_posts (url);
+    """
+
+    # URL の比較で無視するトラッキング用のクエリパラメーター
+    TRACKING_PARAMS = re.compile(r"^(utm_\w+|ref|ref_src|ref_url|fbclid|gclid|igshid|share_id|si)$")
+    # 比較する URL から取り除くホスト名の接頭辞
+    HOST_PREFIXES = ("www.", "m.", "old.", "new.", "np.", "amp.")
+    # simhash の特徴量: 英数字は単語単位、それ以外 (日本語など) は文字 2-gram
+    SIMHASH_TOKEN = re.compile(r"[0-9a-z]+|[^\x00-\x7f]+")
+    # 特徴量がこれより少ないテキストの simhash は誤検出が多いため照合に使わない
+    SIMHASH_MIN_FEATURES = 6
+    # simhash の計算に使う本文の最大文字数
+    SIMHASH_MAX_CHARS = 2000
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_age: Optional[float] = None,
+        max_distance: Optional[int] = None,
+    ):
+        """インデックスの初期化
+
+        Args:
+            path: SQLite ファイルのパス (省略時は SEEN_INDEX_PATH)
+            max_age: 要約済みとして扱う期間 [秒] (省略時は SEEN_INDEX_MAX_AGE)
+            max_distance: 同じ話題とみなす simhash のハミング距離 (省略時は SEEN_INDEX_SIMHASH_DISTANCE)
+        """
+        self.path = path or os.getenv("SEEN_INDEX_PATH", ".cache/seen_posts.sqlite3")
+        self.max_age = (
+            max_age if max_age is not None
+            else float(os.getenv("SEEN_INDEX_MAX_AGE", "2592000"))
+        )
+        self.max_distance = (
+            max_distance if max_distance is not None
+            else int(os.getenv("SEEN_INDEX_SIMHASH_DISTANCE", "3"))
+        )
+        # 選ばれたがまだ記録されていない投稿 (投稿 ID → (サブレディット, 正規化した URL, simhash))
+        self._claims: Dict[str, Tuple[str, str, Optional[int]]] = {}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        """スキーム・ホスト名の接頭辞・トラッキング用パラメーター・末尾のスラッシュの違いを無視した URL を返す"""
+        parts = urlsplit(url.strip())
+        host = parts.netloc.lower()
+        for prefix in cls.HOST_PREFIXES:
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+                break
+        query = urlencode(sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not cls.TRACKING_PARAMS.match(key)
+        ))
+        path = parts.path.rstrip("/")
+        return f"{host}{path}?{query}" if query else f"{host}{path}"
+
+    @classmethod
+    def simhash(cls, text: str) -> Optional[int]:
+        """テキストから 64 bit の simhash を計算する (特徴量が少なすぎる場合は None)"""
+        normalized = unicodedata.normalize("NFKC", text[:cls.SIMHASH_MAX_CHARS]).lower()
+        features = set()
+        for token in cls.SIMHASH_TOKEN.findall(normalized):
+            if token.isascii():
+                features.add(token)
+            else:
+                features.update(token[i:i + 2] for i in range(max(1, len(token) - 1)))
+        if len(features) < cls.SIMHASH_MIN_FEATURES:
+            return None
+
+        weights = [0] * 64
+        for feature in features:
+            value = int.from_bytes(
+                hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big"
+            )
+            for bit in range(64):
+                weights[bit] += 1 if value >> bit & 1 else -1
+        value = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+        # SQLite の INTEGER は符号付き 64 bit のため、上位ビットが立つ値は負数として保存する
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    @staticmethod
+    def _post_text(post: Any) -> str:
+        """simhash の対象とするタイトルと本文を返す"""
+        return f"{post.title}\n{post.selftext}"
+
+    def _near(self, simhash: int, other: int) -> bool:
+        """2 つの simhash のハミング距離が max_distance 以下かどうか"""
+        return bin((simhash ^ other) & ((1 << 64) - 1)).count("1") <= self.max_distance
+
+    def _find(self, subreddit: str, post_id: str, url: str, simhash: Optional[int]) -> Optional[str]:
+        """記録済みの投稿と照合する (self._lock を取得した状態で呼び出す)"""
+        since = time.time() - self.max_age
+        row = self._conn.execute(
+            "SELECT id = ? FROM seen_posts WHERE (id = ? OR url = ?) AND seen_at >= ? "
+            "ORDER BY id = ? DESC LIMIT 1",
+            (post_id, post_id, url, since, post_id),
+        ).fetchone()
+        if row is not None:
+            return "id" if row[0] else "url"
+        if simhash is None:
+            return None
+        rows = self._conn.execute(
+            "SELECT simhash FROM seen_posts WHERE simhash IS NOT NULL AND seen_at >= ? AND subreddit != ?",
+            (since, subreddit),
+        ).fetchall()
+        if any(self._near(simhash, other) for (other,) in rows):
+            return "simhash"
+        return None
+
+    def find(self, subreddit: str, post: Any) -> Optional[str]:
+        """投稿が要約済みであれば一致した理由 ("id" / "url" / "simhash") を返す
+
+        Args:
+            subreddit: 投稿を要約しようとしているサブレディット名
+            post: id / url / title / selftext を持つ投稿 (RedditPost または PRAW の Submission)
+
+        Returns:
+            一致した理由 (要約済みでない場合は None)
+        """
+        url = self.normalize_url(post.url)
+        simhash = self.simhash(self._post_text(post))
+        with self._lock:
+            return self._find(subreddit.lower(), post.id, url, simhash)
+
+    def claim(self, subreddit: str, post: Any) -> Optional[str]:
+        """投稿が要約済みでも確保済みでもなければ確保し、None を返す
+
+        記録済みの投稿に加え、このプロセスで確保済みの投稿とも照合する。
+        確認と確保は同じロックの中で行うため、並行するサブレディット同士で
+        同じ投稿を選ぶことはない。
+
+        Returns:
+            一致した理由 ("id" / "url" / "simhash")。確保した場合は None
+        """
+        subreddit = subreddit.lower()
+        url = self.normalize_url(post.url)
+        simhash = self.simhash(self._post_text(post))
+        with self._lock:
+            reason = self._find(subreddit, post.id, url, simhash)
+            if reason is not None:
+                return reason
+            for claimed_id, (claimed_subreddit, claimed_url, claimed_simhash) in self._claims.items():
+                if claimed_id == post.id:
+                    return "id"
+                if claimed_url == url:
+                    return "url"
+                if (
+                    simhash is not None and claimed_simhash is not None
+                    and claimed_subreddit != subreddit and self._near(simhash, claimed_simhash)
+                ):
+                    return "simhash"
+            self._claims[post.id] = (subreddit, url, simhash)
+        return None
+
+    def release(self, subreddit: str, post_ids: Optional[List[str]] = None) -> None:
+        """確保した投稿を解放する (post_ids を省略した場合はそのサブレディットの全て)"""
+        subreddit = subreddit.lower()
+        with self._lock:
+            for post_id in list(self._claims):
+                if (post_ids is None or post_id in post_ids) and self._claims[post_id][0] == subreddit:
+                    del self._claims[post_id]
+
+    def mark(self, subreddit: str, posts: List[Any]) -> None:
+        """投稿を要約済みとして記録し、確保を解除して期限切れの記録を削除する"""
+        now = time.time()
+        rows = [
+            (
+                post.id, self.normalize_url(post.url),
+                self.simhash(self._post_text(post)), subreddit.lower(), now,
+            )
+            for post in posts
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO seen_posts VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("DELETE FROM seen_posts WHERE seen_at < ?", (now - self.max_age,))
+            for post in posts:
+                self._claims.pop(post.id, None)
+
+    def close(self) -> None:
+        """SQLite の接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+
+class RedditJSONFetcher:
+    """PRAW を使わずに Reddit の JSON API を直接呼び出す軽量な取得クライアント
+
+    投稿一覧と /comments/{id} のレスポンスから、プロンプトに使うフィールドだけを
+    RedditPost / RedditComment レコードに取り出す。PRAW の遅延オブジェクトや
+    MoreComments を作らないため、取得時の CPU 時間とメモリを抑えられる。
+    """
+
+    # 1 リクエストあたりのタイムアウト [秒] (PRAW の既定値と同じ)
+    TIMEOUT = 16
+    # 投稿一覧の 1 ページあたりの最大件数 (Reddit API の上限)
+    LISTING_PAGE_SIZE = 100
+
+    def __init__(self, session: requests.Session):
+        """取得クライアントの初期化
+
+        Args:
+            session: リクエストに使う HTTP セッション (計測用のフックを登録済みのもの)
+        """
+        self.session = session
+        self.session.headers["User-Agent"] = os.getenv("REDDIT_USER_AGENT") or ""
+        self.client_id = os.getenv("REDDIT_CLIENT_ID")
+        self.client_secret = os.getenv("REDDIT_CLIENT_SECRET")
+        self.oauth_url = os.getenv("REDDIT_OAUTH_URL") or "https://oauth.reddit.com"
+        self.reddit_url = os.getenv("REDDIT_URL") or "https://www.reddit.com"
+        # 1 投稿あたりに取得するトップレベルコメントの最大数
+        self.comment_limit = int(os.getenv("REDDIT_COMMENT_LIMIT", "500"))
+        # PRAW の auth.limits と同じ形式で保持する (RedditClient のレート制限待機で参照する)
+        self.limits: Dict[str, Optional[float]] = {
+            "remaining": None, "reset_timestamp": None, "used": None,
+        }
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    def _access_token(self) -> str:
+        """application-only OAuth (client_credentials) のアクセストークンを返す
+
+        有効期限の 1 分前までは取得済みのトークンを使い回す。
+        """
+        with self._token_lock:
+            if self._token is None or time.time() >= self._token_expires_at:
+                response = self.session.post(
+                    f"{self.reddit_url}/api/v1/access_token",
+                    data={"grant_type": "client_credentials"},
+                    auth=(self.client_id or "", self.client_secret or ""),
+                    timeout=self.TIMEOUT,
+                )
+                response.raise_for_status()
+                data = response.json()
+                self._token = data["access_token"]
+                self._token_expires_at = time.time() + float(data.get("expires_in", 3600)) - 60
+            return self._token
+
+    def _update_limits(self, headers: Any) -> None:
+        """レスポンスの X-Ratelimit-* ヘッダーから残りリクエスト数などを更新する"""
+        if "X-Ratelimit-Remaining" not in headers:
+            return
+        self.limits = {
+            "remaining": float(headers["X-Ratelimit-Remaining"]),
+            "reset_timestamp": time.time() + float(headers.get("X-Ratelimit-Reset", 0)),
+            "used": float(headers.get("X-Ratelimit-Used", 0)),
+        }
+
+    def _get(self, path: str, params: Dict[str, Any]) -> Any:
+        """OAuth のエンドポイントに GET し、JSON を返す (トークン失効時は 1 回だけ再取得する)"""
+        for attempt in range(2):
+            response = self.session.get(
+                f"{self.oauth_url}{path}",
+                params={**params, "raw_json": 1},
+                headers={"Authorization": f"bearer {self._access_token()}"},
+                timeout=self.TIMEOUT,
+            )
+            self._update_limits(response.headers)
+            if response.status_code == 401 and attempt == 0:
+                with self._token_lock:
+                    self._token = None
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def listing(self, subreddit_name: str, limit: int, time_filter: str) -> List[RedditPost]:
+        """サブレディットの上位投稿をコメントを含まない RedditPost として返す"""
+        posts: List[RedditPost] = []
+        after = None
+        while len(posts) < limit:
+            params = {"t": time_filter, "limit": min(limit - len(posts), self.LISTING_PAGE_SIZE)}
+            if after:
+                params["after"] = after
+            data = self._get(f"/r/{subreddit_name}/top", params)["data"]
+            posts.extend(
+                RedditPost(
+                    id=child["data"]["id"],
+                    title=child["data"]["title"],
+                    url=child["data"]["url"],
+                    created_utc=child["data"]["created_utc"],
+                    score=child["data"]["score"],
+                    num_comments=child["data"]["num_comments"],
+                    selftext=child["data"].get("selftext") or "",
+                )
+                for child in data["children"]
+                if child["kind"] == "t3"
+            )
+            after = data.get("after")
+            if not after or not data["children"]:
+                break
+        return posts[:limit]
+
+    def comments(self, post_id: str) -> List[RedditComment]:
+        """投稿のトップレベルコメントを 1 リクエストで取得する
+
+        depth=1 で返信を取得せず、"more" (続きのコメント) は展開しない。
+        """
+        _, comment_listing = self._get(
+            f"/comments/{post_id}", {"limit": self.comment_limit, "depth": 1}
+        )
+        return [
+            RedditComment(
+                id=child["data"]["id"],
+                author=child["data"].get("author") or "[deleted]",
+                body=child["data"].get("body") or "",
+                score=child["data"].get("score", 0),
+                created_utc=child["data"]["created_utc"],
+                distinguished=child["data"].get("distinguished"),
+            )
+            for child in comment_listing["data"]["children"]
+            if child["kind"] == "t1"
+        ]
+
 
 class RedditClient:
     """Reddit からデータを取得するクライアントクラス"""
 
+    # レート制限の残りリクエスト数がこの値を下回ったらリセットまで待機する
+    RATE_LIMIT_RESERVE = 2
+
     def __init__(self):
         """Reddit API クライアントの初期化"""
-        self.reddit = praw.Reddit(
+        # REDDIT_OAUTH_URL / REDDIT_URL はベンチマーク用のスタブサーバーなどを指す場合に指定する
+        self._endpoints = {
+            key: value
+            for key, value in (
+                ("oauth_url", os.getenv("REDDIT_OAUTH_URL")),
+                ("reddit_url", os.getenv("REDDIT_URL")),
+            )
+            if value
+        }
+        # "praw": PRAW 経由で取得 / "raw": RedditJSONFetcher で JSON API を直接呼び出す
+        self.fetcher = os.getenv("REDDIT_FETCHER", "praw")
+        # PRAW の Reddit インスタンスはスレッドセーフではないため、ワーカーごとに貸し出す
+        self._reddit_pool: "queue.SimpleQueue[praw.Reddit]" = queue.SimpleQueue()
+        # close で閉じるため、作成した HTTP セッションを保持する
+        self._sessions: List[requests.Session] = []
+        if self.fetcher == "raw":
+            self.raw = RedditJSONFetcher(self._new_session())
+        elif self.fetcher == "praw":
+            self.raw = None
+            self._reddit_pool.put(self._new_reddit())
+        else:
+            raise ValueError(f"サポートされていない REDDIT_FETCHER: {self.fetcher}")
+        self.concurrency = max(1, int(os.getenv("REDDIT_FETCH_CONCURRENCY", "4")))
+        self.cache = RedditCache() if _env_flag("REDDIT_CACHE_ENABLED", "true") else None
+        self.seen_index = SeenPostIndex() if _env_flag("SEEN_INDEX_ENABLED", "true") else None
+        # 要約済みの投稿を除いた分を補うため、投稿一覧を多めに取得する件数
+        self.overfetch = int(os.getenv("SEEN_INDEX_OVERFETCH", "5")) if self.seen_index else 0
+
+    @staticmethod
+    def _record_response(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        """Reddit API のレスポンスごとにリクエスト数と受信バイト数を記録する"""
+        record_metric("reddit_requests")
+        record_metric("reddit_bytes", len(response.content))
+
+    def _new_session(self) -> requests.Session:
+        """取得バイト数を計測するフックを登録した HTTP セッションを作成する"""
+        session = requests.Session()
+        session.hooks["response"].append(self._record_response)
+        self._sessions.append(session)
+        return session
+
+    def close(self) -> None:
+        """HTTP セッションとキャッシュ・インデックスの接続を閉じる"""
+        for session in self._sessions:
+            session.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.seen_index is not None:
+            self.seen_index.close()
+
+    def _new_reddit(self) -> praw.Reddit:
+        """専用の HTTP セッションを持つ praw.Reddit インスタンスを作成する"""
+        return praw.Reddit(
             client_id=os.getenv("REDDIT_CLIENT_ID"),
             client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
             user_agent=os.getenv("REDDIT_USER_AGENT"),
+            requestor_kwargs={"session": self._new_session()},
+            **self._endpoints,
+        )
+
+    @contextmanager
+    def _borrow_reddit(self) -> Iterator[praw.Reddit]:
+        """praw.Reddit インスタンスをプールから 1 つ借りる
+
+        同時に使われるインスタンスは 1 スレッドにつき 1 つだけになる。返却された
+        インスタンスは OAuth トークンと HTTP 接続ごと次の取得で再利用する。
+        """
+        try:
+            reddit = self._reddit_pool.get_nowait()
+        except queue.Empty:
+            reddit = self._new_reddit()
+        try:
+            yield reddit
+        finally:
+            self._reddit_pool.put(reddit)
+
+    def _wait_for_rate_limit(self) -> None:
+        """Reddit のレート制限ヘッダーに基づき、必要であればリセットまで待機する
+
+        RedditJSONFetcher はレスポンスの X-Ratelimit-* ヘッダーを limits に保持して
+        いるため、並列取得で残りリクエスト数を使い切らないよう、同時実行数分の
+        余裕を確保する。各ワーカーは独立して待機し、互いを直列化しない。
+        PRAW 経由の取得は prawcore のレートリミッターに任せる。
+        """
+        if self.raw is None:
+            return
+        # limits は丸ごと置き換えられるため、参照を 1 度だけ読めばロックは不要
+        limits = self.raw.limits
+        remaining = limits.get("remaining")
+        reset_timestamp = limits.get("reset_timestamp")
+        if remaining is None or reset_timestamp is None:
+            return
+        if remaining > self.concurrency + self.RATE_LIMIT_RESERVE:
+            return
+        wait_seconds = reset_timestamp - time.time()
+        if wait_seconds > 0:
+            print(f"Reddit のレート制限に近づいたため {wait_seconds:.1f} 秒待機します")
+            time.sleep(wait_seconds)
+
+    def _fetch_post(self, post: Any) -> RedditPost:
+        """投稿のコメントを取得し、RedditPost レコードに変換する
+
+        Args:
+            post: PRAW の Submission オブジェクト (REDDIT_FETCHER=raw の場合は RedditPost)
+
+        Returns:
+            トップレベルコメントを含む RedditPost
+        """
+        # コメント処理 (post.comments へのアクセスで HTTP リクエストが発生する)
+        self._wait_for_rate_limit()
+        with metric_stage("fetch_post"):
+            if self.raw is not None:
+                comments = self.raw.comments(post.id)
+            else:
+                # 投稿一覧を取得したインスタンスとは別の、このワーカー専用のインスタンスで取得する
+                with self._borrow_reddit() as reddit:
+                    comments = [
+                        RedditComment(
+                            id=comment.id,
+                            author=comment.author.name if comment.author else "[deleted]",
+                            body=comment.body,
+                            score=comment.score,
+                            created_utc=comment.created_utc,
+                            distinguished=comment.distinguished,
+                        )
+                        for comment in reddit.submission(id=post.id).comments
+                        if isinstance(comment, praw.models.Comment)
+                    ]
+        record_metric("comments_fetched", len(comments))
+
+        record = self._post_from_submission(post)
+        record.comments = comments
+        return record
+
+    def _post_from_submission(self, post: Any) -> RedditPost:
+        """PRAW の Submission からコメントを含まない RedditPost を作成する"""
+        if isinstance(post, RedditPost):
+            return RedditPost(
+                post.id, post.title, post.url, post.created_utc,
+                post.score, post.num_comments, post.selftext,
+            )
+        return RedditPost(
+            id=post.id,
+            title=post.title,
+            url=post.url,
+            created_utc=post.created_utc,
+            score=post.score,
+            num_comments=post.num_comments,
+            selftext=post.selftext,
+        )
+
+    def _fetch_post_cached(self, post: Any) -> RedditPost:
+        """キャッシュを経由して投稿とコメントを取得する
+
+        コメント数が変わっていない、または TTL 内の投稿はキャッシュから返し、
+        それ以外はコメントを取得してキャッシュにマージする。
+        """
+        if self.cache.comments_fresh(post.id, post.num_comments):
+            cached = self.cache.get_post(post.id)
+            if cached is not None:
+                record_metric("reddit_cache_hits")
+                return cached
+
+        fetched = self._fetch_post(post)
+        self.cache.merge_comments(fetched)
+        return self.cache.get_post(post.id) or fetched
+
+    def _select_unseen(self, subreddit_name: str, posts: List[Any], limit: int) -> List[Any]:
+        """要約済み・他のジョブで確保済みの投稿を除き、先頭から limit 件を選んで確保する
+
+        確保した投稿は mark_seen で記録するか release_seen で解放する。
+
+        Args:
+            subreddit_name: サブレディット名
+            posts: 投稿順の RedditPost または Submission のリスト
+            limit: 選ぶ投稿数
+
+        Returns:
+            選ばれた投稿のリスト
+        """
+        if self.seen_index is None:
+            return posts[:limit]
+
+        selected = []
+        for post in posts:
+            if len(selected) >= limit:
+                break
+            reason = self.seen_index.claim(subreddit_name, post)
+            if reason is None:
+                selected.append(post)
+                continue
+            record_metric("seen_posts_skipped")
+            print(f"r/{subreddit_name}: 要約済みの投稿をスキップします ({reason} が一致): {post.title}")
+        return selected
+
+    def mark_seen(self, subreddit_name: str, posts: List[RedditPost]) -> None:
+        """投稿を要約済みとして記録する (SEEN_INDEX_ENABLED が無効な場合は何もしない)"""
+        if self.seen_index is not None and posts:
+            self.seen_index.mark(subreddit_name, posts)
+
+    def release_seen(self, subreddit_name: str, posts: Optional[List[Any]] = None) -> None:
+        """投稿しなかった投稿の確保を解放し、他のジョブや次回の実行で選べるようにする
+
+        posts を省略した場合は、そのサブレディットで確保した全ての投稿を解放する。
+        """
+        if self.seen_index is not None:
+            self.seen_index.release(
+                subreddit_name, [post.id for post in posts] if posts is not None else None
+            )
+
+    def _fetch_listing(self, subreddit_name: str, limit: int, time_filter: str) -> List[Any]:
+        """サブレディットの上位投稿の一覧を取得する
+
+        Returns:
+            PRAW の Submission (REDDIT_FETCHER=raw の場合はコメントを含まない RedditPost) のリスト
+        """
+        with metric_stage("fetch_listing"):
+            if self.raw is not None:
+                return self.raw.listing(subreddit_name, limit, time_filter)
+            with self._borrow_reddit() as reddit:
+                subreddit = reddit.subreddit(subreddit_name)
+                return list(subreddit.top(limit=limit, time_filter=time_filter))
+
+    def _plan_fetch(
+        self, subreddit_name: str, limit: int, time_filter: str
+    ) -> Tuple[Optional[List[RedditPost]], List[Any], Callable[[Any], RedditPost]]:
+        """投稿一覧を取得し、コメント取得の計画を立てる
+
+        SeenPostIndex が有効な場合は投稿一覧を SEEN_INDEX_OVERFETCH 件多く取得し、
+        要約済みの投稿を除いた上位 limit 件を対象にする。
+
+        Returns:
+            (全件キャッシュから返せる場合の投稿リスト, 取得対象の Submission リスト,
+             Submission を RedditPost に変換する関数) のタプル
+        """
+        listing_limit = limit + self.overfetch
+        if self.cache is None:
+            best_posts = self._fetch_listing(subreddit_name, listing_limit, time_filter)
+            return None, self._select_unseen(subreddit_name, best_posts, limit), self._fetch_post
+
+        post_ids = self.cache.get_listing(subreddit_name, time_filter, listing_limit)
+        if post_ids is not None:
+            cached_posts = [self.cache.get_post(post_id) for post_id in post_ids]
+            if all(cached is not None for cached in cached_posts):
+                cached_posts = self._select_unseen(subreddit_name, cached_posts, limit)
+                if all(
+                    self.cache.comments_fresh(cached.id, cached.num_comments)
+                    for cached in cached_posts
+                ):
+                    record_metric("reddit_cache_hits", len(cached_posts))
+                    return cached_posts, [], self._fetch_post_cached
+                # 最新の投稿一覧から選び直すため、いったん確保を解放する
+                self.release_seen(subreddit_name, cached_posts)
+
+        # 投稿一覧は 1 リクエストで最新のスコア・コメント数を得られるため常に更新する
+        best_posts = self._fetch_listing(subreddit_name, listing_limit, time_filter)
+        self.cache.put_listing(
+            subreddit_name, time_filter, [post.id for post in best_posts], listing_limit
         )
+        for post in best_posts:
+            self.cache.upsert_post(self._post_from_submission(post))
+        return None, self._select_unseen(subreddit_name, best_posts, limit), self._fetch_post_cached
+
+    def fetch_posts(
+        self, subreddit_name: str, limit: int = 3, time_filter: str = "week"
+    ) -> List[RedditPost]:
+        """指定されたサブレディットの上位投稿とトップレベルコメントを取得する
+
+        各投稿のコメント取得は REDDIT_FETCH_CONCURRENCY 件まで並列に実行し、
+        結果は元の投稿順で返す。RedditCache が有効な場合は読み込みを
+        キャッシュ経由で行い、変化のあった投稿のコメントのみ再取得する。
+
+        Args:
+            subreddit_name: サブレディット名
+            limit: 取得する投稿数
+            time_filter: 時間フィルター（例: "day", "week", "month"）
+
+        Returns:
+            RedditPost のリスト
+        """
+        cached_posts, best_posts, fetch_one = self._plan_fetch(subreddit_name, limit, time_filter)
+        if cached_posts is not None:
+            return cached_posts
+        if not best_posts:
+            return []
+
+        workers = min(self.concurrency, len(best_posts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # executor.map は入力順に結果を返すため、投稿順が保たれる
+            return list(executor.map(_in_current_context(fetch_one), best_posts))
+
+    def iter_posts(
+        self, subreddit_name: str, limit: int = 3, time_filter: str = "week"
+    ) -> Iterator[Tuple[int, RedditPost]]:
+        """fetch_posts と同様に投稿を取得し、取得が完了したものから順に返す
+
+        Args:
+            subreddit_name: サブレディット名
+            limit: 取得する投稿数
+            time_filter: 時間フィルター（例: "day", "week", "month"）
+
+        Yields:
+            (元の投稿順のインデックス, RedditPost) のタプル
+        """
+        cached_posts, best_posts, fetch_one = self._plan_fetch(subreddit_name, limit, time_filter)
+        if cached_posts is not None:
+            yield from enumerate(cached_posts)
+            return
+        if not best_posts:
+            return
+
+        workers = min(self.concurrency, len(best_posts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_in_current_context(fetch_one), post): index
+                for index, post in enumerate(best_posts)
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
 
     def get_hot_posts_with_comments(
         self, subreddit_name: str, limit: int = 3, time_filter: str = "week"
     ) -> str:
         """指定されたサブレディットからホットな投稿とコメントを取得する
 
+        取得結果は PromptInputBuilder により INPUT_TOKEN_BUDGET の範囲に収まるよう
+        整形される。
+
         Args:
             subreddit_name: サブレディット名
             limit: 取得する投稿数
@@ -54,465 +1183,3702 @@ class RedditClient:
         Returns:
             全ての投稿とコメントをテキスト形式で連結した文字列
         """
-        subreddit = self.reddit.subreddit(subreddit_name)
-        best_posts = list(subreddit.top(limit=limit, time_filter=time_filter))
+        posts = self.fetch_posts(subreddit_name, limit, time_filter)
+        return self.build_input(subreddit_name, posts)
 
-        all_posts_text = []
-        for post in best_posts:
-            post_date = datetime.fromtimestamp(post.created_utc, tz=timezone.utc)
-            post_text = [
-                f"タイトル: {post.title}",
-                f"URL: {post.url}",
-                f"投稿日時: {post_date:%Y/%m/%d %H:%M:%S}",
-                f"スコア: {post.score}",
-                f"コメント数: {post.num_comments}",
-                f"本文:\n{post.selftext}",
-            ]
+    def build_input(self, subreddit_name: str, posts: List[RedditPost]) -> str:
+        """取得済みの投稿を PromptInputBuilder でプロンプト入力に整形する
+
+        Args:
+            subreddit_name: サブレディット名 (ログ出力用)
+            posts: RedditPost のリスト
+
+        Returns:
+            全ての投稿とコメントをテキスト形式で連結した文字列
+        """
+        with metric_stage("build"):
+            text, report = PromptInputBuilder().build(posts)
+        report.record_metrics()
+        print(f"r/{subreddit_name}: {report.describe()}")
+        return text
+
+
+class InputBuildReport(BaseModel):
+    """PromptInputBuilder による入力構築の結果レポート"""
+    token_budget: int
+    tokens_used: int = 0
+    posts: int = 0
+    comments_kept: int = 0
+    dropped_deleted: int = 0
+    dropped_duplicate: int = 0
+    dropped_bot: int = 0
+    dropped_budget: int = 0
+    dropped_posts: int = 0
+    truncated_bodies: int = 0
+
+    @property
+    def comments_dropped(self) -> int:
+        """除外されたコメントの合計数"""
+        return (
+            self.dropped_deleted + self.dropped_duplicate
+            + self.dropped_bot + self.dropped_budget
+        )
+
+    def record_metrics(self) -> None:
+        """実行中の RunMetrics に入力構築の結果を記録する"""
+        record_metric("input_tokens", self.tokens_used)
+        record_metric("comments_kept", self.comments_kept)
+        record_metric("comments_dropped", self.comments_dropped)
+
+    def describe(self) -> str:
+        """ログ出力用の要約文字列を返す"""
+        return (
+            f"入力トークン {self.tokens_used}/{self.token_budget} "
+            f"(投稿 {self.posts} 件, コメント採用 {self.comments_kept} 件, "
+            f"除外 {self.comments_dropped} 件: 予算超過 {self.dropped_budget}, "
+            f"重複 {self.dropped_duplicate}, 削除済み {self.dropped_deleted}, "
+            f"bot {self.dropped_bot}, 本文切り詰め {self.truncated_bodies} 件"
+            + (f", 予算不足で除外した投稿 {self.dropped_posts} 件" if self.dropped_posts else "")
+            + ")"
+        )
+
+
+class PromptInputBuilder:
+    """投稿とコメントをトークン予算内に収めたプロンプト入力に整形するクラス
+
+    コメントはスコア順に並べ、削除済み・重複・bot のコメントを除外したうえで、
+    全体のトークン予算を投稿間で公平に配分する。
+    """
+
+    # 1 トークンあたりの文字数の目安 (ASCII, 非 ASCII)
+    CHARS_PER_TOKEN = {
+        "openai": (4.0, 1.0),
+        "cohere": (4.0, 0.8),
+        "gemini": (4.0, 1.2),
+    }
+    DEFAULT_CHARS_PER_TOKEN = (4.0, 1.0)
+    # モデル名の接頭辞ごとの比率 (エンジンの値より優先し、最も長く一致したものを使う)
+    # o200k 系のトークナイザー (gpt-4o 以降) は日本語を cl100k 系より少ないトークンに分割する
+    MODEL_CHARS_PER_TOKEN = {
+        "gpt-3.5": (4.0, 1.0),
+        "gpt-4": (4.0, 1.0),
+        "gpt-4o": (4.0, 1.4),
+        "gpt-4.1": (4.0, 1.4),
+        "o1": (4.0, 1.4),
+        "o3": (4.0, 1.4),
+        "o4": (4.0, 1.4),
+        "command-r": (4.0, 0.8),
+        "gemini-1.5": (4.0, 1.2),
+        "gemini-2": (4.0, 1.3),
+    }
+
+    # 1 投稿の割り当てのうち、本文に使ってよい割合の上限
+    BODY_SHARE = 0.4
+
+    DELETED_BODIES = {"[deleted]", "[removed]", ""}
+    # 定型コメントを投稿する既知の bot (小文字)。これ以外は "_bot" / "-bot" で終わる名前のみ bot とみなす
+    BOT_AUTHORS = {
+        "automoderator", "remindmebot", "repostsleuthbot", "sneakpeekbot",
+        "wikitextbot", "totesmessenger", "savevideobot", "b0trank",
+    }
+    BOT_SUFFIXES = ("_bot", "-bot")
+
+    def __init__(
+        self,
+        engine: Optional[str] = None,
+        model: Optional[str] = None,
+        token_budget: Optional[int] = None,
+    ):
+        """ビルダーの初期化
+
+        Args:
+            engine: AI エンジン名 (省略時は AI_ENGINE)
+            model: モデル名 (省略時は AI_MODEL)
+            token_budget: 入力全体のトークン予算 (省略時は INPUT_TOKEN_BUDGET)
+        """
+        self.engine = engine or os.getenv("AI_ENGINE", "openai")
+        self.model = model or os.getenv("AI_MODEL") or ""
+        self.token_budget = (
+            token_budget if token_budget is not None
+            else int(os.getenv("INPUT_TOKEN_BUDGET", "12000"))
+        )
+        self.ascii_ratio, self.non_ascii_ratio = self._chars_per_token(self.engine, self.model)
+
+    @classmethod
+    def _chars_per_token(cls, engine: str, model: str) -> Tuple[float, float]:
+        """モデル名 (接頭辞の最長一致)、エンジン名の順に文字数の比率を決める"""
+        matches = [prefix for prefix in cls.MODEL_CHARS_PER_TOKEN if model.startswith(prefix)]
+        if matches:
+            return cls.MODEL_CHARS_PER_TOKEN[max(matches, key=len)]
+        return cls.CHARS_PER_TOKEN.get(engine, cls.DEFAULT_CHARS_PER_TOKEN)
+
+    def estimate_tokens(self, text: str) -> int:
+        """テキストのトークン数を文字種ごとの比率から見積もる"""
+        ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+        non_ascii_chars = len(text) - ascii_chars
+        return int(
+            ascii_chars / self.ascii_ratio + non_ascii_chars / self.non_ascii_ratio
+        ) + 1
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """テキストを max_tokens 以内に収まるよう末尾を切り詰める"""
+        tokens = self.estimate_tokens(text)
+        if tokens <= max_tokens:
+            return text
+        # 比例配分で見積もった長さから、末尾の "…" を含めて収まるまで縮める
+        keep = max(0, int(len(text) * max_tokens / tokens) - 1)
+        while keep > 0 and self.estimate_tokens(text[:keep] + "…") > max_tokens:
+            keep -= 1
+        return text[:keep] + "…" if keep > 0 else ""
+
+    @staticmethod
+    def _normalize(body: str) -> str:
+        """重複判定用にコメント本文を正規化する"""
+        return " ".join(body.lower().split())
+
+    def _is_bot(self, comment: RedditComment) -> bool:
+        """bot またはモデレーターによる定型コメントかどうかを判定する"""
+        author = comment.author.lower()
+        return (
+            author in self.BOT_AUTHORS
+            or author.endswith(self.BOT_SUFFIXES)
+            or comment.distinguished == "moderator"
+        )
+
+    def _filter_comments(
+        self, posts: List[RedditPost], report: InputBuildReport
+    ) -> List[List[RedditComment]]:
+        """削除済み・重複・bot コメントを除外し、スコア順に並べる"""
+        seen = set()
+        filtered = []
+        for post in posts:
+            kept = []
+            for comment in sorted(post.comments, key=lambda c: c.score, reverse=True):
+                body = comment.body.strip()
+                if body in self.DELETED_BODIES:
+                    report.dropped_deleted += 1
+                    continue
+                if self._is_bot(comment):
+                    report.dropped_bot += 1
+                    continue
+                key = self._normalize(body)
+                if key in seen:
+                    report.dropped_duplicate += 1
+                    continue
+                seen.add(key)
+                kept.append(comment)
+            filtered.append(kept)
+        return filtered
+
+    @staticmethod
+    def _header(post: RedditPost) -> str:
+        """投稿のメタデータ部分を整形する"""
+        post_date = datetime.fromtimestamp(post.created_utc, tz=timezone.utc)
+        return "\n".join([
+            f"タイトル: {post.title}",
+            f"URL: {post.url}",
+            f"投稿日時: {post_date:%Y/%m/%d %H:%M:%S}",
+            f"スコア: {post.score}",
+            f"コメント数: {post.num_comments}",
+        ])
+
+    @staticmethod
+    def _allocate(demands: List[int], budget: int) -> List[int]:
+        """トークン予算を投稿間で公平に配分する (water-filling)
+
+        需要の小さい投稿から順に均等割りの値を割り当て、余った分を
+        残りの投稿に再配分する。
+        """
+        allocation = [0] * len(demands)
+        remaining = budget
+        order = sorted(range(len(demands)), key=lambda i: demands[i])
+        for position, index in enumerate(order):
+            share = remaining // (len(demands) - position)
+            allocation[index] = min(demands[index], share)
+            remaining -= allocation[index]
+        return allocation
+
+    def build(self, posts: List[RedditPost]) -> Tuple[str, InputBuildReport]:
+        """投稿リストからトークン予算内のプロンプト入力を構築する
+
+        Args:
+            posts: RedditPost のリスト
+
+        Returns:
+            (プロンプト入力テキスト, InputBuildReport) のタプル
+        """
+        report = InputBuildReport(token_budget=self.token_budget, posts=len(posts))
+        if not posts:
+            return "", report
+
+        comments_per_post = self._filter_comments(posts, report)
+        headers = [self._header(post) for post in posts]
+        # メタデータに加え、本文・コメントリストの見出しと投稿間の区切りも固定分として数える
+        header_tokens = [
+            self.estimate_tokens(header + "\n本文:\n\nコメントリスト:\n\n\n") for header in headers
+        ]
+        # 上位の投稿から、固定分が予算に収まるものだけを採用する
+        admitted = 0
+        fixed_tokens = 0
+        while admitted < len(posts) and fixed_tokens + header_tokens[admitted] <= self.token_budget:
+            fixed_tokens += header_tokens[admitted]
+            admitted += 1
+        report.dropped_posts = len(posts) - admitted
+        report.dropped_budget += sum(len(comments) for comments in comments_per_post[admitted:])
+        posts = posts[:admitted]
+
+        body_tokens = [self.estimate_tokens(post.selftext) for post in posts]
+        # コメントは改行で連結するため、区切りの改行を含めて数える
+        comment_tokens = [
+            [self.estimate_tokens(comment.body + "\n") for comment in comments]
+            for comments in comments_per_post[:admitted]
+        ]
+        demands = [body_tokens[i] + sum(comment_tokens[i]) for i in range(len(posts))]
+        # 固定分を先に確保し、残りを本文とコメントに公平に配分する
+        allocation = self._allocate(demands, self.token_budget - fixed_tokens)
+
+        all_posts_text = []
+        for i, post in enumerate(posts):
+            available = allocation[i]
+            comments_demand = sum(comment_tokens[i])
+            body_cap = max(
+                int(available * self.BODY_SHARE), available - comments_demand
+            )
+            body = self._truncate(post.selftext, body_cap)
+            if body != post.selftext:
+                report.truncated_bodies += 1
+            available -= self.estimate_tokens(body) if body else 0
+
+            kept_bodies = []
+            for comment, tokens in zip(comments_per_post[i], comment_tokens[i]):
+                if tokens <= available:
+                    kept_bodies.append(comment.body)
+                    available -= tokens
+                else:
+                    report.dropped_budget += 1
+            report.comments_kept += len(kept_bodies)
+
+            all_posts_text.append("\n".join([
+                headers[i],
+                f"本文:\n{body}",
+                "コメントリスト:\n" + "\n".join(kept_bodies),
+            ]))
+
+        text = "\n\n".join(all_posts_text)
+        report.tokens_used = self.estimate_tokens(text) if text else 0
+        return text, report
+
+
+class StreamingSummaryParser:
+    """ストリーミング中の要約 JSON から digest と details を逐次取り出すパーサー
+
+    digest は配列が閉じた時点で確定し、details は生成途中の文字列を
+    エスケープを解決した状態で参照できる。
+    """
+
+    DIGEST_PATTERN = re.compile(r'"digest"\s*:\s*\[')
+    DETAILS_PATTERN = re.compile(r'"details"\s*:\s*"')
+    # 末尾のサロゲートペアの前半 (\ud800〜\udbff) のエスケープ
+    HIGH_SURROGATE_TAIL = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}$")
+
+    def __init__(self):
+        """パーサーの初期化"""
+        self.buffer = ""
+        self.digest: Optional[List[str]] = None
+        self.details = ""
+        self.details_complete = False
+
+    def feed(self, chunk: str) -> None:
+        """受信した断片を追加し、digest と details を更新する"""
+        self.buffer += chunk
+        if self.digest is None:
+            self._parse_digest()
+        if not self.details_complete:
+            self._parse_details()
+
+    def _parse_digest(self) -> None:
+        """digest 配列が閉じていれば取り出す"""
+        match = self.DIGEST_PATTERN.search(self.buffer)
+        if not match:
+            return
+        start = match.end() - 1
+        in_string = False
+        escaped = False
+        for index in range(start + 1, len(self.buffer)):
+            ch = self.buffer[index]
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = not in_string
+            elif ch == "]" and not in_string:
+                try:
+                    self.digest = [str(line) for line in json.loads(self.buffer[start:index + 1])]
+                except ValueError:
+                    pass
+                return
+
+    def _parse_details(self) -> None:
+        """details 文字列の生成済み部分をデコードして取り出す"""
+        match = self.DETAILS_PATTERN.search(self.buffer)
+        if not match:
+            return
+        raw = self.buffer[match.end():]
+        escaped = False
+        end = None
+        for index, ch in enumerate(raw):
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                end = index
+                break
+        if end is not None:
+            raw = raw[:end]
+            self.details_complete = True
+        else:
+            # 途中で切れているエスケープシーケンスは次の断片を待つ
+            cut = raw.rfind("\\")
+            if cut >= 0 and (cut == len(raw) - 1 or raw[cut + 1] == "u" and len(raw) - cut < 6):
+                raw = raw[:cut]
+            # サロゲートペアの前半だけでは文字にならないため、後半が届くまで待つ
+            raw = self.HIGH_SURROGATE_TAIL.sub("", raw)
+        try:
+            self.details = json.loads(f'"{raw}"')
+        except ValueError:
+            pass
+
+
+def _drop_trailing(chars: List[str], pattern: "re.Pattern[str]") -> None:
+    """出力済みの文字列の末尾が pattern に一致する場合、その部分を取り除く"""
+    text = "".join(chars)
+    match = pattern.search(text)
+    if match:
+        chars[:] = list(text[:match.start()])
+
+
+# 閉じ括弧の直前に残った余分なカンマ
+_TRAILING_COMMA = re.compile(r",\s*$")
+# オブジェクト末尾の値のないキー ("key" または "key":)。先頭の '{' は残す
+_DANGLING_KEY = re.compile(r'(?<=\{)\s*"(?:[^"\\]|\\.)*"\s*:?\s*$|,\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+
+def repair_json_object(text: str) -> Dict[str, Any]:
+    """崩れた、または途中で途切れた JSON オブジェクトを補修してパースする
+
+    最初の '{' から 1 文字ずつ走査し、文字列中の生の改行やタブをエスケープする。
+    閉じ括弧直前の余分なカンマと対応しない閉じ括弧は取り除く。末尾で途切れている
+    場合は、文字列・配列・オブジェクトを閉じ、値のないキーを捨ててから閉じる。
+
+    Args:
+        text: LLM が生成したテキスト
+
+    Returns:
+        パースした dict
+
+    Raises:
+        ValueError: 補修しても JSON オブジェクトとして読み取れない場合
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("JSON オブジェクトが見つかりません")
+
+    chars: List[str] = []
+    closers: List[str] = []
+    in_string = False
+    escaped = False
+    escape_start = -1
+    for ch in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+                escape_start = len(chars)
+            elif ch == '"':
+                in_string = False
+            elif ch in "\n\r\t":
+                ch = json.dumps(ch)[1:-1]
+            chars.append(ch)
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not closers or closers[-1] != ch:
+                continue
+            _drop_trailing(chars, _TRAILING_COMMA)
+            closers.pop()
+            chars.append(ch)
+            if not closers:
+                break
+            continue
+        chars.append(ch)
+
+    if in_string:
+        # 途中で切れているエスケープシーケンス (\ や \u00 など) は捨てる
+        tail = "".join(chars[escape_start:]) if escape_start >= 0 else ""
+        if escaped or (tail.startswith("\\u") and len(tail) < 6):
+            del chars[escape_start:]
+        chars.append('"')
+    while closers:
+        closer = closers.pop()
+        if closer == "}":
+            _drop_trailing(chars, _DANGLING_KEY)
+        _drop_trailing(chars, _TRAILING_COMMA)
+        chars.append(closer)
+
+    data = json.loads("".join(chars))
+    if not isinstance(data, dict):
+        raise ValueError("JSON オブジェクトではありません")
+    return data
+
+
+# イベントループごとに共有する AI リクエストの同時実行数制限
+_AI_SEMAPHORES: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _ai_semaphore() -> asyncio.Semaphore:
+    """実行中のイベントループで共有するセマフォ (上限 AI_MAX_CONCURRENCY) を返す"""
+    loop = asyncio.get_running_loop()
+    if loop not in _AI_SEMAPHORES:
+        _AI_SEMAPHORES[loop] = asyncio.Semaphore(int(os.getenv("AI_MAX_CONCURRENCY", "4")))
+    return _AI_SEMAPHORES[loop]
+
+
+def _ai_request_timeout() -> float:
+    """AI リクエスト 1 回あたりの期限 [秒] (AI_REQUEST_TIMEOUT) を返す"""
+    return float(os.getenv("AI_REQUEST_TIMEOUT", "300"))
+
+
+class AIClient(ABC):
+    """AI サービスとのインターフェースを提供する抽象基底クラス"""
+
+    # AI エンジン名 ("openai", "cohere", "gemini")。register_engine で設定される
+    engine = ""
+    # エンジンが使用する SDK のモジュール名 (起動時間の計測で先に import する)
+    SDK_MODULES: Tuple[str, ...] = ()
+    # 使用するモデル名 (各サブクラスの __init__ で設定する)
+    model_name = ""
+
+    # プロンプトテンプレートを変更した場合はこの値を更新し、要約キャッシュを無効化する
+    PROMPT_TEMPLATE_VERSION = "5"
+
+    # digest を生成・補修できなかった場合に投稿するプレースホルダー
+    PLACEHOLDER_DIGEST = ("要約を生成中...", "要約を生成中...", "要約を生成中...")
+
+    # 要約タスクと出力フォーマット (全エンジン・全サブレディットで共通)
+    SUMMARY_FORMAT_PROMPT = """# Redditトピック要約タスク
+    Reddit のホットトピックをキャラクター会話形式で要約します。
+
+    ## 出力フォーマット
+    1. 最初に「=== ダイジェスト ===」セクションで、3行の要点をまとめてください
+    2. その後「=== 詳細 ===」セクションで、会話形式の詳細を記載してください
+    3. 会話は、ずんだもん・四国めたん・東北きりたん・あんこもんによる会話形式で構成します
+    4. 地の文は使用せず、会話のみで構成します
+    5. 一つのトピックにつき、[指定回数]以上の発言を含めてください
+    6. トピック間は「---」で区切り、各区切りにはトピックの「タイトル」と「RedditのURL」を含めます
+    7. 各発言の行頭には発言者タグ「【ずんだもん】」「【めたん】」「【きりたん】」「【あんこもん】」のいずれかを付けます
+
+    ## レスポンス構造
+    === ダイジェスト ===
+    • [1つ目の重要ポイントや話題を1行で簡潔に]
+    • [2つ目の重要ポイントや話題を1行で簡潔に]
+    • [3つ目の重要ポイントや話題を1行で簡潔に]
+
+    === 詳細 ===
+    [最初の発言]
+    ---
+    タイトル: 「Redditのタイトル」
+    URL: https://...
+    【キャラクター名】[発言内容]
+    【キャラクター名】[発言内容]
+    ...（合計[指定回数]以上の発言）
+    ---
+    （以降、各トピックについて同様の形式で続ける）
+    ---
+    [最後のオチ]
+
+    [指定回数]・[最初の発言]・[最後のオチ] の具体的な内容は「今回の要約設定」に従ってください。
+    """
+
+    # 会話の進行方法 (全エンジン・全サブレディットで共通)
+    PROGRESSION_PROMPT = """    ## 会話の進行方法
+    1. 最初の発言は必ず「今回の要約設定」の [最初の発言] にすること
+    2. 各トピックでは4人全員が会話に参加すること
+    3. キャラクターの発言順序はトピックごとにランダムに変更
+    4. 最後はずんだもんがオチをつけて終了"""
+
+    # 要約の digest のみを details から作り直すタスク (repair_digest で使用)
+    DIGEST_REPAIR_PROMPT = """キャラクター会話形式の Reddit トピック要約が与えられます。
+要約全体の重要ポイントや話題を 1 行ずつ簡潔にまとめた 3 つの要点を作成し、
+次の JSON 形式のみで返答してください: {"digest": ["要点1", "要点2", "要点3"]}"""
+
+    # map-reduce モードで 1 トピックを会話化するタスク (全エンジン・全サブレディットで共通)
+    TOPIC_FORMAT_PROMPT = """# Redditトピック会話化タスク
+    Reddit の 1 つのトピックを、ずんだもん・四国めたん・東北きりたん・あんこもんの会話形式で紹介します。
+
+    ## 出力フォーマット
+    タイトル: 「Redditのタイトル」
+    URL: https://...
+    【キャラクター名】[発言内容]
+    【キャラクター名】[発言内容]
+    ...（合計[指定回数]以上の発言）
+
+    ## ルール
+    1. 地の文は使用せず、会話のみで構成します
+    2. 4人全員が会話に参加し、発言順序はランダムにします
+    3. 導入の挨拶・オチ・区切り線「---」は不要です。上記フォーマットの本文のみを出力してください
+    4. [指定回数] は「今回の要約設定」に従ってください
+    5. 各発言の行頭には発言者タグ「【ずんだもん】」「【めたん】」「【きりたん】」「【あんこもん】」のいずれかを付けます"""
+
+    # キャラクター設定 (全エンジン・全サブレディットで共通)
+    CHARACTER_PROMPT = """# キャラクター設定
+
+    ## ずんだもん
+    * ずんだ餅の妖精
+    * 一人称は「ボク」
+    * 必ず語尾に「〜のだ」「〜なのだ」をつける（例:「わかったのだ」「大好きなのだ」）
+    * フレンドリーかつ優しい言葉遣い（たまに毒舌になることもある）
+    * 禁止表現: 「だよ。」「なのだよ。」「！」（多用しない）、「かな？」（代わりに「のだ？」）
+    * 特定表現: 「ごめん」→「ごめんなのだ」
+
+    ## 四国めたん
+    * 良家のお嬢様の設定
+    * タメ口基調だが「〜でしょう」などの言い回しを使用
+    * 特徴的な語尾: 「〜かしら。」「〜わね。」「〜わよ。」「〜なのよ。」
+    * たまに厨二病的な発言をする
+
+    ## 東北きりたん
+    * 11歳の女性だが、しっかり者
+    * 丁寧な言葉遣いを使用
+
+    ## あんこもん
+    * あんこ餅の妖精（ずんだもんのライバル）
+    * 一人称は「あんこもん」（自分のことを名前で呼ぶ。例:「あんこもんは知ってるもん」）
+    * 語尾は「〜もん」（動詞・形容詞の後）または「〜だもん」（名詞の後）
+    * 例:「知らないもん」「そうだもん」「あんこもんの方が詳しいもん」
+    * 現実的・慎重な視点でコメント（建設的な批判）
+    * ツンデレで負けず嫌いだが、良いものは素直に認めることもある
+    * ずんだもんに対抗意識を持ちつつも、最終的にはフォローすることもある
+    * 禁止: 全否定や攻撃的な表現（「〜なんてない」「粗悪」「価値がない」「おもちゃ」など）
+    * 推奨: 「〜には注意が必要だもん」「〜は慎重に見た方がいいもん」「〜という懸念もあるもん」"""
+
+    def build_static_messages(self) -> List[Dict[str, str]]:
+        """サブレディットや設定に依存しない固定のシステムメッセージを返す
+
+        プロバイダー側のプレフィックスキャッシュが効くよう、毎回バイト単位で
+        同一の内容になるようにする。実行ごとに変わる内容は build_variable_instructions で
+        この後ろに追加する。
+        """
+        return [
+            {"role": "system", "content": self.SUMMARY_FORMAT_PROMPT},
+            {"role": "system", "content": f"{self.CHARACTER_PROMPT}\n\n{self.PROGRESSION_PROMPT}"},
+        ]
+
+    def build_variable_instructions(self, subreddit: str, include_opening: bool = True) -> str:
+        """実行ごとに変わる指示 (サブレディット名・発言数・最初の発言とオチ) を構築する
+
+        Args:
+            subreddit: サブレディット名
+            include_opening: 最初の発言とオチの指定を含めるかどうか
+        """
+        conversation_length = int(os.getenv("CONVERSATION_LENGTH", "15"))
+        lines = [
+            "# 今回の要約設定",
+            f"* 対象: r/{subreddit} (https://www.reddit.com/r/{subreddit}/)",
+            f"* [指定回数]: 一つのトピックにつき {conversation_length} 回以上の発言",
+        ]
+        if include_opening:
+            metan = SummaryRenderer.speaker_tag("めたん")
+            zundamon = SummaryRenderer.speaker_tag("ずんだもん")
+            lines += [
+                f"* 最初の発言: 「{metan}今週の r/{subreddit} (https://www.reddit.com/r/{subreddit}/) で話題になっているトピックを紹介していくわ」",
+                f"* 最後のオチ: 「{zundamon}（最後のオチ）」",
+            ]
+        return "\n".join(lines)
+
+    def build_common_messages(self, subreddit: str, text: str) -> List[Dict[str, str]]:
+        """共通のメッセージ構造を構築する
+
+        固定のシステムメッセージ、実行ごとの指示、要約対象テキストの順に並べる。
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            AI サービスに送信するメッセージの構造
+        """
+        return [
+            *self.build_static_messages(),
+            {"role": "system", "content": self.build_variable_instructions(subreddit)},
+            {"role": "user", "content": text},
+        ]
+
+    @abstractmethod
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """テキストを要約する
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        pass
+
+    async def asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """summarize_text の非同期版
+
+        同時実行数は全クライアントで共有するセマフォ (AI_MAX_CONCURRENCY) で制限し、
+        AI_REQUEST_TIMEOUT 秒を超えた呼び出しはキャンセルして asyncio.TimeoutError を送出する。
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        async with _ai_semaphore():
+            return await asyncio.wait_for(
+                self._asummarize_text(subreddit, text), timeout=_ai_request_timeout()
+            )
+
+    async def _asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """エンジンごとの非同期要約処理
+
+        非同期 SDK を持たないクライアントでは、summarize_text をスレッドで実行する。
+        """
+        return await asyncio.to_thread(self.summarize_text, subreddit, text)
+
+    @abstractmethod
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """メッセージ列を送信し、生成されたテキストをそのまま返す
+
+        Args:
+            messages: 標準形式 (role / content) のメッセージリスト
+            json_output: JSON 形式の出力を要求するかどうか
+
+        Returns:
+            生成されたテキスト
+        """
+        pass
+
+    # submit_summary_batch / retrieve_summary_batch / parse_batch_result を実装しているかどうか
+    SUPPORTS_BATCH = False
+
+    def submit_summary_batch(self, requests: Dict[str, Tuple[str, str]]) -> str:
+        """要約リクエストをまとめてエンジンのバッチ API に登録する
+
+        Args:
+            requests: custom_id をキー、(サブレディット名, 要約するテキスト) を値とする辞書
+
+        Returns:
+            バッチ ID
+        """
+        raise NotImplementedError(f"AI エンジン {self.engine} はバッチ API に対応していません")
+
+    def retrieve_summary_batch(self, batch_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """バッチの状態と、終了していれば custom_id ごとの応答を返す
+
+        Args:
+            batch_id: submit_summary_batch が返したバッチ ID
+
+        Returns:
+            (状態, 結果) のタプル。処理中の場合、結果は None。
+            失敗したリクエストの応答は None になる。
+        """
+        raise NotImplementedError(f"AI エンジン {self.engine} はバッチ API に対応していません")
+
+    def parse_batch_result(self, subreddit: str, result: Any) -> RedditSummary:
+        """retrieve_summary_batch が返した 1 件分の応答を RedditSummary に変換する"""
+        raise NotImplementedError(f"AI エンジン {self.engine} はバッチ API に対応していません")
+
+    def close(self) -> None:
+        """保持している HTTP 接続などを閉じる (既定では何もしない。複数回呼び出してもよい)"""
+
+    def _report_usage(
+        self,
+        label: str,
+        prompt_tokens: Optional[int],
+        completion_tokens: Optional[int],
+        cached_tokens: Optional[int] = None,
+    ) -> None:
+        """トークン使用量 (プロバイダー側キャッシュのヒット分を含む) を出力する
+
+        Args:
+            label: ログの見出し (サブレディット名など)
+            prompt_tokens: 入力トークン数
+            completion_tokens: 出力トークン数
+            cached_tokens: 入力のうちプロバイダー側でキャッシュされたトークン数 (不明な場合は None)
+        """
+        record_metric("llm_calls")
+        record_metric("prompt_tokens", prompt_tokens or 0)
+        record_metric("completion_tokens", completion_tokens or 0)
+        record_metric("cached_tokens", cached_tokens or 0)
+        collector = _USAGE_COLLECTOR.get()
+        if collector is not None:
+            collector[0] += prompt_tokens or 0
+            collector[1] += completion_tokens or 0
+        record_model(self.model_name)
+        cached = f" (キャッシュ {cached_tokens})" if cached_tokens is not None else ""
+        print(
+            f"{label}: {self.model_name} トークン使用量 "
+            f"入力 {prompt_tokens}{cached} / 出力 {completion_tokens}"
+        )
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """要約 JSON を生成されたそばから断片として返す
+
+        ストリーミングに対応していないクライアントでは、要約結果全体を
+        1 つの断片として返す。
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Yields:
+            {"digest": [...], "details": "..."} 形式の JSON テキストの断片
+        """
+        summary, _ = self.summarize_text(subreddit, text)
+        yield summary.model_dump_json()
+
+    def parse_summary_text(self, content: str) -> RedditSummary:
+        """生成された JSON テキスト全体を RedditSummary にパースする
+
+        そのままパースできない場合は repair_json_object で補修して読み取る。
+        digest だけが欠けている・件数が足りない場合は、details から digest のみを
+        再生成する小さな追加呼び出し (repair_digest) で補い、要約全体の再生成は行わない。
+        JSON として読み取れない場合は応答全体を details として扱う。
+        HedgedAIClient / RoutingAIClient の呼び出し中は補修を行わず、プレースホルダーの digest を返す。
+        """
+        with metric_stage("parse"):
+            try:
+                return RedditSummary(**self._parse_json_object(content))
+            except ValueError:
+                pass
+
+            try:
+                data = repair_json_object(content)
+                record_metric("json_repairs")
+            except ValueError:
+                data = {}
+            details = data.get("details")
+            if not isinstance(details, str) or not details.strip():
+                details = content
+            digest = self._digest_lines(data.get("digest"))
+            if len(digest) >= 3:
+                return RedditSummary(digest=digest[:3], details=details)
+
+        if _DEFER_DIGEST_REPAIR.get():
+            # 補修するかどうかは呼び出し元 (HedgedAIClient / RoutingAIClient) が決める
+            return self._parse_text_response(details)
+        return RedditSummary(digest=self.repair_digest(details), details=details)
+
+    @staticmethod
+    def _digest_lines(value: Any) -> List[str]:
+        """digest の値を空行を除いた行のリストにする
+
+        配列ではなく 1 つの文字列で返された場合は改行で分割する。
+        """
+        if isinstance(value, str):
+            value = value.splitlines()
+        return [str(line).strip() for line in value or [] if str(line).strip()]
+
+    def repair_digest(self, details: str) -> List[str]:
+        """details から 3 行の digest のみを再生成する
+
+        入力は DIGEST_REPAIR_CHARS 文字までに切り詰めるため、要約全体を
+        生成し直すよりも大幅に安い。追加呼び出しにも失敗した場合は
+        プレースホルダーの digest を返す。
+
+        Args:
+            details: キャラクター会話形式の詳細内容
+
+        Returns:
+            3 つの要点のリスト
+        """
+        record_metric("digest_repairs")
+        excerpt_chars = int(os.getenv("DIGEST_REPAIR_CHARS", "4000"))
+        messages = [
+            {"role": "system", "content": self.DIGEST_REPAIR_PROMPT},
+            {"role": "user", "content": details[:excerpt_chars]},
+        ]
+        try:
+            with metric_stage("digest_repair"):
+                data = repair_json_object(self.complete(messages, json_output=True))
+            digest = self._digest_lines(data.get("digest"))
+            if len(digest) >= 3:
+                return digest[:3]
+            print("digest の再生成結果が 3 行に満たないため、プレースホルダーを使用します")
+        except Exception as e:
+            print(f"digest の再生成に失敗しました: {str(e)}")
+        # JSONパースに失敗した場合のフォールバック
+        record_metric("parse_fallbacks")
+        return self._parse_text_response(details).digest
+
+    def _parse_text_response(self, content: str) -> RedditSummary:
+        """テキストレスポンスをRedditSummaryにパース"""
+        digest = list(self.PLACEHOLDER_DIGEST)
+        details = content
+        return RedditSummary(digest=digest, details=details)
+
+    @staticmethod
+    def _parse_json_object(text: str) -> Dict[str, Any]:
+        """テキスト中の最初の '{' から最後の '}' までを JSON としてパースする"""
+        start = text.find("{")
+        end = text.rfind("}") + 1
+        if start < 0 or end <= start:
+            raise ValueError("JSON オブジェクトが見つかりません")
+        return json.loads(text[start:end])
+
+    def build_topic_messages(self, subreddit: str, post_text: str) -> List[Dict[str, str]]:
+        """map-reduce モードで 1 トピック分の会話を生成するメッセージを構築する
+
+        Args:
+            subreddit: サブレディット名
+            post_text: 1 投稿分の投稿・コメントテキスト
+
+        Returns:
+            AI サービスに送信するメッセージの構造
+        """
+        return [
+            {"role": "system", "content": self.TOPIC_FORMAT_PROMPT},
+            {"role": "system", "content": self.CHARACTER_PROMPT},
+            {
+                "role": "system",
+                "content": self.build_variable_instructions(subreddit, include_opening=False),
+            },
+            {"role": "user", "content": post_text},
+        ]
+
+    def summarize_topic(self, subreddit: str, post_text: str) -> str:
+        """map ステップ: 1 トピック分の会話を生成する
+
+        Args:
+            subreddit: サブレディット名
+            post_text: 1 投稿分の投稿・コメントテキスト
+
+        Returns:
+            「タイトル」「URL」と会話からなるテキスト
+        """
+        return self.complete(self.build_topic_messages(subreddit, post_text)).strip().strip("-").strip()
+
+    def reduce_topics(self, subreddit: str, topics: List[str]) -> RedditSummary:
+        """reduce ステップ: トピックごとの会話からダイジェストとオチを生成し、詳細を組み立てる
+
+        LLM には各トピックの冒頭のみを渡し、詳細本文はローカルで連結する。
+
+        Args:
+            subreddit: サブレディット名
+            topics: summarize_topic で生成したトピックごとの会話 (投稿順)
+
+        Returns:
+            RedditSummary
+        """
+        excerpt_chars = int(os.getenv("MAPREDUCE_EXCERPT_CHARS", "600"))
+        excerpts = "\n---\n".join(topic[:excerpt_chars] for topic in topics)
+        messages = [
+            {
+                "role": "system",
+                "content": f"""r/{subreddit} で話題のトピックを紹介する会話の抜粋が与えられます。
+以下を JSON 形式で返答してください: {{"digest": [3つの要点], "closing": "オチ"}}
+- digest: トピック全体の重要ポイントや話題を 1 行ずつ簡潔にまとめた 3 つの文字列
+- closing: ずんだもん（語尾「〜のだ」「〜なのだ」）が最後にオチをつける一言。発言者名は含めない""",
+            },
+            {"role": "user", "content": excerpts},
+        ]
+        try:
+            data = repair_json_object(self.complete(messages, json_output=True))
+        except ValueError:
+            data = {}
+
+        metan = SummaryRenderer.speaker_tag("めたん")
+        zundamon = SummaryRenderer.speaker_tag("ずんだもん")
+        closing = str(data.get("closing", "")).strip()
+        for prefix in (zundamon, "ずんだもん:", "ずんだもん："):
+            if closing.startswith(prefix):
+                closing = closing[len(prefix):].strip()
+
+        details = "\n---\n".join(
+            [
+                f"{metan}今週の r/{subreddit} (https://www.reddit.com/r/{subreddit}/) で話題になっているトピックを紹介していくわ。",
+                *topics,
+                f"{zundamon}{closing}",
+            ]
+        )
+        digest = self._digest_lines(data.get("digest"))
+        if len(digest) < 3:
+            digest = self.repair_digest(details)
+        return RedditSummary(digest=digest[:3], details=details)
+
+
+# AI エンジンのレジストリ (エンジン名 → AIClient のサブクラス)
+# SDK は選択されたエンジンのクライアントを作成する時点で初めて import する
+ENGINE_REGISTRY: Dict[str, Type[AIClient]] = {}
+
+# create_ai_client で計測したエンジンごとの起動時間 [秒]
+ENGINE_STARTUP_TIMES: Dict[str, Dict[str, float]] = {}
+
+
+def register_engine(name: str) -> Callable[[Type[AIClient]], Type[AIClient]]:
+    """AIClient のサブクラスを AI エンジンとして登録するデコレーター
+
+    Args:
+        name: AI_ENGINE で指定するエンジン名
+    """
+    def decorator(cls: Type[AIClient]) -> Type[AIClient]:
+        cls.engine = name
+        ENGINE_REGISTRY[name] = cls
+        return cls
+    return decorator
+
+
+@register_engine("openai")
+class OpenAIChatClient(AIClient):
+    """OpenAI API クライアント"""
+
+    SDK_MODULES = ("openai",)
+
+    # RedditSummary のスキーマに従った出力を強制する structured outputs の指定
+    SUMMARY_RESPONSE_FORMAT = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "reddit_summary",
+            "strict": True,
+            "schema": RedditSummary.response_schema(strict=True),
+        },
+    }
+    # structured outputs に対応していないモデルで代わりに使う JSON モードの指定
+    JSON_OBJECT_RESPONSE_FORMAT = {"type": "json_object"}
+
+    # JSON での返答方法 (固定のシステムメッセージの末尾に置く)
+    JSON_OUTPUT_PROMPT = """## JSON での返答
+    上記の「レスポンス構造」の内容を、次のキーを持つ JSON オブジェクトとして返答してください。
+    - digest: 「=== ダイジェスト ===」の 3 行の要点を 1 要素 1 行の配列にしたもの (必ず 3 要素、行頭の「•」は付けない)
+    - details: 「=== 詳細 ===」以降の会話全体を 1 つの文字列にしたもの (発言・区切り線「---」・タイトル・URL は改行で区切る)
+    - 「=== ダイジェスト ===」「=== 詳細 ===」の見出し自体はどちらにも含めない
+    - digest を details より先に出力する"""
+
+    def __init__(self, model: Optional[str] = None):
+        """OpenAI API クライアントの初期化
+
+        Args:
+            model: 使用するモデル名 (省略時は AI_MODEL)
+        """
+        from openai import OpenAI
+
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=_ai_request_timeout())
+        self.model = model or os.getenv("AI_MODEL")
+        self.model_name = self.model
+        self._async_client = None
+        # 要約リクエストの response_format (json_schema を拒否された場合は JSON モードに切り替える)
+        self.summary_response_format: Dict[str, Any] = self.SUMMARY_RESPONSE_FORMAT
+
+    def close(self) -> None:
+        """OpenAI クライアントの HTTP 接続を閉じる
+
+        AsyncOpenAI は作成したイベントループ (HedgedAIClient のループなど) と共に破棄される。
+        """
+        self.client.close()
+
+    def _summary_messages(self, subreddit: str, text: str) -> List[Dict[str, str]]:
+        """要約リクエスト用のメッセージを構築する
+
+        全エンジン共通の固定プロンプトと JSON_OUTPUT_PROMPT を先頭に置く。OpenAI の
+        自動プレフィックスキャッシュは同一の先頭部分が 1024 トークン以上ある場合にのみ
+        効くため、固定部分がこの長さを下回らないよう共通プロンプト全体を使う。
+        """
+        return [
+            *self.build_static_messages(),
+            {"role": "system", "content": self.JSON_OUTPUT_PROMPT},
+            {"role": "system", "content": self.build_variable_instructions(subreddit)},
+            {"role": "user", "content": text}
+        ]
+
+    def _summary_request(self, subreddit: str, text: str) -> Dict[str, Any]:
+        """要約リクエストの chat.completions.create の引数を構築する"""
+        return {
+            "model": self.model,
+            "messages": self._summary_messages(subreddit, text),
+            "response_format": self.summary_response_format,
+        }
+
+    def _fall_back_to_json_object(self, error: Exception) -> bool:
+        """structured outputs を拒否された場合に、以降の要約リクエストを JSON モードに切り替える
+
+        古いモデルは response_format の json_schema に 400 を返すため、同じリクエストを
+        json_object で再試行できるようにする。
+
+        Returns:
+            切り替えた (リクエストを再試行すべき) 場合は True
+        """
+        from openai import BadRequestError
+
+        if self.summary_response_format is not self.SUMMARY_RESPONSE_FORMAT:
+            return False
+        message = str(error)
+        if not isinstance(error, BadRequestError) or (
+            "json_schema" not in message and "response_format" not in message
+        ):
+            return False
+        print(f"{self.model} は structured outputs (json_schema) に対応していないため、JSON モードで再試行します")
+        self.summary_response_format = self.JSON_OBJECT_RESPONSE_FORMAT
+        return True
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """OpenAI API を使用してテキストを要約する
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        try:
+            response = self.client.chat.completions.create(**self._summary_request(subreddit, text))
+        except Exception as e:
+            if not self._fall_back_to_json_object(e):
+                raise
+            response = self.client.chat.completions.create(**self._summary_request(subreddit, text))
+
+        self._report_openai_usage(f"r/{subreddit}", response.usage)
+        return self.parse_summary_text(response.choices[0].message.content), self.model
+
+    def _report_openai_usage(self, label: str, usage: Any) -> None:
+        """OpenAI のレスポンスに含まれる usage を出力する"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) if details else None
+        self._report_usage(label, usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+
+    async def _asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """AsyncOpenAI を使用してテキストを要約する"""
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            self._async_client = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"), timeout=_ai_request_timeout()
+            )
+
+        create = self._async_client.chat.completions.create
+        try:
+            response = await create(**self._summary_request(subreddit, text))
+        except Exception as e:
+            if not self._fall_back_to_json_object(e):
+                raise
+            response = await create(**self._summary_request(subreddit, text))
+
+        self._report_openai_usage(f"r/{subreddit}", response.usage)
+        # digest の補修が必要な場合は同期の追加呼び出しになるため、スレッドで実行する
+        content = response.choices[0].message.content
+        return await asyncio.to_thread(self.parse_summary_text, content), self.model
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """OpenAI API のストリーミングで要約 JSON を生成する"""
+        options = {"stream": True, "stream_options": {"include_usage": True}}
+        try:
+            stream = self.client.chat.completions.create(
+                **self._summary_request(subreddit, text), **options
+            )
+        except Exception as e:
+            if not self._fall_back_to_json_object(e):
+                raise
+            stream = self.client.chat.completions.create(
+                **self._summary_request(subreddit, text), **options
+            )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None) is not None:
+                self._report_openai_usage(f"r/{subreddit}", chunk.usage)
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """OpenAI API にメッセージを送信し、生成されたテキストを返す"""
+        options = {"response_format": {"type": "json_object"}} if json_output else {}
+        response = self.client.chat.completions.create(
+            model=self.model, messages=messages, **options
+        )
+        self._report_openai_usage("complete", response.usage)
+        return response.choices[0].message.content
+
+    SUPPORTS_BATCH = True
+    # 結果がまだ確定していないバッチの状態
+    BATCH_PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+    def submit_summary_batch(self, requests: Dict[str, Tuple[str, str]]) -> str:
+        """要約リクエストを JSONL ファイルとしてアップロードし、OpenAI Batch API に登録する"""
+        lines = [
+            json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._summary_request(subreddit, text),
+            }, ensure_ascii=False)
+            for custom_id, (subreddit, text) in requests.items()
+        ]
+        input_file = self.client.files.create(
+            file=("summaries.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def retrieve_summary_batch(self, batch_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """OpenAI Batch API の状態を確認し、終了していれば出力・エラーファイルを読み込む
+
+        結果は custom_id ごとの chat.completion のレスポンス本文 (失敗した場合は None)。
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in self.BATCH_PENDING_STATUSES:
+            return batch.status, None
+
+        results: Dict[str, Any] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                body = response.get("body") or {}
+                ok = response.get("status_code") == 200 and body.get("choices")
+                results[record["custom_id"]] = body if ok else None
+        return batch.status, results
+
+    def parse_batch_result(self, subreddit: str, result: Any) -> RedditSummary:
+        """Batch API の chat.completion レスポンス本文から使用量を出力し、要約を取り出す"""
+        usage = result.get("usage") or {}
+        details = usage.get("prompt_tokens_details") or {}
+        self._report_usage(
+            f"r/{subreddit}",
+            usage.get("prompt_tokens"),
+            usage.get("completion_tokens"),
+            details.get("cached_tokens"),
+        )
+        return self.parse_summary_text(result["choices"][0]["message"]["content"])
+
+
+@register_engine("cohere")
+class CohereChatClient(AIClient):
+    """Cohere API クライアント"""
+
+    SDK_MODULES = ("cohere",)
+
+    def __init__(self, model: Optional[str] = None):
+        """Cohere API クライアントの初期化
+
+        Args:
+            model: 使用するモデル名 (省略時は AI_MODEL)
+        """
+        import cohere
+
+        self.api_key = os.getenv("COHERE_API_KEY")
+        # COHERE_BASE_URL はベンチマーク用のスタブサーバーなどを指す場合に指定する
+        self.base_url = os.getenv("COHERE_BASE_URL") or None
+        self.client = cohere.Client(
+            self.api_key, base_url=self.base_url, timeout=_ai_request_timeout()
+        )
+        self.model = model or os.getenv("AI_MODEL")
+        self.model_name = self.model
+        self._async_client = None
+
+    def _convert_messages_format(
+        self, messages: List[Dict[str, str]]
+    ) -> List[Dict[str, str]]:
+        """メッセージ形式を Cohere API 形式に変換する
+
+        Args:
+            messages: 標準形式のメッセージリスト
+
+        Returns:
+            Cohere API 形式のメッセージリスト
+        """
+        return [{"role": msg["role"], "text": msg["content"]} for msg in messages]
+
+    def _summary_request(self, subreddit: str, text: str) -> Dict[str, Any]:
+        """要約リクエスト用の chat 引数を構築する
+
+        固定のシステムメッセージは preamble にまとめ、実行ごとに変わる指示と
+        要約対象テキストを chat_history で渡す。
+        """
+        preamble = "\n\n".join(msg["content"] for msg in self.build_static_messages())
+        variable_messages = [
+            {"role": "system", "content": self.build_variable_instructions(subreddit)},
+            # JSONレスポンスを要求するメッセージを追加
+            {"role": "user", "content": text + "\n\nJSON形式で返答してください: {\"digest\": [「要点1」, 「要点2」, 「要点3」], \"details\": \"詳細内容\"}"},
+        ]
+
+        return {
+            "model": self.model,
+            "preamble": preamble,
+            "chat_history": self._convert_messages_format(variable_messages),
+            "message": "指示に従ってJSON形式で要約してください",
+            "response_format": {"type": "json_object", "schema": RedditSummary.response_schema()},
+            "temperature": 1.0,
+        }
+
+    def _report_cohere_usage(self, label: str, meta: Any) -> None:
+        """Cohere のレスポンスに含まれる課金トークン数を出力する
+
+        Cohere はキャッシュされたトークン数を返さないため、キャッシュ分は不明として扱う。
+        """
+        billed_units = getattr(meta, "billed_units", None) if meta else None
+        if billed_units is None:
+            return
+        self._report_usage(label, billed_units.input_tokens, billed_units.output_tokens)
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """Cohere API を使用してテキストを要約する
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        response = self.client.chat(**self._summary_request(subreddit, text))
+        self._report_cohere_usage(f"r/{subreddit}", response.meta)
+        return self.parse_summary_text(response.text), self.model
+
+    async def _asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """cohere.AsyncClient を使用してテキストを要約する"""
+        if self._async_client is None:
+            import cohere
+
+            self._async_client = cohere.AsyncClient(
+                self.api_key, base_url=self.base_url, timeout=_ai_request_timeout()
+            )
+
+        response = await self._async_client.chat(**self._summary_request(subreddit, text))
+        self._report_cohere_usage(f"r/{subreddit}", response.meta)
+        # digest の補修が必要な場合は同期の追加呼び出しになるため、スレッドで実行する
+        return await asyncio.to_thread(self.parse_summary_text, response.text), self.model
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """Cohere API のストリーミングで要約 JSON を生成する"""
+        for event in self.client.chat_stream(**self._summary_request(subreddit, text)):
+            if event.event_type == "text-generation":
+                yield event.text
+            elif event.event_type == "stream-end":
+                self._report_cohere_usage(f"r/{subreddit}", event.response.meta)
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """Cohere API にメッセージを送信し、生成されたテキストを返す
+
+        最後のメッセージを message、それ以前を chat_history として送信する。
+        """
+        message = messages[-1]["content"]
+        options = {}
+        if json_output:
+            message += "\n\nJSON形式のみで返答してください"
+            options["response_format"] = {"type": "json_object"}
+        response = self.client.chat(
+            model=self.model,
+            chat_history=self._convert_messages_format(messages[:-1]),
+            message=message,
+            temperature=1.0,
+            **options,
+        )
+        self._report_cohere_usage("complete", response.meta)
+        return response.text
+
+
+@register_engine("gemini")
+class GeminiChatClient(AIClient):
+    """Google Gemini API クライアント"""
+
+    SDK_MODULES = ("google.generativeai",)
+
+    def __init__(self, model: Optional[str] = None):
+        """Gemini API クライアントの初期化
+
+        Args:
+            model: 使用するモデル名 (省略時は AI_MODEL)
+        """
+        import google.generativeai as genai
+
+        self._genai = genai
+        # GEMINI_API_ENDPOINT はベンチマーク用のスタブサーバーなどを指す場合に指定する
+        api_endpoint = os.getenv("GEMINI_API_ENDPOINT")
+        # REST トランスポートでは generate_content_async が使えないため、非同期要約はスレッドで実行する
+        self._rest_transport = bool(api_endpoint)
+        if api_endpoint:
+            genai.configure(
+                api_key=os.getenv("GOOGLE_API_KEY"),
+                transport="rest",
+                client_options={"api_endpoint": api_endpoint},
+            )
+        else:
+            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        self.model_name = model or os.getenv("AI_MODEL")
+        self.model = genai.GenerativeModel(self.model_name)
+        self.request_options = {"timeout": _ai_request_timeout()}
+        # RedditSummary のスキーマに従った JSON 出力を強制する
+        self.summary_generation_config = {
+            "response_mime_type": "application/json",
+            "response_schema": RedditSummary.response_schema(),
+        }
+        # Gemini は response_schema のプロパティをアルファベット順 (details → digest) に
+        # 出力するため、ストリーミングでは digest を先に投稿できなくなる。順序を指定する
+        # propertyOrdering は固定している SDK の Schema に存在しないので、ストリーミングでは
+        # スキーマを渡さず JSON モードにし、プロンプトの指示どおり digest から出力させる
+        self.stream_generation_config = {"response_mime_type": "application/json"}
+        # system_instruction ごとの GenerativeModel
+        self._models: Dict[str, Any] = {}
+        self._summary_instruction = "\n\n".join(
+            msg["content"] for msg in self.build_static_messages()
+        )
+
+    def _model_for(self, system_instruction: str) -> Any:
+        """system_instruction を設定した GenerativeModel を返す
+
+        固定のシステム指示 (約 1.3k トークン) は CachedContent の最小トークン数に
+        遠く及ばないため明示的なキャッシュは使わない。暗黙的キャッシュに対応した
+        モデルでは、system_instruction が先頭で毎回同一であることが効く。
+        """
+        if system_instruction not in self._models:
+            self._models[system_instruction] = self._genai.GenerativeModel(
+                self.model_name, system_instruction=system_instruction
+            )
+        return self._models[system_instruction]
+
+    def _summary_prompt(self, subreddit: str, text: str) -> str:
+        """要約リクエスト用のプロンプト (system_instruction 以外の部分) を構築する"""
+        prompt_with_json = f"{self.build_variable_instructions(subreddit)}\n\n{text}"
+        # JSONレスポンスを要求するプロンプトを追加 (ストリーミングで先に投稿できるよう digest から出力させる)
+        prompt_with_json += "\n\nJSON形式で、digest を details より先に出力して返答してください: {\"digest\": [「要点1」, 「要点2」, 「要点3」], \"details\": \"詳細内容\"}"
+        return prompt_with_json
+
+    def _report_gemini_usage(self, label: str, usage_metadata: Any) -> None:
+        """Gemini のレスポンスに含まれる usage_metadata を出力する"""
+        if not usage_metadata:
+            return
+        self._report_usage(
+            label,
+            usage_metadata.prompt_token_count,
+            usage_metadata.candidates_token_count,
+            getattr(usage_metadata, "cached_content_token_count", None),
+        )
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """Gemini API を使用してテキストを要約する
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        model = self._model_for(self._summary_instruction)
+        response = model.generate_content(
+            self._summary_prompt(subreddit, text),
+            generation_config=self.summary_generation_config,
+            request_options=self.request_options,
+        )
+        self._report_gemini_usage(f"r/{subreddit}", response.usage_metadata)
+        return self.parse_summary_text(response.text), self.model_name
+
+    async def _asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """generate_content_async を使用してテキストを要約する"""
+        if self._rest_transport:
+            return await super()._asummarize_text(subreddit, text)
+        model = self._model_for(self._summary_instruction)
+        response = await model.generate_content_async(
+            self._summary_prompt(subreddit, text),
+            generation_config=self.summary_generation_config,
+            request_options=self.request_options,
+        )
+        self._report_gemini_usage(f"r/{subreddit}", response.usage_metadata)
+        # digest の補修が必要な場合は同期の追加呼び出しになるため、スレッドで実行する
+        return await asyncio.to_thread(self.parse_summary_text, response.text), self.model_name
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """Gemini API のストリーミングで要約 JSON を生成する"""
+        model = self._model_for(self._summary_instruction)
+        response = model.generate_content(
+            self._summary_prompt(subreddit, text),
+            generation_config=self.stream_generation_config,
+            stream=True,
+            request_options=self.request_options,
+        )
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        self._report_gemini_usage(f"r/{subreddit}", response.usage_metadata)
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """Gemini API にメッセージを送信し、生成されたテキストを返す
+
+        system メッセージは system_instruction として、それ以外は本文として送信する。
+        """
+        system_instruction = "\n\n".join(
+            msg["content"] for msg in messages if msg["role"] == "system"
+        )
+        prompt = "\n\n".join(msg["content"] for msg in messages if msg["role"] != "system")
+        model = self._model_for(system_instruction) if system_instruction else self.model
+        generation_config = {"response_mime_type": "application/json"} if json_output else None
+        response = model.generate_content(
+            prompt, generation_config=generation_config, request_options=self.request_options
+        )
+        self._report_gemini_usage("complete", response.usage_metadata)
+        return response.text
+
+
+class SummaryCache:
+    """要約結果を入力内容のハッシュで保持する SQLite キャッシュ
+
+    同一の入力・エンジン・モデル・プロンプト設定による再実行では LLM を呼ばずに
+    保存済みの RedditSummary を返す。エントリは経過時間と件数の上限で削除する。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS summaries (
+        key TEXT PRIMARY KEY,
+        summary TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    );
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_age: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ):
+        """キャッシュの初期化
+
+        Args:
+            path: SQLite ファイルのパス (省略時は SUMMARY_CACHE_PATH)
+            max_age: エントリの有効期間 [秒] (省略時は SUMMARY_CACHE_MAX_AGE)
+            max_entries: 保持する最大エントリ数 (省略時は SUMMARY_CACHE_MAX_ENTRIES)
+        """
+        self.path = path or os.getenv("SUMMARY_CACHE_PATH", ".cache/summary_cache.sqlite3")
+        self.max_age = (
+            max_age if max_age is not None
+            else float(os.getenv("SUMMARY_CACHE_MAX_AGE", "604800"))
+        )
+        self.max_entries = (
+            max_entries if max_entries is not None
+            else int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "500"))
+        )
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """キャッシュキーとなる SHA-256 ハッシュを作成する
+
+        入力テキストは Unicode 正規化・改行統一・行末空白の除去を行ってからハッシュする。
+        """
+        text = unicodedata.normalize("NFC", parts.pop("text", ""))
+        text = "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+        payload = json.dumps({"text": text, **parts}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[RedditSummary, str]]:
+        """有効期間内のエントリを返す (なければ None)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT summary, model_name, created_at FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > self.max_age:
+                self._conn.execute("DELETE FROM summaries WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE summaries SET accessed_at = ? WHERE key = ?", (now, key))
+        return RedditSummary.model_validate_json(row[0]), row[1]
+
+    def put(self, key: str, summary: RedditSummary, model_name: str) -> None:
+        """エントリを保存し、期限切れ・上限超過のエントリを削除する"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)",
+                (key, summary.model_dump_json(), model_name, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM summaries WHERE created_at < ?", (now - self.max_age,)
+            )
+            self._conn.execute(
+                "DELETE FROM summaries WHERE key NOT IN "
+                "(SELECT key FROM summaries ORDER BY accessed_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def close(self) -> None:
+        """SQLite の接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+
+class CachedAIClient(AIClient):
+    """SummaryCache を経由して要約を行う AIClient のラッパー"""
+
+    def __init__(self, inner: AIClient, cache: Optional[SummaryCache] = None, bypass: bool = False):
+        """ラッパーの初期化
+
+        Args:
+            inner: 実際に要約を行う AIClient
+            cache: 使用する SummaryCache (省略時は新規作成)
+            bypass: True の場合はキャッシュを読まずに必ず LLM を呼ぶ (結果は保存する)
+        """
+        self.inner = inner
+        self.engine = inner.engine
+        self.model_name = inner.model_name
+        self.cache = cache or SummaryCache()
+        self.bypass = bypass
+
+    def cache_key(self, subreddit: str, text: str) -> str:
+        """要約結果に影響する全ての要素からキャッシュキーを作成する"""
+        return SummaryCache.make_key(
+            text=text,
+            subreddit=subreddit.lower(),
+            engine=self.inner.engine,
+            model=self.inner.model_name,
+            conversation_length=int(os.getenv("CONVERSATION_LENGTH", "15")),
+            prompt_version=self.inner.PROMPT_TEMPLATE_VERSION,
+        )
+
+    def _store(self, key: str, summary: RedditSummary, model_name: str) -> None:
+        """要約結果をキャッシュに保存する (digest がプレースホルダーの結果は次回再生成させるため保存しない)"""
+        if tuple(summary.digest) == self.PLACEHOLDER_DIGEST:
+            return
+        self.cache.put(key, summary, model_name)
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """キャッシュにヒットすればその結果を、なければ inner で要約した結果を返す
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, モデル名)のタプル
+        """
+        key = self.cache_key(subreddit, text)
+        if not self.bypass:
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_metric("summary_cache_hits")
+                print(f"r/{subreddit}: 要約キャッシュにヒットしました")
+                return cached
+
+        summary, model_name = self.inner.summarize_text(subreddit, text)
+        self._store(key, summary, model_name)
+        return summary, model_name
+
+    async def asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """summarize_text の非同期版
+
+        同時実行数の制限と期限は inner.asummarize_text 側で適用する。
+        """
+        key = self.cache_key(subreddit, text)
+        if not self.bypass:
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_metric("summary_cache_hits")
+                print(f"r/{subreddit}: 要約キャッシュにヒットしました")
+                return cached
+
+        summary, model_name = await self.inner.asummarize_text(subreddit, text)
+        self._store(key, summary, model_name)
+        return summary, model_name
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """キャッシュにヒットすればその結果を一括で、なければ inner のストリームを返す
+
+        ストリームの完了後、パースした結果をキャッシュに保存する。
+        """
+        key = self.cache_key(subreddit, text)
+        if not self.bypass:
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_metric("summary_cache_hits")
+                print(f"r/{subreddit}: 要約キャッシュにヒットしました")
+                record_model(cached[1])
+                yield cached[0].model_dump_json()
+                return
+
+        # 呼び出し元が集計しているモデル名のうち、このストリームで記録された分を保存に使う
+        models = _MODEL_COLLECTOR.get()
+        start = len(models) if models is not None else 0
+        chunks = []
+        for chunk in self.inner.stream_summary(subreddit, text):
+            chunks.append(chunk)
+            yield chunk
+        # 補修が必要な出力は呼び出し元で parse_summary_text により補修されるため、
+        # ここでは追加呼び出しを重複させないよう、そのままパースできた結果のみ保存する
+        try:
+            summary = RedditSummary(**self._parse_json_object("".join(chunks)))
+        except ValueError:
+            return
+        model_name = models_label(models[start:]) if models is not None else ""
+        self.cache.put(key, summary, model_name or self.inner.model_name)
+
+    def summarize_topic(self, subreddit: str, post_text: str) -> str:
+        """inner にそのまま委譲する (map-reduce モードの呼び出しはキャッシュしない)"""
+        return self.inner.summarize_topic(subreddit, post_text)
+
+    def reduce_topics(self, subreddit: str, topics: List[str]) -> RedditSummary:
+        """inner にそのまま委譲する (map-reduce モードの呼び出しはキャッシュしない)"""
+        return self.inner.reduce_topics(subreddit, topics)
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """inner にそのまま委譲する (map-reduce モードの呼び出しはキャッシュしない)"""
+        return self.inner.complete(messages, json_output)
+
+    def close(self) -> None:
+        """inner とキャッシュの接続を閉じる"""
+        self.inner.close()
+        self.cache.close()
+
+
+class HedgedAIClient(AIClient):
+    """複数の AIClient に段階的にリクエストを送り、最初に得られた有効な要約を採用するラッパー
+
+    先頭のクライアント (プライマリ) にリクエストを送り、hedge_delay 秒以内に結果が
+    返らない場合、またはエラーになった場合に次のクライアントへ同じリクエストを送る。
+    最初に RedditSummary として有効な (digest がプレースホルダーでない) 結果を採用し、
+    残りのリクエストはキャンセルする。
+
+    キャンセルが実際のリクエストまで届くのは、非同期 SDK で asummarize_text を実装した
+    クライアント (OpenAI / Cohere / Gemini と、それらを段階に持つ RoutingAIClient) のみ。
+    同期の summarize_text しか持たないクライアント (プラグインのエンジンなど) は
+    asyncio.to_thread で実行されるため、採用されなかったリクエストも最後まで実行され、
+    その結果が捨てられる (トークンも消費する)。
+    """
+
+    def __init__(self, clients: List[AIClient], hedge_delay: float):
+        """ラッパーの初期化
+
+        Args:
+            clients: リクエストを送る順に並べた AIClient のリスト (先頭がプライマリ)
+            hedge_delay: 次のクライアントにリクエストを送るまでの待ち時間 [秒]
+        """
+        if not clients:
+            raise ValueError("HedgedAIClient には 1 つ以上のクライアントが必要です")
+        self.clients = clients
+        self.primary = clients[0]
+        self.engine = self.primary.engine
+        self.model_name = self.primary.model_name
+        self.hedge_delay = hedge_delay
+        # 非同期 SDK のクライアントをイベントループ間で共有しないよう、専用のループで実行する
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._loop_lock = threading.Lock()
+
+    def _run(self, coroutine_factory: Callable[[], Any]) -> Any:
+        """専用のイベントループでコルーチンを実行し、結果を待つ
+
+        呼び出し元の RunMetrics に記録されるよう、実行中の計測対象を引き継ぐ。
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever, name="ai-hedge-loop", daemon=True
+                )
+                self._loop_thread.start()
+        metrics = _CURRENT_METRICS.get()
+
+        async def run() -> Any:
+            _CURRENT_METRICS.set(metrics)
+            return await coroutine_factory()
+
+        return asyncio.run_coroutine_threadsafe(run(), self._loop).result()
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """asummarize_text を専用のイベントループで実行する
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, 採用した結果を生成したモデル名)のタプル
+        """
+        return self._run(lambda: self.asummarize_text(subreddit, text))
+
+    async def asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """プライマリから順にリクエストを送り、最初に得られた有効な要約を返す
+
+        各クライアントの同時実行数の制限と期限は、それぞれの asummarize_text 側で適用する。
+        並行リクエスト中は digest の補修 (追加呼び出し) を行わせず、digest が欠けた結果は
+        次のクライアントにも送る理由として扱う。全ての結果の digest が欠けていた場合のみ、
+        最初に得られた結果の digest を 1 回だけ補修する。
+
+        Args:
+            subreddit: サブレディット名
+            text: 要約するテキスト
+
+        Returns:
+            (RedditSummary, 採用した結果を生成したモデル名)のタプル
+
+        Raises:
+            Exception: 全てのクライアントが失敗した場合は最後のエラー
+        """
+        token = _DEFER_DIGEST_REPAIR.set(True)
+        try:
+            summary, model_name, client = await self._race(subreddit, text)
+        finally:
+            _DEFER_DIGEST_REPAIR.reset(token)
+        if tuple(summary.digest) == self.PLACEHOLDER_DIGEST:
+            digest = await asyncio.to_thread(client.repair_digest, summary.details)
+            summary = RedditSummary(digest=digest, details=summary.details)
+        return summary, model_name
+
+    async def _race(self, subreddit: str, text: str) -> Tuple[RedditSummary, str, AIClient]:
+        """asummarize_text の並行リクエスト部分
+
+        Returns:
+            (RedditSummary, モデル名, 結果を返した AIClient)のタプル。有効な結果がなく、
+            digest の欠けた結果のみ得られた場合はそのうち最初のもの
+        """
+        waiting = list(self.clients)
+        tasks: Dict["asyncio.Task[Tuple[RedditSummary, str]]", AIClient] = {}
+        pending: set = set()
+        last_error: Optional[BaseException] = None
+        incomplete: Optional[Tuple[RedditSummary, str, AIClient]] = None
+
+        def launch() -> None:
+            client = waiting.pop(0)
+            if client is not self.primary:
+                record_metric("hedge_requests")
+                print(f"r/{subreddit}: {client.engine}/{client.model_name} にもリクエストを送ります")
+            task = asyncio.ensure_future(client.asummarize_text(subreddit, text))
+            tasks[task] = client
+            pending.add(task)
+
+        launch()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if waiting else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # ヘッジ待ち時間を過ぎても結果がないため、次のクライアントにも送る
+                    launch()
+                    continue
+
+                failed = False
+                for task in done:
+                    pending.discard(task)
+                    client = tasks[task]
+                    try:
+                        summary, model_name = task.result()
+                    except Exception as e:
+                        print(f"r/{subreddit}: {client.engine}/{client.model_name} の要約に失敗しました: {str(e)}")
+                        last_error = e
+                        failed = True
+                        continue
+                    if tuple(summary.digest) == self.PLACEHOLDER_DIGEST:
+                        print(f"r/{subreddit}: {client.engine}/{client.model_name} の要約は digest が欠けているため保留します")
+                        if incomplete is None:
+                            incomplete = (summary, model_name, client)
+                        failed = True
+                        continue
+                    if client is not self.primary:
+                        record_metric("hedge_wins")
+                    return summary, model_name, client
+
+                # エラーの場合はヘッジ待ち時間を待たずに次のクライアントへ送る
+                if failed and waiting:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if incomplete is not None:
+            return incomplete
+        raise last_error or RuntimeError("要約を取得できませんでした")
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """プライマリのストリームをそのまま返す
+
+        ストリーミングでは生成途中の内容をそのまま投稿するため、並行リクエストは行わない。
+        """
+        return self.primary.stream_summary(subreddit, text)
+
+    def summarize_topic(self, subreddit: str, post_text: str) -> str:
+        """プライマリから順に送信し、最初に成功した会話を返す"""
+        return self._failover(lambda client: client.summarize_topic(subreddit, post_text))
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """プライマリから順に送信し、最初に成功した結果を返す"""
+        return self._failover(lambda client: client.complete(messages, json_output))
+
+    def _failover(self, call: Callable[[AIClient], Any]) -> Any:
+        """プライマリから順に call を実行し、最初に成功した結果を返す"""
+        for index, client in enumerate(self.clients):
+            try:
+                return call(client)
+            except Exception as e:
+                if index == len(self.clients) - 1:
+                    raise
+                print(f"{client.engine}/{client.model_name} の呼び出しに失敗しました: {str(e)}")
+                record_metric("hedge_requests")
+
+    def close(self) -> None:
+        """専用のイベントループを停止し、各クライアントの接続を閉じる"""
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop = self._loop_thread = None
+        if loop is not None and thread is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        for client in self.clients:
+            client.close()
+
+
+class RoutingAIClient(AIClient):
+    """入力サイズに応じてリクエストごとにモデルを選び分ける AIClient のラッパー
+
+    要約・トピック会話化は入力のトークン数 (PromptInputBuilder の見積もり) から
+    AI_MODEL_TIERS の段階に従ってモデルを選ぶ。digest_client を指定した場合、
+    要約とは別の呼び出しで行う digest の生成 (digest が欠けた応答の補修・map-reduce の
+    reduce) はそのモデルで行う。digest は要約モデルが details と同じ応答で生成した
+    ものを使い、欠けていない限り追加の呼び出しは行わない。
+    ルーティングの判断と所要時間・トークン数・推定コストは AI_ROUTING_LOG_PATH に
+    JSON Lines で記録し、段階の調整に使えるようにする。
+    """
+
+    def __init__(
+        self,
+        tiers: List[Tuple[Optional[int], AIClient]],
+        digest_client: Optional[AIClient] = None,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+        log_path: Optional[str] = None,
+    ):
+        """ラッパーの初期化
+
+        Args:
+            tiers: (入力トークン数の上限, AIClient) のリスト。上限の小さい順に並べ、
+                最後の段階の上限は None (上限なし) にする
+            digest_client: digest の補修と reduce に使う AIClient (省略時は入力サイズで選ぶ)
+            prices: モデル名ごとの (入力, 出力) 100 万トークンあたりの料金 [USD]
+                (省略時は AI_MODEL_PRICES)
+            log_path: ルーティングの記録を追記する JSON Lines ファイル
+                (省略時は AI_ROUTING_LOG_PATH。空文字なら記録しない)
+        """
+        if not tiers or tiers[-1][0] is not None:
+            raise ValueError("RoutingAIClient の最後の段階は上限なしにする必要があります")
+        self.tiers = tiers
+        self.digest_client = digest_client
+        self.engine = tiers[-1][1].engine
+        self.model_name = "+".join(dict.fromkeys(client.model_name for _, client in tiers))
+        if digest_client is not None:
+            self.model_name += f" (digest: {digest_client.model_name})"
+        self.prices = (
+            prices if prices is not None else self.parse_prices(os.getenv("AI_MODEL_PRICES", ""))
+        )
+        self.log_path = (
+            log_path if log_path is not None
+            else os.getenv("AI_ROUTING_LOG_PATH", ".cache/routing.jsonl")
+        )
+        self._estimator = PromptInputBuilder(engine=self.engine)
+        self._log_lock = threading.Lock()
+
+    @staticmethod
+    def parse_tiers(value: str) -> List[Tuple[Optional[int], str]]:
+        """AI_MODEL_TIERS ("8000=gpt-4o-mini,*=gpt-4o" 形式) を (上限, モデル名) のリストに変換する
+
+        上限の小さい順に並べ、"*" (上限なし) は最後にする。
+        """
+        tiers: List[Tuple[Optional[int], str]] = []
+        for entry in value.split(","):
+            if not entry.strip():
+                continue
+            limit, _, model = entry.partition("=")
+            if not model.strip():
+                raise ValueError(f"AI_MODEL_TIERS の形式が正しくありません: {entry}")
+            tiers.append((None if limit.strip() == "*" else int(limit), model.strip()))
+        return sorted(tiers, key=lambda tier: (tier[0] is None, tier[0] or 0))
+
+    @staticmethod
+    def parse_prices(value: str) -> Dict[str, Tuple[float, float]]:
+        """AI_MODEL_PRICES ("gpt-4o-mini=0.15/0.6,..." 形式) をモデル名ごとの料金に変換する"""
+        prices = {}
+        for entry in value.split(","):
+            if not entry.strip():
+                continue
+            model, _, price = entry.partition("=")
+            prompt_price, _, completion_price = price.partition("/")
+            prices[model.strip()] = (float(prompt_price), float(completion_price or prompt_price))
+        return prices
+
+    def select(self, text: str) -> Tuple[Optional[int], AIClient, int]:
+        """入力テキストのトークン数から段階を選ぶ
+
+        Returns:
+            (段階の上限, 選ばれた AIClient, 入力の推定トークン数) のタプル
+        """
+        tokens = self._estimator.estimate_tokens(text)
+        for limit, client in self.tiers:
+            if limit is None or tokens <= limit:
+                return limit, client, tokens
+        return self.tiers[-1][0], self.tiers[-1][1], tokens
+
+    def _route(
+        self,
+        task: str,
+        limit: Optional[int],
+        client: AIClient,
+        input_tokens: int,
+        call: Callable[[], Any],
+    ) -> Any:
+        """選んだクライアントで call を実行し、ルーティングの結果を記録する"""
+        usage = [0, 0]
+        token = _USAGE_COLLECTOR.set(usage)
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = call()
+            ok = True
+            return result
+        finally:
+            _USAGE_COLLECTOR.reset(token)
+            self._log_route(task, limit, client, input_tokens, time.perf_counter() - started, usage, ok)
+
+    async def _aroute(
+        self,
+        task: str,
+        limit: Optional[int],
+        client: AIClient,
+        input_tokens: int,
+        call: Callable[[], Any],
+    ) -> Any:
+        """_route の非同期版 (call はコルーチンを返す関数)"""
+        usage = [0, 0]
+        token = _USAGE_COLLECTOR.set(usage)
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = await call()
+            ok = True
+            return result
+        finally:
+            _USAGE_COLLECTOR.reset(token)
+            self._log_route(task, limit, client, input_tokens, time.perf_counter() - started, usage, ok)
+
+    def _log_route(
+        self,
+        task: str,
+        limit: Optional[int],
+        client: AIClient,
+        input_tokens: int,
+        seconds: float,
+        usage: Optional[List[int]],
+        ok: bool,
+    ) -> None:
+        """ルーティングの判断・所要時間・推定コストを出力し、JSON Lines に追記する
+
+        usage (実際の入力・出力トークン数) が不明な場合、コストは記録しない。
+        """
+        metrics = _CURRENT_METRICS.get()
+        price = self.prices.get(client.model_name)
+        cost = (
+            (usage[0] * price[0] + usage[1] * price[1]) / 1_000_000
+            if price and usage is not None else None
+        )
+        record_metric(f"routed_{task}")
+        if cost is not None:
+            record_metric("llm_cost_usd", cost)
+
+        tier = f"≤{limit}" if limit is not None else "上限なし"
+        cost_text = f"${cost:.4f}" if cost is not None else "不明"
+        label = f"r/{metrics.subreddit}" if metrics is not None else "routing"
+        print(
+            f"{label}: ルーティング {task} 入力 {input_tokens} トークン → {client.model_name} "
+            f"({tier}) {seconds:.2f} 秒, 推定コスト {cost_text}{'' if ok else ' (失敗)'}"
+        )
+        if not self.log_path:
+            return
+        record = {
+            "timestamp": time.time(),
+            "subreddit": metrics.subreddit if metrics is not None else None,
+            "task": task,
+            "input_tokens": input_tokens,
+            "tier_max_tokens": limit,
+            "model": client.model_name,
+            "seconds": round(seconds, 3),
+            "prompt_tokens": usage[0] if usage is not None else None,
+            "completion_tokens": usage[1] if usage is not None else None,
+            "cost_usd": cost,
+            "ok": ok,
+        }
+        try:
+            directory = os.path.dirname(self.log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._log_lock, open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"ルーティングの記録に失敗しました: {str(e)}")
+
+    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """入力サイズで選んだモデルで要約する
+
+        応答の digest が欠けていた場合のみ、選んだモデルではなく complete
+        (digest_client があればそのモデル) で補修する。
+        """
+        limit, client, tokens = self.select(text)
+        deferred = _DEFER_DIGEST_REPAIR.get()
+        token = _DEFER_DIGEST_REPAIR.set(True)
+        try:
+            summary, model_name = self._route(
+                "summary", limit, client, tokens, lambda: client.summarize_text(subreddit, text)
+            )
+        finally:
+            _DEFER_DIGEST_REPAIR.reset(token)
+        if not deferred and tuple(summary.digest) == self.PLACEHOLDER_DIGEST:
+            summary = RedditSummary(digest=self.repair_digest(summary.details), details=summary.details)
+        return summary, model_name
+
+    async def asummarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
+        """summarize_text の非同期版
+
+        選んだクライアントの asummarize_text を直接待つため、HedgedAIClient が
+        このリクエストをキャンセルすると、選んだクライアントのリクエストもキャンセルされる。
+        同時実行数の制限と期限は選んだクライアント側で適用する。
+        """
+        limit, client, tokens = self.select(text)
+        deferred = _DEFER_DIGEST_REPAIR.get()
+        token = _DEFER_DIGEST_REPAIR.set(True)
+        try:
+            summary, model_name = await self._aroute(
+                "summary", limit, client, tokens, lambda: client.asummarize_text(subreddit, text)
+            )
+        finally:
+            _DEFER_DIGEST_REPAIR.reset(token)
+        if not deferred and tuple(summary.digest) == self.PLACEHOLDER_DIGEST:
+            digest = await asyncio.to_thread(self.repair_digest, summary.details)
+            summary = RedditSummary(digest=digest, details=summary.details)
+        return summary, model_name
+
+    def stream_summary(self, subreddit: str, text: str) -> Iterator[str]:
+        """入力サイズで選んだモデルでストリーミング生成する (digest_client は使わない)
+
+        生成はストリームを読み進める呼び出し元で行われるため、選択結果のみを記録する。
+        """
+        limit, client, tokens = self.select(text)
+        self._log_route("stream", limit, client, tokens, 0.0, None, True)
+        return client.stream_summary(subreddit, text)
+
+    def summarize_topic(self, subreddit: str, post_text: str) -> str:
+        """map ステップ: 1 トピック分の入力サイズで選んだモデルで会話を生成する"""
+        limit, client, tokens = self.select(post_text)
+        return self._route(
+            "topic", limit, client, tokens, lambda: client.summarize_topic(subreddit, post_text)
+        )
+
+    def complete(self, messages: List[Dict[str, str]], json_output: bool = False) -> str:
+        """digest_client があればそのモデルで、なければ入力サイズで選んだモデルで生成する
+
+        AIClient の repair_digest / reduce_topics はこのメソッドを通して digest を生成する。
+        """
+        text = "\n".join(message["content"] for message in messages)
+        if self.digest_client is not None:
+            limit, client, tokens = None, self.digest_client, self._estimator.estimate_tokens(text)
+            task = "digest"
+        else:
+            limit, client, tokens = self.select(text)
+            task = "complete"
+        return self._route(
+            task, limit, client, tokens, lambda: client.complete(messages, json_output)
+        )
+
+    def close(self) -> None:
+        """各段階と digest_client の接続を閉じる (同じクライアントは 1 度だけ閉じる)"""
+        clients = [client for _, client in self.tiers] + [self.digest_client]
+        for client in {id(client): client for client in clients if client is not None}.values():
+            client.close()
+
+
+class SummaryRenderer:
+    """発言者タグ付きの RedditSummary を出力先ごとの形式に整形するレンダラー
+
+    モデルには中立な発言者タグ「【ずんだもん】発言」で会話を生成させ、表示名・
+    Slack 絵文字・Markdown・HTML への変換はここでローカルに行う。1 回の生成結果を
+    複数のチャンネルやアーカイブで使い回せる。
+
+    形式:
+        plain: 'ずんだもん: 発言'
+        slack_emoji: ':zundamon: 発言'
+        markdown: '**ずんだもん**: 発言'
+        html: '<p><strong>ずんだもん</strong>: 発言</p>'
+    """
+
+    FORMATS = ("plain", "slack_emoji", "markdown", "html")
+
+    EMOJI_MAP = {
+        "ずんだもん": ":zundamon:",
+        "めたん": ":shikoku-metan:",
+        "きりたん": ":tohoku-kiritan:",
+        "あんこもん": ":ankomon:",
+    }
+    # モデルがフルネームで出力した場合の表記ゆれ
+    SPEAKER_ALIASES = {"四国めたん": "めたん", "東北きりたん": "きりたん"}
+
+    # 発言者タグ付きの行 (タグのない「名前: 発言」形式の出力も受け付ける)
+    SPEAKER_LINE = re.compile(
+        r"^\s*(?:【(?P<tag>[^】]{1,20})】|(?P<name>ずんだもん|四国めたん|めたん|東北きりたん|きりたん|あんこもん)\s*[:：])\s*(?P<text>.*)$"
+    )
+    PARTIAL_TAG = re.compile(r"^\s*【[^】]*$")
+    TITLE_LINE = re.compile(r"^\s*タイトル\s*[:：]\s*「?(?P<title>.*?)」?\s*$")
+    URL_LINE = re.compile(r"^\s*URL\s*[:：]\s*(?P<url>\S+)\s*$")
+
+    def __init__(self, output_format: str = "plain"):
+        """レンダラーの初期化
+
+        Args:
+            output_format: 出力形式 (FORMATS のいずれか)
+
+        Raises:
+            ValueError: サポートされていない形式が指定された場合
+        """
+        if output_format not in self.FORMATS:
+            raise ValueError(f"サポートされていない出力形式: {output_format}")
+        self.format = output_format
+
+    @staticmethod
+    def speaker_tag(name: str) -> str:
+        """プロンプトとモデル出力で使う中立な発言者タグを返す"""
+        return f"【{name}】"
+
+    def _speaker(self, name: str, text: str) -> str:
+        """1 つの発言を出力形式に整形する"""
+        if self.format == "slack_emoji" and name in self.EMOJI_MAP:
+            return f"{self.EMOJI_MAP[name]} {text}"
+        if self.format == "markdown":
+            return f"**{name}**: {text}"
+        if self.format == "html":
+            return f"<p><strong>{html.escape(name)}</strong>: {html.escape(text)}</p>"
+        return f"{name}: {text}"
+
+    def _line(self, line: str) -> str:
+        """details の 1 行を出力形式に整形する"""
+        match = self.SPEAKER_LINE.match(line)
+        if match:
+            name = match.group("tag") or match.group("name")
+            return self._speaker(self.SPEAKER_ALIASES.get(name, name), match.group("text"))
+        if self.format == "markdown":
+            title = self.TITLE_LINE.match(line)
+            if title:
+                return f"### {title.group('title')}"
+            url = self.URL_LINE.match(line)
+            if url:
+                return f"<{url.group('url')}>"
+        if self.format == "html":
+            if line.strip() == "---":
+                return "<hr>"
+            title = self.TITLE_LINE.match(line)
+            if title:
+                return f"<h3>{html.escape(title.group('title'))}</h3>"
+            url = self.URL_LINE.match(line)
+            if url:
+                escaped = html.escape(url.group("url"))
+                return f'<p><a href="{escaped}">{escaped}</a></p>'
+            return f"<p>{html.escape(line)}</p>" if line.strip() else ""
+        return line
+
+    def render_details(self, details: str) -> str:
+        """発言者タグ付きの details を出力形式に整形する
+
+        生成途中 (ストリーミング中) の details を渡してもよい。その場合、
+        閉じていない発言者タグだけの末尾の行は表示しない。
+        """
+        lines = details.split("\n")
+        if self.PARTIAL_TAG.match(lines[-1]):
+            lines.pop()
+        lines = [self._line(line) for line in lines]
+        if self.format == "markdown":
+            # Markdown では発言ごとに段落を分け、区切り線の直前の行が見出しにならないようにする
+            return "\n\n".join(line for line in lines if line.strip())
+        if self.format == "html":
+            return "\n".join(line for line in lines if line)
+        return "\n".join(lines)
+
+    def render_document(self, subreddit: str, summary: RedditSummary, model_name: str) -> str:
+        """digest と details をまとめた 1 つの文書 (アーカイブ用) を返す"""
+        details = self.render_details(summary.details)
+        title = f"今週の r/{subreddit}"
+        if self.format == "markdown":
+            digest = "\n".join(f"- {line}" for line in summary.digest)
+            return f"# {title}\n\n{digest}\n\n---\n\n{details}\n\n使用モデル: {model_name}\n"
+        if self.format == "html":
+            digest = "".join(f"<li>{html.escape(line)}</li>" for line in summary.digest)
+            return (
+                f'<!DOCTYPE html>\n<html lang="ja">\n<head>\n<meta charset="utf-8">\n'
+                f"<title>{html.escape(title)}</title>\n</head>\n<body>\n"
+                f"<h1>{html.escape(title)}</h1>\n<ul>{digest}</ul>\n<hr>\n{details}\n"
+                f"<p>使用モデル: {html.escape(model_name)}</p>\n</body>\n</html>\n"
+            )
+        digest = "\n".join(f"• {line}" for line in summary.digest)
+        return f"📊 {title}\n\n{digest}\n\n{details}\n\n使用モデル: {model_name}\n"
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限"""
+
+    def __init__(self, rate: float, capacity: float):
+        """レート制限の初期化
+
+        Args:
+            rate: 1 秒あたりに補充されるトークン数
+            capacity: バケットの容量 (バースト可能な回数)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンを 1 つ取得する (足りない場合は補充されるまで待機する)"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            wait_seconds = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+            # 待機分のトークンを先取りし、ロック外で待機する
+            self.tokens -= 1
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class SlackNotifier:
+    """Slack 通知クライアント
+
+    HTTP セッションを使い回し、チャンネルごとのトークンバケットで送信レートを
+    制限する。429 / 5xx / 通信エラーは Retry-After を尊重して再試行する。
+    """
+
+    def __init__(self):
+        """Slack API クライアントの初期化"""
+        self.token = os.getenv("SLACK_BOT_TOKEN")
+        self.channel = os.getenv("SLACK_CHANNEL")
+        api_base_url = os.getenv("SLACK_API_BASE_URL", "https://slack.com/api").rstrip("/")
+        self.url = f"{api_base_url}/chat.postMessage"
+        self.update_url = f"{api_base_url}/chat.update"
+        self.delete_url = f"{api_base_url}/chat.delete"
+        self.max_retries = int(os.getenv("SLACK_MAX_RETRIES", "3"))
+        self.max_message_chars = int(os.getenv("SLACK_MAX_MESSAGE_CHARS", "3500"))
+        self.rate = float(os.getenv("SLACK_RATE_PER_SECOND", "1.0"))
+        self.burst = float(os.getenv("SLACK_RATE_BURST", "2"))
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        })
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+        # chat.update にはチャンネル ID が必要なため、投稿時のレスポンスから
+        # 「指定されたチャンネル名 → チャンネル ID」を記録する (チャンネル数までしか増えない)
+        self._channel_ids: Dict[str, str] = {}
+
+    def _channel_id(self, channel: str) -> str:
+        """記録済みであればチャンネル名をチャンネル ID に変換する"""
+        return self._channel_ids.get(channel, channel)
+
+    def _bucket(self, channel: str) -> TokenBucket:
+        """チャンネルごとのトークンバケットを返す
+
+        chat.postMessage (チャンネル名) と chat.update (チャンネル ID) で同じ
+        バケットを使うよう、チャンネル ID をキーにする。
+        """
+        key = self._channel_id(channel)
+        with self._buckets_lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    def _call(self, url: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Slack API を呼び出す
+
+        レート制限を待ってから送信し、429 / 5xx / 通信エラーの場合は
+        Retry-After (なければ指数バックオフ) だけ待って再試行する。
+
+        Returns:
+            成功時はレスポンスの JSON、失敗時は None
+        """
+        bucket = self._bucket(payload["channel"])
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            wait_seconds = 2 ** attempt
+            record_metric("slack_requests")
+            if attempt > 0:
+                record_metric("slack_retries")
+            try:
+                response = self.session.post(url, json=payload, timeout=30)
+            except requests.RequestException as e:
+                print(f"Slack への送信でエラーが発生しました: {str(e)}")
+            else:
+                try:
+                    data = response.json() if response.status_code == 200 else None
+                except ValueError:
+                    # プロキシのエラーページなど、JSON でない 200 応答は一時的な失敗として再試行する
+                    print("Slack API が JSON でない応答を返しました。再試行します")
+                else:
+                    if data is not None and data.get("ok"):
+                        return data
+                    retryable = response.status_code == 429 or response.status_code >= 500
+                    if not retryable:
+                        print(f"エラーが発生しました: {response.status_code}: {response.text}")
+                        record_metric("slack_failures")
+                        return None
+                    wait_seconds = float(response.headers.get("Retry-After", wait_seconds))
+                    print(
+                        f"Slack API が {response.status_code} を返しました。"
+                        f"{wait_seconds:.0f} 秒後に再試行します"
+                    )
+            if attempt < self.max_retries:
+                time.sleep(wait_seconds)
+        record_metric("slack_failures")
+        return None
+
+    def send_message(
+        self, text: str, thread_ts: Optional[str] = None, channel: Optional[str] = None
+    ) -> Optional[str]:
+        """Slack にメッセージを送信する
+
+        Args:
+            text: 送信するテキスト
+            thread_ts: スレッド ID (オプション)
+            channel: 送信先チャンネル (省略時は SLACK_CHANNEL)
+
+        Returns:
+            送信成功時はメッセージ ID、失敗時は None
+        """
+        payload = {
+            "channel": channel or self.channel,
+            "text": text,
+        }
+
+        if thread_ts:
+            payload["thread_ts"] = thread_ts
+
+        data = self._call(self.url, payload)
+        if data is None:
+            return None
+        if data.get("channel"):
+            self._channel_ids[payload["channel"]] = data["channel"]
+        return data.get("ts")
+
+    def update_message(self, ts: str, text: str, channel: Optional[str] = None) -> bool:
+        """送信済みのメッセージを chat.update で書き換える
+
+        Args:
+            ts: send_message が返したメッセージ ID
+            text: 新しいテキスト
+            channel: 送信時に指定したチャンネル (省略時は SLACK_CHANNEL)
+
+        Returns:
+            更新に成功した場合は True
+        """
+        payload = {
+            "channel": self._channel_id(channel or self.channel),
+            "ts": ts,
+            "text": text,
+        }
+        return self._call(self.update_url, payload) is not None
+
+    def delete_message(self, ts: str, channel: Optional[str] = None) -> bool:
+        """送信済みのメッセージを chat.delete で削除する
+
+        Args:
+            ts: send_message が返したメッセージ ID
+            channel: 送信時に指定したチャンネル (省略時は SLACK_CHANNEL)
+
+        Returns:
+            削除に成功した場合は True
+        """
+        payload = {
+            "channel": self._channel_id(channel or self.channel),
+            "ts": ts,
+        }
+        return self._call(self.delete_url, payload) is not None
+
+    def split_message(self, text: str) -> List[str]:
+        """長いテキストを SLACK_MAX_MESSAGE_CHARS 以内のメッセージに分割する
+
+        トピック区切りの「---」行を優先して分割し、1 トピックが上限を超える場合は
+        行単位、それでも超える場合は文字数で分割する。
+
+        Args:
+            text: 分割するテキスト
+
+        Returns:
+            順序を保った分割後のテキストのリスト
+        """
+        limit = self.max_message_chars
+        if len(text) <= limit:
+            return [text]
+
+        # (直前との区切り, テキスト) の組に分解する
+        pieces = []
+        for section_index, section in enumerate(text.split("\n---\n")):
+            separator = "\n---\n" if section_index else ""
+            if len(section) <= limit:
+                pieces.append((separator, section))
+                continue
+            for line_index, line in enumerate(section.split("\n")):
+                line_separator = separator if line_index == 0 else "\n"
+                for offset in range(0, max(len(line), 1), limit):
+                    pieces.append((line_separator if offset == 0 else "", line[offset:offset + limit]))
+
+        chunks = []
+        current = ""
+        for separator, piece in pieces:
+            if current and len(current) + len(separator) + len(piece) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = current + separator + piece if current else piece
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def send_thread(
+        self, text: str, thread_ts: str, channel: Optional[str] = None
+    ) -> List[str]:
+        """テキストを分割し、スレッドへの返信として順番に送信する
+
+        Args:
+            text: 送信するテキスト
+            thread_ts: スレッド ID
+            channel: 送信先チャンネル (省略時は SLACK_CHANNEL)
+
+        Returns:
+            送信に成功したメッセージ ID のリスト (失敗した時点で打ち切る)
+        """
+        sent = []
+        for chunk in self.split_message(text):
+            ts = self.send_message(chunk, thread_ts, channel=channel)
+            if not ts:
+                break
+            sent.append(ts)
+        return sent
+
+    def close(self) -> None:
+        """HTTP セッションを閉じる"""
+        self.session.close()
+
+
+class ProgressiveMessage:
+    """ストリーミング生成中のテキストでスレッド内の返信を段階的に更新するヘルパー
+
+    chat.update のレート制限 (Tier 3) に収まるよう、更新間隔を
+    SLACK_UPDATE_INTERVAL 秒以上に間引く。テキストが 1 メッセージの上限を
+    超えた場合は、確定した部分を書き切ってから次の返信に移る。
+    最終結果の返信数が生成途中より少なくなった場合は、余った返信を削除する。
+    """
+
+    def __init__(
+        self,
+        notifier: SlackNotifier,
+        thread_ts: str,
+        channel: Optional[str] = None,
+        min_interval: Optional[float] = None,
+    ):
+        """ヘルパーの初期化
+
+        Args:
+            notifier: 送信・更新に使用する SlackNotifier
+            thread_ts: 返信先のスレッド ID
+            channel: 送信先チャンネル (省略時は SLACK_CHANNEL)
+            min_interval: 更新の最小間隔 [秒] (省略時は SLACK_UPDATE_INTERVAL)
+        """
+        self.notifier = notifier
+        self.thread_ts = thread_ts
+        self.channel = channel
+        self.min_interval = (
+            min_interval if min_interval is not None
+            else float(os.getenv("SLACK_UPDATE_INTERVAL", "1.5"))
+        )
+        self.message_ts: List[str] = []
+        self._texts: List[str] = []
+        self._last_update = 0.0
+
+    def _write(self, index: int, text: str) -> bool:
+        """index 番目の返信を作成または更新する
+
+        Returns:
+            返信がこのテキストになっている場合は True
+        """
+        if index > len(self.message_ts):
+            # 直前の返信の送信に失敗している場合は順序を保つため送信しない
+            return False
+        if index < len(self.message_ts):
+            if text == self._texts[index]:
+                return True
+            updated = self.notifier.update_message(
+                self.message_ts[index], text, channel=self.channel
+            )
+            if not updated:
+                return False
+            self._texts[index] = text
+        else:
+            ts = self.notifier.send_message(text, self.thread_ts, channel=self.channel)
+            if ts is None:
+                return False
+            self.message_ts.append(ts)
+            self._texts.append(text)
+        self._last_update = time.monotonic()
+        return True
+
+    def _trim(self, count: int) -> bool:
+        """count 番目以降の返信を後ろから削除する
+
+        Returns:
+            余った返信を全て削除できた場合は True
+        """
+        while len(self.message_ts) > count:
+            if not self.notifier.delete_message(self.message_ts[-1], channel=self.channel):
+                return False
+            self.message_ts.pop()
+            self._texts.pop()
+        return True
+
+    def update(self, text: str, force: bool = False, cursor: str = " ▌") -> bool:
+        """前回の更新から min_interval 経過していれば返信を書き換える
+
+        force の場合は、最終結果より多く送信済みの返信 (生成途中のテキストが長かった
+        場合に残るもの) を削除する。
+
+        Args:
+            text: これまでに生成されたテキスト全体
+            force: True の場合は間隔に関わらず更新する (最終結果の反映用)
+            cursor: 生成途中であることを示す末尾の記号 (force 時は付けない)
+
+        Returns:
+            送信・更新・削除に 1 件も失敗しなかった場合は True
+            (間隔により更新を見送った場合も True)
+        """
+        chunks = self.notifier.split_message(text)
+        # 上限を超えて確定したチャンクは、間隔に関わらず書き切って次の返信に移る
+        # (内容が変わっていないチャンクは _write 内で送信をスキップする)
+        ok = all([self._write(index, chunks[index]) for index in range(len(chunks) - 1)])
+        if not force:
+            if time.monotonic() - self._last_update < self.min_interval:
+                return ok
+            return self._write(len(chunks) - 1, chunks[-1] + cursor) and ok
+        ok = self._write(len(chunks) - 1, chunks[-1]) and ok
+        return self._trim(len(chunks)) and ok
+
+
+def _load_engine_plugins() -> None:
+    """AI_ENGINE_PLUGINS (カンマ区切りのモジュール名) を import し、外部エンジンを登録させる
+
+    python main.py として実行するとこのモジュールは __main__ になるため、プラグインの
+    `from main import register_engine` が main.py を別のモジュールとして読み直し、
+    そちらの ENGINE_REGISTRY に登録してしまう。実行中のモジュールを main として
+    登録してから import する。
+    """
+    sys.modules.setdefault("main", sys.modules[__name__])
+    for module_name in os.getenv("AI_ENGINE_PLUGINS", "").split(","):
+        if module_name.strip():
+            importlib.import_module(module_name.strip())
+
+
+def create_ai_client(ai_engine: str, model: Optional[str] = None) -> AIClient:
+    """AI エンジン名に基づいて適切な AI クライアントを作成する
+
+    SDK の import 時間とクライアントの初期化時間を ENGINE_STARTUP_TIMES に記録する。
+
+    Args:
+        ai_engine: AI エンジン名 ("openai", "cohere", "gemini" または登録済みのプラグイン)
+        model: 使用するモデル名 (省略時は AI_MODEL)
+
+    Returns:
+        AIClient インスタンス
+
+    Raises:
+        ValueError: サポートされていない AI エンジンが指定された場合
+    """
+    _load_engine_plugins()
+    engine_class = ENGINE_REGISTRY.get(ai_engine)
+    if engine_class is None:
+        raise ValueError(f"サポートされていない AI エンジン: {ai_engine}")
+
+    started = time.perf_counter()
+    for module_name in engine_class.SDK_MODULES:
+        importlib.import_module(module_name)
+    imported = time.perf_counter()
+    client = engine_class(model) if model else engine_class()
+    constructed = time.perf_counter()
+
+    ENGINE_STARTUP_TIMES[ai_engine] = {
+        "import_seconds": imported - started,
+        "construct_seconds": constructed - imported,
+    }
+    return client
+
+
+def benchmark_startup(engines: List[str]) -> List[Dict[str, Any]]:
+    """エンジンごとの起動時間を新しいプロセスで計測する
+
+    SDK の import キャッシュの影響を避けるため、エンジンごとに
+    "--startup-probe" モードの子プロセスを起動して計測する。
+    "none" はエンジンを作成しない場合の基準値として扱う。
+
+    Args:
+        engines: 計測するエンジン名のリスト
+
+    Returns:
+        エンジンごとの計測結果 (プロセス全体の所要時間・import 時間・初期化時間)
+    """
+    results = []
+    for engine in engines:
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--startup-probe", engine],
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - started
+        result = {"engine": engine, "process_seconds": elapsed}
+        if completed.returncode == 0:
+            result.update(json.loads(completed.stdout.strip().splitlines()[-1]))
+        else:
+            result["error"] = completed.stderr.strip().splitlines()[-1:]
+        results.append(result)
+    return results
+
+
+class MetricsExporter:
+    """RunMetrics を JSON Lines と Prometheus の textfile 形式で書き出すクラス
+
+    METRICS_JSONL_PATH には実行ごとに 1 行を追記し、METRICS_PROM_PATH には
+    サブレディットごとの最新の値を node_exporter の textfile collector 形式で書き出す。
+    いずれも未設定の場合は何も書き出さない。
+    """
+
+    PROM_PREFIX = "reddit_digest"
+    PROM_SAMPLE = re.compile(r"^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)\{(?P<labels>.*)\} (?P<value>\S+)$")
+
+    def __init__(self, jsonl_path: Optional[str] = None, prom_path: Optional[str] = None):
+        """エクスポーターの初期化
+
+        Args:
+            jsonl_path: JSON Lines の出力先 (省略時は METRICS_JSONL_PATH)
+            prom_path: Prometheus textfile の出力先 (省略時は METRICS_PROM_PATH)
+        """
+        self.jsonl_path = jsonl_path or os.getenv("METRICS_JSONL_PATH") or None
+        self.prom_path = prom_path or os.getenv("METRICS_PROM_PATH") or None
+        self._lock = threading.Lock()
+
+    def export(self, metrics: RunMetrics) -> None:
+        """計測結果を設定された出力先に書き出す"""
+        record = metrics.to_record()
+        with self._lock:
+            if self.jsonl_path:
+                self._append_jsonl(record)
+            if self.prom_path:
+                self._write_prom(record)
+
+    def _append_jsonl(self, record: Dict[str, Any]) -> None:
+        """JSON Lines ファイルに 1 行追記する"""
+        directory = os.path.dirname(self.jsonl_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.jsonl_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def _escape_label(value: str) -> str:
+        """Prometheus のラベル値をエスケープする"""
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def _samples(self, record: Dict[str, Any]) -> List[Tuple[str, str, float]]:
+        """レコードを (メトリクス名, ラベル, 値) のサンプルに変換する"""
+        subreddit = f'subreddit="{self._escape_label(record["subreddit"])}"'
+        prefix = self.PROM_PREFIX
+        finished_at = datetime.fromisoformat(record["timestamp"]).timestamp() + record["duration_seconds"]
+        run_labels = (
+            f'{subreddit},engine="{self._escape_label(record["engine"])}",'
+            f'model="{self._escape_label(record["model"] or "")}"'
+        )
+        samples = [
+            (f"{prefix}_run_success", run_labels, 1.0 if record["ok"] else 0.0),
+            (f"{prefix}_run_timestamp_seconds", subreddit, finished_at),
+            (f"{prefix}_run_duration_seconds", subreddit, record["duration_seconds"]),
+        ]
+        for stage, stats in record["stages"].items():
+            labels = f'{subreddit},stage="{self._escape_label(stage)}"'
+            samples.append((f"{prefix}_stage_seconds", labels, stats["seconds"]))
+            samples.append((f"{prefix}_stage_max_seconds", labels, stats["max_seconds"]))
+            samples.append((f"{prefix}_stage_calls", labels, stats["count"]))
+        for name, value in record["counters"].items():
+            samples.append((f"{prefix}_{name}", subreddit, value))
+        return samples
+
+    def _write_prom(self, record: Dict[str, Any]) -> None:
+        """Prometheus textfile を書き換える
+
+        他のサブレディットの最新値は既存ファイルから引き継ぎ、collector が
+        書きかけのファイルを読まないよう一時ファイルからの rename で置き換える。
+        """
+        subreddit_label = f'subreddit="{self._escape_label(record["subreddit"])}"'
+        series: Dict[str, List[str]] = {}
+        if os.path.exists(self.prom_path):
+            with open(self.prom_path, encoding="utf-8") as f:
+                for line in f:
+                    match = self.PROM_SAMPLE.match(line.rstrip("\n"))
+                    if match is None or subreddit_label in match.group("labels").split(","):
+                        continue
+                    series.setdefault(match.group("name"), []).append(line.rstrip("\n"))
+        for name, labels, value in self._samples(record):
+            series.setdefault(name, []).append(f"{name}{{{labels}}} {float(value)!r}")
+
+        directory = os.path.dirname(self.prom_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.prom_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for name in sorted(series):
+                f.write(f"# TYPE {name} gauge\n")
+                for line in sorted(series[name]):
+                    f.write(line + "\n")
+        os.replace(temp_path, self.prom_path)
+
+
+class BatchJob(BaseModel):
+    """バッチモードで処理する 1 サブレディット分のジョブ"""
+    subreddit: str
+    channel: Optional[str] = None
+    limit: int = 3
+
+
+class BatchResult(BaseModel):
+    """バッチジョブの実行結果"""
+    subreddit: str
+    ok: bool
+    error: Optional[str] = None
+
+
+class SummaryBatchItem(BaseModel):
+    """バッチ API に登録した 1 サブレディット分の要約リクエスト"""
+    custom_id: str
+    subreddit: str
+    channel: Optional[str] = None
+    # 要約対象の投稿 (RedditPost のコメント以外のフィールド)。投稿後に要約済みとして記録する
+    posts: List[List[Any]] = []
+
+    @classmethod
+    def from_posts(
+        cls, custom_id: str, subreddit: str, channel: Optional[str], posts: List[RedditPost]
+    ) -> "SummaryBatchItem":
+        """RedditPost のリストから作成する"""
+        return cls(
+            custom_id=custom_id,
+            subreddit=subreddit,
+            channel=channel,
+            posts=[
+                [p.id, p.title, p.url, p.created_utc, p.score, p.num_comments, p.selftext]
+                for p in posts
+            ],
+        )
+
+    def reddit_posts(self) -> List[RedditPost]:
+        """保存した投稿を RedditPost (コメントなし) として復元する"""
+        return [RedditPost(*row) for row in self.posts]
+
+
+class SummaryBatchStore:
+    """バッチ API に登録した要約リクエストの状態を保持する SQLite ストア
+
+    プロセスを再起動しても結果の回収と投稿を再開できるよう、バッチ ID と
+    投稿に必要な情報 (サブレディット・送信先チャンネル・対象の投稿) を保存する。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS summary_batches (
+        id TEXT PRIMARY KEY,
+        engine TEXT NOT NULL,
+        model TEXT NOT NULL,
+        status TEXT NOT NULL,
+        submitted_at REAL NOT NULL,
+        finished_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS summary_batch_items (
+        custom_id TEXT PRIMARY KEY,
+        batch_id TEXT NOT NULL,
+        item TEXT NOT NULL,
+        state TEXT NOT NULL,
+        error TEXT
+    );
+    """
+
+    # 終了したバッチの記録を保持する期間 [秒]
+    MAX_AGE = 2592000
+
+    def __init__(self, path: Optional[str] = None):
+        """ストアの初期化
+
+        Args:
+            path: SQLite ファイルのパス (省略時は AI_BATCH_STATE_PATH)
+        """
+        self.path = path or os.getenv("AI_BATCH_STATE_PATH", ".cache/summary_batches.sqlite3")
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+
+    def add(self, batch_id: str, engine: str, model: str, items: List[SummaryBatchItem]) -> None:
+        """登録したバッチを保存し、期限切れの記録を削除する"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO summary_batches VALUES (?, ?, ?, 'submitted', ?, NULL)",
+                (batch_id, engine, model, now),
+            )
+            self._conn.executemany(
+                "INSERT INTO summary_batch_items VALUES (?, ?, ?, 'pending', NULL)",
+                [(item.custom_id, batch_id, item.model_dump_json()) for item in items],
+            )
+            self._conn.execute(
+                "DELETE FROM summary_batch_items WHERE batch_id IN "
+                "(SELECT id FROM summary_batches WHERE finished_at < ?)",
+                (now - self.MAX_AGE,),
+            )
+            self._conn.execute(
+                "DELETE FROM summary_batches WHERE finished_at < ?", (now - self.MAX_AGE,)
+            )
+
+    def pending_batches(self) -> List[Tuple[str, str]]:
+        """結果を回収していないバッチの (バッチ ID, モデル名) を登録順に返す"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, model FROM summary_batches WHERE finished_at IS NULL "
+                "ORDER BY submitted_at"
+            ).fetchall()
+
+    def pending_items(self, batch_id: Optional[str] = None) -> List[SummaryBatchItem]:
+        """投稿していないリクエストを返す (batch_id を省略した場合は全バッチ分)"""
+        query = "SELECT item FROM summary_batch_items WHERE state = 'pending'"
+        params: Tuple[Any, ...] = ()
+        if batch_id is not None:
+            query += " AND batch_id = ?"
+            params = (batch_id,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [SummaryBatchItem.model_validate_json(row[0]) for row in rows]
+
+    def set_item_state(self, custom_id: str, state: str, error: Optional[str] = None) -> None:
+        """リクエストの状態 ("posted" / "failed") を記録する"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE summary_batch_items SET state = ?, error = ? WHERE custom_id = ?",
+                (state, error, custom_id),
+            )
+
+    def finish_batch(self, batch_id: str, status: str) -> None:
+        """バッチの最終状態を記録し、回収済みにする"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE summary_batches SET status = ?, finished_at = ? WHERE id = ?",
+                (status, time.time(), batch_id),
+            )
+
+    def close(self) -> None:
+        """SQLite の接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+
+class Application:
+    """メインアプリケーションクラス"""
+
+    def __init__(self):
+        """アプリケーションの初期化"""
+        ai_engine = os.getenv("AI_ENGINE", "openai")
+        self.ai_client = create_ai_client(ai_engine)
+        # バッチ API はルーティング・ヘッジ・要約キャッシュを経由せず、AI_MODEL のクライアントで直接呼び出す
+        self.batch_client = self.ai_client
+        startup = ENGINE_STARTUP_TIMES[ai_engine]
+        print(
+            f"AI エンジン {ai_engine}: import {startup['import_seconds']:.2f} 秒, "
+            f"初期化 {startup['construct_seconds']:.2f} 秒"
+        )
+        tiers = RoutingAIClient.parse_tiers(os.getenv("AI_MODEL_TIERS", ""))
+        digest_model = os.getenv("AI_DIGEST_MODEL") or None
+        if tiers or digest_model:
+            # 入力サイズに応じてモデルを選び、digest は AI_DIGEST_MODEL で生成する
+            clients = {self.ai_client.model_name: self.ai_client}
+
+            def client_for(model: str) -> AIClient:
+                if model not in clients:
+                    clients[model] = create_ai_client(ai_engine, model)
+                return clients[model]
+
+            if not tiers or tiers[-1][0] is not None:
+                tiers.append((None, self.ai_client.model_name))
+            self.ai_client = RoutingAIClient(
+                [(limit, client_for(model)) for limit, model in tiers],
+                digest_client=client_for(digest_model) if digest_model else None,
+            )
+        hedge_engine = os.getenv("AI_HEDGE_ENGINE") or None
+        hedge_model = os.getenv("AI_HEDGE_MODEL") or None
+        if hedge_engine or hedge_model:
+            # 応答が遅い・エラーになった場合に別のエンジン/モデルにも同じリクエストを送る
+            secondary = create_ai_client(hedge_engine or ai_engine, hedge_model)
+            self.ai_client = HedgedAIClient(
+                [self.ai_client, secondary],
+                hedge_delay=float(os.getenv("AI_HEDGE_DELAY", "60")),
+            )
+        if _env_flag("SUMMARY_CACHE_ENABLED", "true"):
+            self.ai_client = CachedAIClient(
+                self.ai_client, bypass=_env_flag("SUMMARY_CACHE_BYPASS")
+            )
+        self.reddit_client = RedditClient()
+        self.slack_notifier = SlackNotifier()
+        # "single": 全投稿を 1 回で要約 / "mapreduce": 投稿ごとに並列要約してから統合
+        self.summary_mode = os.getenv("SUMMARY_MODE", "single")
+        self.streaming = _env_flag("SLACK_STREAMING")
+        # 発言者を Slack 絵文字で表示するチャンネル (SLACK_EMOJI_NAMES=true の場合は全チャンネル)
+        self.emoji_channels = {
+            channel.strip()
+            for channel in os.getenv("SLACK_EMOJI_CHANNELS", "").split(",")
+            if channel.strip()
+        }
+        # 要約を Markdown / HTML などでも保存するディレクトリ (未設定なら保存しない)
+        self.archive_dir = os.getenv("SUMMARY_ARCHIVE_DIR") or None
+        self.archive_renderers = [
+            SummaryRenderer(output_format.strip())
+            for output_format in os.getenv("SUMMARY_ARCHIVE_FORMATS", "markdown,html").split(",")
+            if output_format.strip()
+        ]
+        self.metrics_exporter = MetricsExporter()
+        # true の場合、run_batch は要約をバッチ API に登録し、結果は poll_summary_batches で投稿する
+        self.batch_api = _env_flag("AI_BATCH_API")
+        self.batch_store: Optional[SummaryBatchStore] = None
+        if self.batch_api:
+            if not self.batch_client.SUPPORTS_BATCH:
+                raise ValueError(f"AI エンジン {ai_engine} はバッチ API (AI_BATCH_API) に対応していません")
+            self.batch_store = SummaryBatchStore()
+
+    def close(self) -> None:
+        """AI / Reddit / Slack のクライアントとキャッシュの接続を閉じる
+
+        HedgedAIClient のイベントループのスレッドも停止する。close の後は使用できない。
+        """
+        self.ai_client.close()
+        if self.batch_client is not self.ai_client:
+            self.batch_client.close()
+        self.reddit_client.close()
+        self.slack_notifier.close()
+        if self.batch_store is not None:
+            self.batch_store.close()
+
+    @contextmanager
+    def instrument(self, subreddit_name: str) -> Iterator[RunMetrics]:
+        """with ブロック内の処理を 1 回の実行として計測し、終了時に書き出す
 
-            # コメント処理
-            comments = post.comments
-            comment_list = [
-                comment.body
-                for comment in comments
-                if isinstance(comment, praw.models.Comment)
-            ]
+        ブロック内 (ワーカースレッドを含む) の各ステージは metric_stage /
+        record_metric を通じて、ここで作成した RunMetrics に記録される。
 
-            post_text.append("コメントリスト:\n" + "\n".join(comment_list))
-            all_posts_text.append("\n".join(post_text))
+        Args:
+            subreddit_name: サブレディット名
 
-        return "\n\n".join(all_posts_text)
+        Yields:
+            RunMetrics
+        """
+        metrics = RunMetrics(
+            subreddit_name, engine=self.ai_client.engine, model=self.ai_client.model_name
+        )
+        token = _CURRENT_METRICS.set(metrics)
+        try:
+            yield metrics
+        except BaseException as e:
+            metrics.finish(False, str(e))
+            raise
+        else:
+            if metrics.ok is None:
+                metrics.finish(True)
+        finally:
+            _CURRENT_METRICS.reset(token)
+            print(f"r/{subreddit_name}: {metrics.describe()}")
+            try:
+                self.metrics_exporter.export(metrics)
+            except OSError as e:
+                print(f"計測結果の書き出しに失敗しました: {str(e)}")
 
+    def fetch(self, subreddit_name: str, limit: int) -> Tuple[str, List[RedditPost]]:
+        """Reddit から投稿とコメントを取得する
 
-class AIClient(ABC):
-    """AI サービスとのインターフェースを提供する抽象基底クラス"""
+        Returns:
+            (プロンプト入力テキスト, 対象の RedditPost リスト) のタプル。
+            要約済みでない投稿が 1 件もない場合、投稿リストは空になる。
+        """
+        with metric_stage("fetch"):
+            posts = self.reddit_client.fetch_posts(subreddit_name, limit)
+            if not posts:
+                return "", []
+            return self.reddit_client.build_input(subreddit_name, posts), posts
 
-    EMOJI_MAP = {
-        "ずんだもん": ":zundamon:",
-        "めたん": ":shikoku-metan:",
-        "きりたん": ":tohoku-kiritan:",
-        "あんこもん": ":ankomon:",
-    }
+    def summarize(self, subreddit_name: str, text: str) -> Tuple[RedditSummary, str]:
+        """AI による要約 (structured output) を生成する"""
+        with metric_stage("summarize"):
+            return self.ai_client.summarize_text(subreddit_name, text)
 
-    @staticmethod
-    def _use_emoji_names() -> bool:
-        """環境変数 SLACK_EMOJI_NAMES が truthy かどうかを判定する"""
-        return os.getenv("SLACK_EMOJI_NAMES", "").lower() in ("true", "1", "yes")
-
-    def _speaker_label(self, name: str) -> str:
-        """発言者ラベルを返す
-
-        通常モード: 'ずんだもん:'
-        絵文字モード: ':zundamon:'
-        """
-        if self._use_emoji_names():
-            return self.EMOJI_MAP.get(name, name + ":")
-        return name + ":"
-
-    def _speaker_label_instruction(self) -> str:
-        """絵文字モード時の発言者ラベル指示を返す"""
-        if not self._use_emoji_names():
-            return ""
-        lines = "\n".join(
-            f"    * {name} → `{emoji}`"
-            for name, emoji in self.EMOJI_MAP.items()
-        )
-        return f"""
-    ## 発言者ラベルの表記ルール
-    会話の発言者ラベルには、キャラクター名ではなく以下の Slack 絵文字コードを使用してください:
-{lines}
-    例: `:zundamon: すごいのだ！`
-"""
+    def summarize_mapreduce(
+        self, subreddit_name: str, limit: int
+    ) -> Tuple[Optional[RedditSummary], str, List[RedditPost]]:
+        """map-reduce モードで要約を生成する
 
-    def build_common_messages(self, subreddit: str, text: str) -> List[Dict[str, str]]:
-        """共通のメッセージ構造を構築する
+        各投稿はコメントの取得が完了した時点で MAPREDUCE_CONCURRENCY 件まで並列に
+        会話化 (map) し、最後に小さな reduce 呼び出しでダイジェストとオチを生成する。
 
         Args:
-            subreddit: サブレディット名
-            text: 要約するテキスト
+            subreddit_name: サブレディット名
+            limit: 取得する投稿数
 
         Returns:
-            AI サービスに送信するメッセージの構造
+            (RedditSummary, モデル名, 対象の RedditPost リスト)のタプル。
+            要約済みでない投稿が 1 件もない場合は (None, モデル名, [])
         """
-        conversation_length = int(os.getenv("CONVERSATION_LENGTH", "15"))
-        metan = self._speaker_label("めたん")
-        zundamon = self._speaker_label("ずんだもん")
-        label_instruction = self._speaker_label_instruction()
-
-        return [
-            {
-                "role": "system",
-                "content": f"""# Redditトピック要約タスク
-    Reddit のホットトピックをキャラクター会話形式で要約します。
-
-    ## 出力フォーマット
-    1. 最初に「=== ダイジェスト ===」セクションで、3行の要点をまとめてください
-    2. その後「=== 詳細 ===」セクションで、会話形式の詳細を記載してください
-    3. 会話は、ずんだもん・四国めたん・東北きりたん・あんこもんによる会話形式で構成します
-    4. 地の文は使用せず、会話のみで構成します
-    5. 一つのトピックにつき、{conversation_length}回以上の発言を含めてください
-    6. トピック間は「---」で区切り、各区切りにはトピックの「タイトル」と「RedditのURL」を含めます
+        builder = PromptInputBuilder(
+            token_budget=int(os.getenv("MAPREDUCE_POST_TOKEN_BUDGET", "4000"))
+        )
 
-    ## レスポンス構造
-    === ダイジェスト ===
-    • [1つ目の重要ポイントや話題を1行で簡潔に]
-    • [2つ目の重要ポイントや話題を1行で簡潔に]
-    • [3つ目の重要ポイントや話題を1行で簡潔に]
-    
-    === 詳細 ===
-    {metan} 今週の r/{subreddit} (https://www.reddit.com/r/{subreddit}/) で話題になっているトピックを紹介していくわ。
-    ---
-    タイトル: 「Redditのタイトル」
-    URL: https://...
-    [キャラクター名]: [発言内容]
-    [キャラクター名]: [発言内容]
-    ...（合計{conversation_length}回以上の発言）
-    ---
-    （以降、各トピックについて同様の形式で続ける）
-    ---
-    {zundamon} （最後のオチ）
-    """,
-            },
-            {
-                "role": "system",
-                "content": f"""# キャラクター設定
+        def map_post(post: RedditPost) -> str:
+            with metric_stage("build"):
+                post_text, report = builder.build([post])
+            report.record_metrics()
+            print(f"r/{subreddit_name} ({post.id}): {report.describe()}")
+            with metric_stage("summarize_topic"):
+                return self.ai_client.summarize_topic(subreddit_name, post_text)
 
-    ## ずんだもん
-    * ずんだ餅の妖精
-    * 一人称は「ボク」
-    * 必ず語尾に「〜のだ」「〜なのだ」をつける（例:「わかったのだ」「大好きなのだ」）
-    * フレンドリーかつ優しい言葉遣い（たまに毒舌になることもある）
-    * 禁止表現: 「だよ。」「なのだよ。」「！」（多用しない）、「かな？」（代わりに「のだ？」）
-    * 特定表現: 「ごめん」→「ごめんなのだ」
+        workers = int(os.getenv("MAPREDUCE_CONCURRENCY", "4"))
+        with collect_models() as models:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    index: (post, executor.submit(_in_current_context(map_post), post))
+                    for index, post in self.reddit_client.iter_posts(subreddit_name, limit)
+                }
+                posts = [futures[index][0] for index in sorted(futures)]
+                topics = [futures[index][1].result() for index in sorted(futures)]
 
-    ## 四国めたん
-    * 良家のお嬢様の設定
-    * タメ口基調だが「〜でしょう」などの言い回しを使用
-    * 特徴的な語尾: 「〜かしら。」「〜わね。」「〜わよ。」「〜なのよ。」
-    * たまに厨二病的な発言をする
+            if not topics:
+                return None, self.ai_client.model_name, []
+            with metric_stage("reduce"):
+                summary_response = self.ai_client.reduce_topics(subreddit_name, topics)
+        return summary_response, self.used_model_name(models), posts
 
-    ## 東北きりたん
-    * 11歳の女性だが、しっかり者
-    * 丁寧な言葉遣いを使用
+    def used_model_name(self, models: List[str]) -> str:
+        """collect_models で集計したモデル名をフッター用にまとめる
 
-    ## あんこもん
-    * あんこ餅の妖精（ずんだもんのライバル）
-    * 一人称は「あんこもん」（自分のことを名前で呼ぶ。例:「あんこもんは知ってるもん」）
-    * 語尾は「〜もん」（動詞・形容詞の後）または「〜だもん」（名詞の後）
-    * 例:「知らないもん」「そうだもん」「あんこもんの方が詳しいもん」
-    * 現実的・慎重な視点でコメント（建設的な批判）
-    * ツンデレで負けず嫌いだが、良いものは素直に認めることもある
-    * ずんだもんに対抗意識を持ちつつも、最終的にはフォローすることもある
-    * 禁止: 全否定や攻撃的な表現（「〜なんてない」「粗悪」「価値がない」「おもちゃ」など）
-    * 推奨: 「〜には注意が必要だもん」「〜は慎重に見た方がいいもん」「〜という懸念もあるもん」
+        ルーティングやヘッジで実際に使われたモデルのみを表示する。
+        使用量を報告しないクライアントで記録がない場合は ai_client のモデル名を返す。
+        """
+        return models_label(models) or self.ai_client.model_name
 
-    ## 会話の進行方法
-    1. 最初の発言は必ず: 「{metan} 今週の r/{subreddit} (https://www.reddit.com/r/{subreddit}/) で話題になっているトピックを紹介していくわ」
-    2. 各トピックでは4人全員が会話に参加すること
-    3. キャラクターの発言順序はトピックごとにランダムに変更
-    4. 最後はずんだもんがオチをつけて終了
-    {label_instruction}""",
-            },
-            {"role": "user", "content": text},
-        ]
+    def slack_renderer(self, channel: Optional[str] = None) -> SummaryRenderer:
+        """送信先チャンネルに応じた発言者表記のレンダラーを返す"""
+        channel = channel or self.slack_notifier.channel
+        if _env_flag("SLACK_EMOJI_NAMES") or channel in self.emoji_channels:
+            return SummaryRenderer("slack_emoji")
+        return SummaryRenderer("plain")
 
-    @abstractmethod
-    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
-        """テキストを要約する
+    def archive(self, subreddit_name: str, summary_response: RedditSummary, model_name: str) -> None:
+        """要約を SUMMARY_ARCHIVE_DIR に SUMMARY_ARCHIVE_FORMATS の各形式で保存する"""
+        if self.archive_dir is None:
+            return
+        extensions = {"plain": "txt", "slack_emoji": "txt", "markdown": "md", "html": "html"}
+        directory = os.path.join(self.archive_dir, subreddit_name)
+        stem = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for renderer in self.archive_renderers:
+                path = os.path.join(directory, f"{stem}.{extensions[renderer.format]}")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(renderer.render_document(subreddit_name, summary_response, model_name))
+        except OSError as e:
+            print(f"要約の保存に失敗しました: {str(e)}")
 
-        Args:
-            subreddit: サブレディット名
-            text: 要約するテキスト
+    def post(
+        self,
+        subreddit_name: str,
+        summary_response: RedditSummary,
+        model_name: str,
+        channel: Optional[str] = None,
+    ) -> bool:
+        """要約を Slack に投稿する (SUMMARY_ARCHIVE_DIR が設定されていれば保存も行う)
 
         Returns:
-            (RedditSummary, モデル名)のタプル
+            ダイジェストの投稿に成功した場合は True
         """
-        pass
+        self.archive(subreddit_name, summary_response, model_name)
+        with metric_stage("post"):
+            # ダイジェストを整形
+            digest_formatted = "\n".join([f"• {line}" for line in summary_response.digest])
 
+            # 最初のメッセージにダイジェストを含める
+            first_message = f"📊 今週の r/{subreddit_name}\n\n{digest_formatted}"
+            thread_ts = self.slack_notifier.send_message(first_message, channel=channel)
+            if not thread_ts:
+                return False
 
-class OpenAIChatClient(AIClient):
-    """OpenAI API クライアント"""
+            # 詳細とモデル名を追加
+            details = self.slack_renderer(channel).render_details(summary_response.details)
+            details_with_model = f"{details}\n\n使用モデル: {model_name}"
+            self.slack_notifier.send_thread(details_with_model, thread_ts, channel=channel)
+            return True
 
-    def __init__(self):
-        """OpenAI API クライアントの初期化"""
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        self.model = os.getenv("AI_MODEL")
+    def summarize_and_post_streaming(
+        self, subreddit_name: str, text: str, channel: Optional[str] = None
+    ) -> bool:
+        """要約をストリーミング生成しながら Slack に投稿する
 
-    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
-        """OpenAI API を使用してテキストを要約する
+        digest が確定した時点でダイジェストを投稿し、スレッド内の詳細メッセージを
+        生成の進行に合わせて chat.update で書き換える。
 
         Args:
-            subreddit: サブレディット名
+            subreddit_name: サブレディット名
             text: 要約するテキスト
+            channel: 送信先チャンネル (省略時は SLACK_CHANNEL)
 
         Returns:
-            (RedditSummary, モデル名)のタプル
+            ダイジェストと最終的な詳細の投稿に成功した場合は True
         """
-        conversation_length = int(os.getenv("CONVERSATION_LENGTH", "15"))
-        metan = self._speaker_label("めたん")
-        zundamon = self._speaker_label("ずんだもん")
-        label_instruction = self._speaker_label_instruction()
-
-        system_message = f"""あなたはRedditのトピックを要約するアシスタントです。
-
-以下のキャラクターを使った会話形式で要約してください：
-- ずんだもん: 語尾に「〜のだ」「〜なのだ」をつける
-- 四国めたん: 「〜かしら」「〜わね」「〜わよ」の語尾を使う
-- 東北きりたん: 丁寧な言葉遣い
-- あんこもん: 語尾に「〜もん」「〜だもん」をつける。一人称は「あんこもん」。現実的・慎重な視点で建設的な批判をする
-
-詳細のフォーマット:
-{metan} 今週の r/{subreddit} (https://www.reddit.com/r/{subreddit}/) で話題になっているトピックを紹介していくわ。
----
-タイトル: 「[Redditのタイトル]」
-URL: [URL]
-[キャラクター名]: [発言内容]
-（{conversation_length}回以上の発言）
----
-（各トピックを同様に）
----
-{zundamon} [オチ]{label_instruction}
-
-JSON形式で返答してください: {{"digest": [3つの要点], "details": "詳細"}}"""
-
-        messages = [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": text}
-        ]
-
-        import json
-
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            response_format={"type": "json_object"}
-        )
+        parser = StreamingSummaryParser()
+        renderer = self.slack_renderer(channel)
+        progress: Optional[ProgressiveMessage] = None
+        thread_ts = None
 
-        content = response.choices[0].message.content
-        data = json.loads(content)
-        return RedditSummary(**data), self.model
+        # 生成と投稿が重なって進むため、まとめて 1 つのステージとして計測する
+        with collect_models() as models, metric_stage("summarize_and_post"):
+            for chunk in self.ai_client.stream_summary(subreddit_name, text):
+                parser.feed(chunk)
+                if thread_ts is None and parser.digest is not None:
+                    digest_formatted = "\n".join([f"• {line}" for line in parser.digest])
+                    first_message = f"📊 今週の r/{subreddit_name}\n\n{digest_formatted}"
+                    thread_ts = self.slack_notifier.send_message(first_message, channel=channel)
+                    if not thread_ts:
+                        return False
+                    progress = ProgressiveMessage(self.slack_notifier, thread_ts, channel)
+                if progress is not None and parser.details:
+                    progress.update(renderer.render_details(parser.details))
 
+        # フッターには digest の補修を除いた、ストリームを生成したモデルを表示する
+        model_name = self.used_model_name(models)
+        summary_response = self.ai_client.parse_summary_text(parser.buffer)
+        if thread_ts is None:
+            # digest が途中で確定しなかった場合は通常の投稿にフォールバックする
+            return self.post(subreddit_name, summary_response, model_name, channel)
 
-class CohereChatClient(AIClient):
-    """Cohere API クライアント"""
+        self.archive(subreddit_name, summary_response, model_name)
+        details = renderer.render_details(summary_response.details)
+        details_with_model = f"{details}\n\n使用モデル: {model_name}"
+        with metric_stage("summarize_and_post"):
+            return progress.update(details_with_model, force=True)
 
-    def __init__(self):
-        """Cohere API クライアントの初期化"""
-        self.api_key = os.getenv("COHERE_API_KEY")
-        self.client = cohere.Client(self.api_key)
-        self.model = os.getenv("AI_MODEL")
+    def process(
+        self,
+        subreddit_name: str,
+        limit: int,
+        channel: Optional[str] = None,
+        slots: Optional[Dict[str, threading.Semaphore]] = None,
+    ) -> bool:
+        """1 サブレディット分の取得 → 要約 → 投稿を実行する
 
-    def _convert_messages_format(
-        self, messages: List[Dict[str, str]]
-    ) -> List[Dict[str, str]]:
-        """メッセージ形式を Cohere API 形式に変換する
+        投稿に成功した場合は対象の投稿を SeenPostIndex に要約済みとして記録し、
+        失敗した場合は取得時に確保した投稿を解放する。
+        要約済みでない投稿が 1 件もない場合は何も投稿しない。
 
         Args:
-            messages: 標準形式のメッセージリスト
+            subreddit_name: サブレディット名
+            limit: 取得する投稿数
+            channel: 送信先チャンネル (省略時は SLACK_CHANNEL)
+            slots: ステージ ("fetch" / "summarize" / "post") ごとの同時実行数を制限する
+                セマフォ (バッチモード用。省略したステージは制限しない)
 
         Returns:
-            Cohere API 形式のメッセージリスト
+            投稿に成功した、または投稿する対象がなかった場合は True
         """
-        return [{"role": msg["role"], "text": msg["content"]} for msg in messages]
+        slots = slots or {}
 
-    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
-        """Cohere API を使用してテキストを要約する
+        def slot(stage: str) -> ContextManager[Any]:
+            return slots.get(stage) or nullcontext()
 
-        Args:
-            subreddit: サブレディット名
-            text: 要約するテキスト
+        posted = False
+        try:
+            if self.summary_mode == "mapreduce":
+                # map-reduce モードでは取得と要約が重なって進むため、要約ステージとして扱う
+                with slot("summarize"):
+                    summary_response, model_name, posts = self.summarize_mapreduce(subreddit_name, limit)
+                if posts:
+                    with slot("post"):
+                        posted = self.post(subreddit_name, summary_response, model_name, channel)
+            else:
+                with slot("fetch"):
+                    all_posts_text, posts = self.fetch(subreddit_name, limit)
+                if posts and self.streaming:
+                    # ストリーミングでは要約と投稿が重なって進むため、要約ステージとして扱う
+                    with slot("summarize"):
+                        posted = self.summarize_and_post_streaming(
+                            subreddit_name, all_posts_text, channel
+                        )
+                elif posts:
+                    with slot("summarize"):
+                        summary_response, model_name = self.summarize(subreddit_name, all_posts_text)
+                    with slot("post"):
+                        posted = self.post(subreddit_name, summary_response, model_name, channel)
 
-        Returns:
-            (RedditSummary, モデル名)のタプル
+            if not posts:
+                print(f"r/{subreddit_name}: 要約済みでない投稿がないため、投稿をスキップします")
+                return True
+            if posted:
+                self.reddit_client.mark_seen(subreddit_name, posts)
+            return posted
+        finally:
+            if not posted:
+                # 投稿しなかった投稿は、他のサブレディットや次回の実行で選べるようにする
+                self.reddit_client.release_seen(subreddit_name)
+
+    def run(self, subreddit_name: str, limit: int) -> None:
+        """アプリケーションを実行する
+
+        Args:
+            subreddit_name: サブレディット名
+            limit: 取得する投稿数
         """
-        import json
+        try:
+            with self.instrument(subreddit_name) as metrics:
+                if not self.process(subreddit_name, limit):
+                    metrics.finish(False, "Slack への通知に失敗しました。")
+                    print("Slack への通知に失敗しました。")
 
-        common_messages = self.build_common_messages(subreddit, text)
-        # JSONレスポンスを要求するメッセージを追加
-        common_messages[-1]["content"] += "\n\nJSON形式で返答してください: {\"digest\": [「要点1」, 「要点2」, 「要点3」], \"details\": \"詳細内容\"}"
-        messages = self._convert_messages_format(common_messages)
+        except Exception as e:
+            print(f"エラーが発生しました: {str(e)}")
+            sys.exit(1)
 
-        response = self.client.chat(
-            model=self.model,
-            chat_history=messages,
-            message="指示に従ってJSON形式で要約してください",
-            temperature=1.0,
-        )
+    def run_batch(self, jobs: List[BatchJob]) -> List[BatchResult]:
+        """複数のサブレディットを fetch → summarize → post のパイプラインで処理する
 
-        try:
-            data = json.loads(response.text)
-            return RedditSummary(**data), self.model
-        except:
-            # JSONパースに失敗した場合のフォールバック
-            return self._parse_text_response(response.text), self.model
+        各ジョブは独立したスレッドで進行し、ステージごとの同時実行数を
+        BATCH_FETCH_CONCURRENCY / BATCH_SUMMARIZE_CONCURRENCY / BATCH_POST_CONCURRENCY
+        で制限する。あるジョブが LLM を待っている間に別のジョブの取得が進む。
+        1 つのジョブが失敗しても他のジョブは継続する。
 
-    def _parse_text_response(self, content: str) -> RedditSummary:
-        """テキストレスポンスをRedditSummaryにパース"""
-        digest = ["要約を生成中...", "要約を生成中...", "要約を生成中..."]
-        details = content
-        return RedditSummary(digest=digest, details=details)
+        AI_BATCH_API が有効な場合は submit_summary_batch で要約をバッチ API に登録する。
 
+        Args:
+            jobs: 処理するジョブのリスト
 
-class GeminiChatClient(AIClient):
-    """Google Gemini API クライアント"""
+        Returns:
+            ジョブと同じ順序の実行結果リスト
+        """
+        if not jobs:
+            return []
+        if self.batch_api:
+            return self.submit_summary_batch(jobs)
 
-    def __init__(self):
-        """Gemini API クライアントの初期化"""
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.model = genai.GenerativeModel(os.getenv("AI_MODEL"))
-        self.model_name = os.getenv("AI_MODEL")
+        slots = {
+            "fetch": threading.Semaphore(int(os.getenv("BATCH_FETCH_CONCURRENCY", "2"))),
+            "summarize": threading.Semaphore(int(os.getenv("BATCH_SUMMARIZE_CONCURRENCY", "2"))),
+            "post": threading.Semaphore(int(os.getenv("BATCH_POST_CONCURRENCY", "1"))),
+        }
 
-    def summarize_text(self, subreddit: str, text: str) -> Tuple[RedditSummary, str]:
-        """Gemini API を使用してテキストを要約する
+        def run_job(job: BatchJob) -> BatchResult:
+            try:
+                with self.instrument(job.subreddit) as metrics:
+                    posted = self.process(job.subreddit, job.limit, job.channel, slots)
+                    if not posted:
+                        metrics.finish(False, "Slack への通知に失敗しました。")
+                if not posted:
+                    return BatchResult(
+                        subreddit=job.subreddit, ok=False, error="Slack への通知に失敗しました。"
+                    )
+                return BatchResult(subreddit=job.subreddit, ok=True)
+            except Exception as e:
+                print(f"r/{job.subreddit} の処理中にエラーが発生しました: {str(e)}")
+                return BatchResult(subreddit=job.subreddit, ok=False, error=str(e))
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            return list(executor.map(run_job, jobs))
+
+    def submit_summary_batch(self, jobs: List[BatchJob]) -> List[BatchResult]:
+        """全ジョブの投稿を取得し、要約リクエストを 1 つのバッチとしてバッチ API に登録する
+
+        取得は BATCH_FETCH_CONCURRENCY 件まで並列に行う。結果を回収していないバッチに
+        同じサブレディットのリクエストが残っている場合、そのジョブは登録しない。
+        登録内容は SummaryBatchStore に保存し、poll_summary_batches で結果を投稿する。
+        登録だけでは実行として計測せず、1 回の実行は結果を投稿する
+        poll_summary_batches で記録する。
 
         Args:
-            subreddit: サブレディット名
-            text: 要約するテキスト
+            jobs: 処理するジョブのリスト
 
         Returns:
-            (RedditSummary, モデル名)のタプル
+            ジョブと同じ順序の実行結果リスト (ok はバッチへの登録に成功したかどうか)
         """
-        import json
+        waiting = {item.subreddit.lower() for item in self.batch_store.pending_items()}
+        fetch_slot = threading.Semaphore(int(os.getenv("BATCH_FETCH_CONCURRENCY", "2")))
+        submitted_at = int(time.time())
 
-        messages = self.build_common_messages(subreddit, text)
-        # JSONレスポンスを要求するプロンプトを追加
-        prompt_with_json = " ".join([msg["content"] for msg in messages])
-        prompt_with_json += "\n\nJSON形式で返答してください: {\"digest\": [「要点1」, 「要点2」, 「要点3」], \"details\": \"詳細内容\"}"
+        def collect(index: int, job: BatchJob) -> Tuple[Optional[SummaryBatchItem], str]:
+            if job.subreddit.lower() in waiting:
+                print(f"r/{job.subreddit}: 結果待ちのバッチがあるため、登録をスキップします")
+                return None, ""
+            with fetch_slot:
+                text, posts = self.fetch(job.subreddit, job.limit)
+            if not posts:
+                print(f"r/{job.subreddit}: 要約済みでない投稿がないため、登録をスキップします")
+                return None, ""
+            custom_id = f"{job.subreddit}-{submitted_at}-{index}"
+            return SummaryBatchItem.from_posts(custom_id, job.subreddit, job.channel, posts), text
 
-        response = self.model.generate_content(prompt_with_json)
+        results = [BatchResult(subreddit=job.subreddit, ok=True) for job in jobs]
+        collected: List[Tuple[int, SummaryBatchItem, str]] = []
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(collect, index, job) for index, job in enumerate(jobs)]
+            for index, future in enumerate(futures):
+                try:
+                    item, text = future.result()
+                except Exception as e:
+                    print(f"r/{jobs[index].subreddit} の処理中にエラーが発生しました: {str(e)}")
+                    results[index] = BatchResult(subreddit=jobs[index].subreddit, ok=False, error=str(e))
+                    self.reddit_client.release_seen(jobs[index].subreddit)
+                    continue
+                if item is not None:
+                    collected.append((index, item, text))
 
+        if not collected:
+            return results
         try:
-            # JSON部分を抽出してパース
-            text = response.text
-            # JSONブロックを探す
-            if '{' in text and '}' in text:
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                json_str = text[start:end]
-                data = json.loads(json_str)
-                return RedditSummary(**data), self.model_name
-        except:
-            pass
+            batch_id = self.batch_client.submit_summary_batch(
+                {item.custom_id: (item.subreddit, text) for _, item, text in collected}
+            )
+        except Exception as e:
+            print(f"バッチの登録中にエラーが発生しました: {str(e)}")
+            for index, item, _ in collected:
+                results[index] = BatchResult(subreddit=item.subreddit, ok=False, error=str(e))
+                self.reddit_client.release_seen(item.subreddit, item.reddit_posts())
+            return results
 
-        # JSONパースに失敗した場合のフォールバック
-        return self._parse_text_response(response.text), self.model_name
+        self.batch_store.add(
+            batch_id,
+            self.batch_client.engine,
+            self.batch_client.model_name,
+            [item for _, item, _ in collected],
+        )
+        print(f"バッチ {batch_id} に {len(collected)} 件の要約リクエストを登録しました")
+        return results
 
-    def _parse_text_response(self, content: str) -> RedditSummary:
-        """テキストレスポンスをRedditSummaryにパース"""
-        digest = ["要約を生成中...", "要約を生成中...", "要約を生成中..."]
-        details = content
-        return RedditSummary(digest=digest, details=details)
+    def poll_summary_batches(self) -> List[BatchResult]:
+        """結果を回収していないバッチの状態を確認し、終了したものを Slack に投稿する
 
+        投稿に成功したサブレディットの投稿は要約済みとして記録する。
+        応答が失敗したリクエストは再送せず、失敗として記録する。
 
-class SlackNotifier:
-    """Slack 通知クライアント"""
+        Returns:
+            今回投稿 (または失敗) したリクエストの実行結果リスト
+        """
+        results = []
+        for batch_id, model_name in self.batch_store.pending_batches():
+            status, outputs = self.batch_client.retrieve_summary_batch(batch_id)
+            if outputs is None:
+                print(f"バッチ {batch_id}: {status}")
+                continue
 
-    def __init__(self):
-        """Slack API クライアントの初期化"""
-        self.token = os.getenv("SLACK_BOT_TOKEN")
-        self.channel = os.getenv("SLACK_CHANNEL")
-        self.url = "https://slack.com/api/chat.postMessage"
+            for item in self.batch_store.pending_items(batch_id):
+                error = None
+                try:
+                    with self.instrument(item.subreddit) as metrics:
+                        output = outputs.get(item.custom_id)
+                        if output is None:
+                            error = f"バッチの応答がありません ({status})"
+                        else:
+                            with metric_stage("parse"):
+                                summary_response = self.batch_client.parse_batch_result(
+                                    item.subreddit, output
+                                )
+                            if self.post(item.subreddit, summary_response, model_name, item.channel):
+                                self.reddit_client.mark_seen(item.subreddit, item.reddit_posts())
+                            else:
+                                error = "Slack への通知に失敗しました。"
+                        if error:
+                            metrics.finish(False, error)
+                            print(f"r/{item.subreddit}: {error}")
+                except Exception as e:
+                    print(f"r/{item.subreddit} の処理中にエラーが発生しました: {str(e)}")
+                    error = str(e)
 
-    def send_message(self, text: str, thread_ts: Optional[str] = None) -> Optional[str]:
-        """Slack にメッセージを送信する
+                if error:
+                    self.reddit_client.release_seen(item.subreddit, item.reddit_posts())
+                self.batch_store.set_item_state(item.custom_id, "failed" if error else "posted", error)
+                results.append(BatchResult(subreddit=item.subreddit, ok=error is None, error=error))
+            self.batch_store.finish_batch(batch_id, status)
+            print(f"バッチ {batch_id}: {status}")
+        return results
 
-        Args:
-            text: 送信するテキスト
-            thread_ts: スレッド ID (オプション)
 
-        Returns:
-            送信成功時はメッセージ ID、失敗時は None
-        """
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "channel": self.channel,
-            "text": text,
-        }
+def parse_batch_jobs(args: List[str], limit: int) -> List[BatchJob]:
+    """コマンドライン引数 "subreddit[:channel]" をバッチジョブに変換する
 
-        if thread_ts:
-            payload["thread_ts"] = thread_ts
+    Args:
+        args: "subreddit" または "subreddit:#channel" 形式の文字列リスト
+        limit: 各ジョブで取得する投稿数
 
-        response = requests.post(self.url, headers=headers, json=payload)
+    Returns:
+        BatchJob のリスト
+    """
+    jobs = []
+    for arg in args:
+        subreddit, _, channel = arg.partition(":")
+        jobs.append(BatchJob(subreddit=subreddit, channel=channel or None, limit=limit))
+    return jobs
 
-        if response.status_code == 200 and response.json().get("ok"):
-            return response.json().get("ts")
-        else:
-            print(f"エラーが発生しました: {response.status_code}: {response.text}")
+
+class ScheduleSlot(BaseModel):
+    """REPORT_TIME_<名前>_UTC / SUBREDDITS_<名前> / SLACK_CHANNEL_<名前> で定義される投稿時間帯"""
+    name: str
+    hour: int = Field(ge=0, le=23)
+    minute: int = Field(default=0, ge=0, le=59)
+    # 月曜から日曜までのサブレディット (足りない曜日は投稿しない)
+    subreddits: List[str] = []
+    channel: Optional[str] = None
+
+    def job_for(self, when: datetime, limit: int) -> Optional[BatchJob]:
+        """指定日時 (UTC) の曜日に対応するジョブを返す (サブレディットが未設定なら None)"""
+        index = when.isoweekday() - 1
+        if index >= len(self.subreddits) or not self.subreddits[index]:
             return None
+        return BatchJob(subreddit=self.subreddits[index], channel=self.channel, limit=limit)
 
 
-def create_ai_client(ai_engine: str) -> AIClient:
-    """AI エンジン名に基づいて適切な AI クライアントを作成する
+def load_schedule() -> List[ScheduleSlot]:
+    """環境変数から投稿時間帯の一覧を読み込む
 
-    Args:
-        ai_engine: AI エンジン名 ("openai", "cohere", "gemini")
+    REPORT_TIME_<名前>_UTC に時刻 ("9" または "9:30") が設定された時間帯のみを対象とし、
+    送信先は SLACK_CHANNEL_<名前>、未設定の場合は SLACK_CHANNEL_DEFAULT とする。
+    SUBREDDITS_<名前> はワークフローと同じく連続する空白をまとめて区切る。
 
     Returns:
-        AIClient インスタンス
+        ScheduleSlot のリスト
 
     Raises:
-        ValueError: サポートされていない AI エンジンが指定された場合
+        ValueError: 時刻の形式が正しくない、または範囲外 (24 時以降など) の場合
     """
-    if ai_engine == "openai":
-        return OpenAIChatClient()
-    elif ai_engine == "cohere":
-        return CohereChatClient()
-    elif ai_engine == "gemini":
-        return GeminiChatClient()
-    else:
-        raise ValueError(f"サポートされていない AI エンジン: {ai_engine}")
+    slots = []
+    for key in sorted(os.environ):
+        match = re.fullmatch(r"REPORT_TIME_(\w+)_UTC", key)
+        if match is None or not os.environ[key].strip():
+            continue
+        name = match.group(1)
+        hour, _, minute = os.environ[key].strip().partition(":")
+        try:
+            slots.append(ScheduleSlot(
+                name=name,
+                hour=int(hour),
+                minute=int(minute or "0"),
+                subreddits=os.getenv(f"SUBREDDITS_{name}", "").split(),
+                channel=os.getenv(f"SLACK_CHANNEL_{name}") or os.getenv("SLACK_CHANNEL_DEFAULT") or None,
+            ))
+        except ValueError as e:
+            raise ValueError(f"{key} の時刻が正しくありません: {os.environ[key]}") from e
+    return slots
 
 
-class Application:
-    """メインアプリケーションクラス"""
+class Scheduler:
+    """常駐して投稿時間帯ごとにジョブを実行するスケジューラー
+
+    Application (Reddit / AI / Slack のクライアントと接続) を保持したまま待機し、
+    時間帯の時刻になると曜日に対応するサブレディットを run_batch で処理する。
+    AI_BATCH_API が有効な場合は、待機中も AI_BATCH_POLL_INTERVAL 秒ごとに
+    登録済みのバッチを確認し、終了したものを投稿する。
+    SIGHUP で .env と環境変数から設定を再読み込みし、SIGTERM / SIGINT では
+    実行中のジョブの完了を待ってから終了する。
+    """
 
     def __init__(self):
-        """アプリケーションの初期化"""
-        ai_engine = os.getenv("AI_ENGINE", "openai")
-        self.ai_client = create_ai_client(ai_engine)
-        self.reddit_client = RedditClient()
-        self.slack_notifier = SlackNotifier()
+        """スケジューラーの初期化"""
+        self.app = Application()
+        self.slots = load_schedule()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._reload_requested = False
 
-    def run(self, subreddit_name: str, limit: int) -> None:
-        """アプリケーションを実行する
+    def reload(self) -> None:
+        """.env を再読み込みし、時間帯の設定と Application を作り直す
 
-        Args:
-            subreddit_name: サブレディット名
-            limit: 取得する投稿数
+        時間帯の設定が正しくない場合や Application の作成に失敗した場合は、
+        それまでの設定を使い続ける。作り直した場合は古い Application を閉じる。
         """
+        load_dotenv(override=True)
         try:
-            # Reddit からデータを取得
-            all_posts_text = self.reddit_client.get_hot_posts_with_comments(
-                subreddit_name, limit
-            )
+            self.slots = load_schedule()
+        except ValueError as e:
+            print(f"{str(e)} (それまでの時間帯を使い続けます)")
+        try:
+            app = Application()
+        except Exception as e:
+            print(f"設定の再読み込みで Application を作成できませんでした: {str(e)}")
+        else:
+            self.app, old_app = app, self.app
+            old_app.close()
+        print(f"設定を再読み込みしました: {self.describe()}")
 
-            # AI による要約 (structured output)
-            summary_response, model_name = self.ai_client.summarize_text(subreddit_name, all_posts_text)
+    def describe(self) -> str:
+        """ログ出力用の時間帯一覧を返す"""
+        return ", ".join(
+            f"{slot.name}={slot.hour:02d}:{slot.minute:02d} UTC" for slot in self.slots
+        ) or "時間帯なし"
 
-            # ダイジェストを整形
-            digest_formatted = "\n".join([f"• {line}" for line in summary_response.digest])
+    def next_run(self, after: datetime) -> Tuple[Optional[datetime], List[ScheduleSlot]]:
+        """after より後で最も早い実行時刻と、その時刻に実行する時間帯を返す"""
+        candidates: Dict[datetime, List[ScheduleSlot]] = {}
+        for slot in self.slots:
+            when = after.replace(hour=slot.hour, minute=slot.minute, second=0, microsecond=0)
+            if when <= after:
+                when += timedelta(days=1)
+            candidates.setdefault(when, []).append(slot)
+        if not candidates:
+            return None, []
+        when = min(candidates)
+        return when, candidates[when]
 
-            # Slack に通知
-            # 最初のメッセージにダイジェストを含める
-            first_message = f"📊 今週の r/{subreddit_name}\n\n{digest_formatted}"
-            thread_ts = self.slack_notifier.send_message(first_message)
-            if thread_ts:
-                # 詳細とモデル名を追加
-                details_with_model = f"{summary_response.details}\n\n使用モデル: {model_name}"
-                self.slack_notifier.send_message(details_with_model, thread_ts)
-            else:
-                print("Slack への通知に失敗しました。")
+    def _handle_signal(self, signum: int, frame: Any) -> None:
+        """シグナルを受けたら待機を中断する (処理は run_forever のループで行う)"""
+        if signum == getattr(signal, "SIGHUP", None):
+            self._reload_requested = True
+        else:
+            self._stopping = True
+        self._wakeup.set()
+
+    def run_once(self, when: datetime, slots: List[ScheduleSlot]) -> List[BatchResult]:
+        """指定時刻の時間帯のジョブをまとめて実行する"""
+        limit = int(os.getenv("SUBREDDIT_TOPICS_NUMBER") or "3")
+        jobs = [job for job in (slot.job_for(when, limit) for slot in slots) if job is not None]
+        if not jobs:
+            print(f"{when:%Y-%m-%d %H:%M} UTC: この曜日に投稿するサブレディットがないためスキップします")
+            return []
+        results = self.app.run_batch(jobs)
+        for result in results:
+            status = "OK" if result.ok else f"NG ({result.error})"
+            print(f"r/{result.subreddit}: {status}")
+        return results
 
+    def poll(self) -> None:
+        """登録済みのバッチを確認する (通信エラーなどは次回の確認で再試行する)"""
+        try:
+            self.app.poll_summary_batches()
         except Exception as e:
-            print(f"エラーが発生しました: {str(e)}")
-            sys.exit(1)
+            print(f"バッチの確認中にエラーが発生しました: {str(e)}")
+
+    def run_forever(self) -> None:
+        """SIGTERM / SIGINT を受けるまで、時間帯ごとにジョブを実行し続ける"""
+        for name in ("SIGTERM", "SIGINT", "SIGHUP"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self._handle_signal)
+
+        print(f"スケジューラーを開始しました: {self.describe()}")
+        last_checked = datetime.now(timezone.utc)
+        while not self._stopping:
+            # フラグを確認する前にクリアし、確認後に届いたシグナルで待機が中断されるようにする
+            self._wakeup.clear()
+            if self._reload_requested:
+                self._reload_requested = False
+                self.reload()
+
+            when, slots = self.next_run(last_checked)
+            timeout = None if when is None else (when - datetime.now(timezone.utc)).total_seconds()
+            poll_interval = float(os.getenv("AI_BATCH_POLL_INTERVAL", "60"))
+            if self.app.batch_api and self.app.batch_store.pending_batches() and (
+                timeout is None or timeout > poll_interval
+            ):
+                if not self._wakeup.wait(poll_interval):
+                    self.poll()
+                continue
+            if timeout is None or timeout > 0:
+                # シグナルで中断された場合は、停止・再読み込みを処理してから次の時刻を計算し直す
+                if self._wakeup.wait(timeout):
+                    continue
+
+            last_checked = when
+            grace = float(os.getenv("SCHEDULER_MISFIRE_GRACE", "600"))
+            if (datetime.now(timezone.utc) - when).total_seconds() > grace:
+                print(f"{when:%Y-%m-%d %H:%M} UTC の実行時刻を {grace:.0f} 秒以上過ぎたためスキップします")
+                continue
+            self.run_once(when, slots)
+
+        print("スケジューラーを停止しました")
 
 
 def main():
     """メイン関数"""
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == "--startup-probe":
+        engine = sys.argv[2]
+        if engine != "none":
+            create_ai_client(engine)
+        print(json.dumps(ENGINE_STARTUP_TIMES.get(engine, {})))
+    elif len(sys.argv) > 1 and sys.argv[1] == "--benchmark-startup":
+        engines = sys.argv[2:] or ["none", *ENGINE_REGISTRY]
+        for result in benchmark_startup(engines):
+            print(json.dumps(result, ensure_ascii=False))
+    elif len(sys.argv) > 1 and sys.argv[1] == "--batch-poll":
+        app = Application()
+        if not app.batch_api:
+            print("--batch-poll には AI_BATCH_API=true の設定が必要です")
+            sys.exit(1)
+        results = app.poll_summary_batches()
+        while "--wait" in sys.argv[2:] and app.batch_store.pending_batches():
+            time.sleep(float(os.getenv("AI_BATCH_POLL_INTERVAL", "60")))
+            results += app.poll_summary_batches()
+        for result in results:
+            status = "OK" if result.ok else f"NG ({result.error})"
+            print(f"r/{result.subreddit}: {status}")
+        if not all(result.ok for result in results):
+            sys.exit(1)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        Scheduler().run_forever()
+    elif len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        limit = int(os.getenv("SUBREDDIT_TOPICS_NUMBER") or "3")
+        jobs = parse_batch_jobs(sys.argv[2:], limit)
+
+        app = Application()
+        results = app.run_batch(jobs)
+        for result in results:
+            status = "OK" if result.ok else f"NG ({result.error})"
+            print(f"r/{result.subreddit}: {status}")
+        if not all(result.ok for result in results):
+            sys.exit(1)
+    elif len(sys.argv) > 1:
         subreddit_name = sys.argv[1]
         limit = int(sys.argv[2]) if len(sys.argv) > 2 else 3
 
@@ -520,6 +4886,10 @@ def main():
         app.run(subreddit_name, limit)
     else:
         print("使用法: python script.py <subreddit_name> [limit]")
+        print("       python script.py --batch <subreddit[:channel]> ...")
+        print("       python script.py --batch-poll [--wait]")
+        print("       python script.py --daemon")
+        print("       python script.py --benchmark-startup [engine ...]")
         sys.exit(1)
 
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py / benchmark.py はリポジトリ直下の単一ファイルのため、パッケージとしてではなくパスから import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
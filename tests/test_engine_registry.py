@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import main
+
+PLUGIN_SOURCE = textwrap.dedent(
+    """
+    from main import AIClient, RedditSummary, register_engine
+
+
+    @register_engine("echo")
+    class EchoClient(AIClient):
+        model_name = "echo-1"
+
+        def summarize_text(self, subreddit, text):
+            return RedditSummary(digest=["a", "b", "c"], details=text), self.model_name
+
+        def complete(self, messages, json_output=False):
+            return messages[-1]["content"]
+    """
+)
+
+
+@pytest.fixture
+def plugin_dir(tmp_path, monkeypatch):
+    (tmp_path / "echo_engine.py").write_text(PLUGIN_SOURCE, encoding="utf-8")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setenv("AI_ENGINE_PLUGINS", "echo_engine")
+    yield tmp_path
+    sys.modules.pop("echo_engine", None)
+    main.ENGINE_REGISTRY.pop("echo", None)
+
+
+def test_plugin_engine_is_registered_and_resolved(plugin_dir):
+    client = main.create_ai_client("echo")
+
+    assert type(client).__name__ == "EchoClient"
+    assert client.engine == "echo"
+    assert main.ENGINE_REGISTRY["echo"] is type(client)
+    summary, model_name = client.summarize_text("python", "本文")
+    assert summary.details == "本文"
+    assert model_name == "echo-1"
+
+
+def test_plugin_engine_resolves_when_run_as_script(plugin_dir):
+    # python main.py で実行した場合 (モジュール名が __main__) もプラグインの登録が見えること
+    env = {**os.environ, "PYTHONPATH": str(plugin_dir)}
+    completed = subprocess.run(
+        [sys.executable, main.__file__, "--startup-probe", "echo"],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=plugin_dir,
+    )
+
+    assert completed.returncode == 0, completed.stderr
+    assert "construct_seconds" in json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_unknown_engine_is_rejected(monkeypatch):
+    monkeypatch.delenv("AI_ENGINE_PLUGINS", raising=False)
+    with pytest.raises(ValueError):
+        main.create_ai_client("no-such-engine")
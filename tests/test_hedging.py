@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import main
+from main import AIClient, HedgedAIClient, RedditSummary, RoutingAIClient
+
+GOOD = '{"digest": ["a", "b", "c"], "details": "d"}'
+NO_DIGEST = '{"details": "d"}'
+
+
+class AsyncClient(AIClient):
+    engine = "fake"
+
+    def __init__(self, model_name, reply, delay=0.0):
+        self.model_name = model_name
+        self.reply = reply
+        self.delay = delay
+        self.completions = 0
+        self.cancelled = False
+
+    async def _asummarize_text(self, subreddit, text):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        self._report_usage(f"r/{subreddit}", 10, 10)
+        return self.parse_summary_text(self.reply), self.model_name
+
+    def summarize_text(self, subreddit, text):
+        return asyncio.run(self._asummarize_text(subreddit, text))
+
+    def complete(self, messages, json_output=False):
+        self.completions += 1
+        self._report_usage("complete", 10, 10)
+        return '{"digest": ["r1", "r2", "r3"]}'
+
+
+def test_missing_digest_hedges_before_spending_a_repair():
+    primary, secondary = AsyncClient("primary", NO_DIGEST), AsyncClient("secondary", GOOD)
+    summary, model_name = HedgedAIClient([primary, secondary], hedge_delay=5).summarize_text("t", "x")
+    assert (summary.digest, model_name) == (["a", "b", "c"], "secondary")
+    assert primary.completions == secondary.completions == 0
+
+
+def test_digest_is_repaired_once_when_every_result_lacks_it():
+    primary, secondary = AsyncClient("primary", NO_DIGEST), AsyncClient("secondary", NO_DIGEST)
+    summary, model_name = HedgedAIClient([primary, secondary], hedge_delay=5).summarize_text("t", "x")
+    assert summary == RedditSummary(digest=["r1", "r2", "r3"], details="d")
+    assert model_name == "primary"
+    assert primary.completions + secondary.completions == 1
+
+
+def test_slow_routed_primary_is_cancelled_when_the_secondary_wins():
+    slow = AsyncClient("slow", GOOD, delay=5)
+    router = RoutingAIClient([(None, slow)], log_path="")
+    hedged = HedgedAIClient([router, AsyncClient("secondary", GOOD)], hedge_delay=0.05)
+    _, model_name = hedged.summarize_text("t", "x")
+    assert model_name == "secondary"
+    for _ in range(50):
+        if slow.cancelled:
+            break
+        time.sleep(0.01)
+    assert slow.cancelled
+
+
+def test_failover_records_the_model_that_answered():
+    class Failing(AsyncClient):
+        def complete(self, messages, json_output=False):
+            raise RuntimeError("down")
+
+    hedged = HedgedAIClient([Failing("primary", GOOD), AsyncClient("secondary", GOOD)], hedge_delay=5)
+    with main.collect_models() as models:
+        hedged.complete([{"role": "user", "content": "x"}])
+    assert main.models_label(models) == "secondary"
+
+
+def test_close_stops_the_hedge_loop_thread():
+    hedged = HedgedAIClient([AsyncClient("primary", GOOD), AsyncClient("secondary", GOOD)], hedge_delay=5)
+    hedged.summarize_text("t", "x")
+    thread = hedged._loop_thread
+    assert thread.is_alive()
+    hedged.close()
+    assert not thread.is_alive()
+    hedged.close()
@@ -0,0 +1,93 @@
+import pytest
+
+from main import PromptInputBuilder, RedditComment, RedditPost
+
+
+def make_comments(prefix, count, chars=200, score=100):
+    return [
+        RedditComment(f"{prefix}-{n}", f"user{n}", f"{prefix} のコメント {n} " + "あ" * chars, score - n, 0.0)
+        for n in range(count)
+    ]
+
+
+def make_post(post_id, comments, selftext=""):
+    return RedditPost(
+        post_id, f"投稿 {post_id}", f"https://example.com/{post_id}", 0.0, 10, len(comments), selftext, comments
+    )
+
+
+def builder(token_budget):
+    return PromptInputBuilder(engine="openai", model="gpt-4", token_budget=token_budget)
+
+
+@pytest.mark.parametrize("token_budget", [300, 2000, 8000])
+def test_estimated_total_stays_within_the_budget(token_budget):
+    posts = [
+        make_post("huge", make_comments("huge", 200), selftext="本文" * 3000),
+        make_post("small1", make_comments("small1", 5)),
+        make_post("small2", make_comments("small2", 5)),
+    ]
+    text, report = builder(token_budget).build(posts)
+    assert report.tokens_used == builder(token_budget).estimate_tokens(text)
+    assert report.tokens_used <= token_budget
+
+
+def test_a_huge_thread_does_not_starve_small_ones():
+    small_posts = [make_post(f"small{n}", make_comments(f"small{n}", 5)) for n in range(3)]
+    posts = [make_post("huge", make_comments("huge", 300), selftext="本文" * 5000), *small_posts]
+    text, report = builder(6000).build(posts)
+
+    # 小さいスレッドは需要が予算の公平な割り当てより小さいため、全てのコメントが残る
+    for post in small_posts:
+        assert all(comment.body in text for comment in post.comments)
+    huge_part = text.split("タイトル: 投稿 small0", 1)[0]
+    assert builder(6000).estimate_tokens(huge_part) < 6000 * 0.75
+    assert report.dropped_budget > 0
+    assert report.truncated_bodies == 1
+
+
+def test_deleted_duplicate_and_bot_comments_are_dropped():
+    comments = [
+        RedditComment("c1", "alice", "Great article", 50, 0.0),
+        RedditComment("c2", "bob", "[deleted]", 40, 0.0),
+        RedditComment("c3", "carol", " [removed] ", 30, 0.0),
+        RedditComment("c4", "dave", "  great   ARTICLE ", 20, 0.0),
+        RedditComment("c5", "AutoModerator", "ルールを確認してください", 10, 0.0),
+        RedditComment("c6", "remind_bot", "リマインドします", 5, 0.0),
+        RedditComment("c7", "mod", "固定のお知らせ", 4, 0.0, distinguished="moderator"),
+        RedditComment("c8", "robot_fan", "ボットではないユーザーです", 3, 0.0),
+    ]
+    other_post = [RedditComment("d1", "erin", "Great article", 100, 0.0)]
+    text, report = builder(8000).build([make_post("p1", comments), make_post("p2", other_post)])
+
+    assert text.lower().count("great article") == 1
+    assert "ARTICLE" not in text
+    for dropped in ("[deleted]", "[removed]", "ルールを確認", "リマインド", "固定のお知らせ"):
+        assert dropped not in text
+    assert "ボットではないユーザーです" in text
+    assert (report.dropped_deleted, report.dropped_duplicate, report.dropped_bot) == (2, 2, 3)
+
+
+def test_report_counts_match_what_was_kept_and_dropped():
+    comments = make_comments("p1", 50) + [
+        RedditComment("x1", "bob", "[deleted]", 0, 0.0),
+        RedditComment("x2", "AutoModerator", "お知らせ", 0, 0.0),
+    ]
+    posts = [make_post("p1", comments), make_post("p2", make_comments("p2", 50))]
+    text, report = builder(3000).build(posts)
+
+    kept = sum(1 for post in posts for comment in post.comments if comment.body in text)
+    assert report.posts == 2
+    assert report.comments_kept == kept
+    assert report.comments_kept + report.comments_dropped == sum(len(post.comments) for post in posts)
+    assert report.dropped_budget > 0
+
+
+def test_posts_whose_headers_do_not_fit_are_dropped_with_their_comments():
+    posts = [make_post(f"p{n}", make_comments(f"p{n}", 3)) for n in range(5)]
+    text, report = builder(100).build(posts)
+
+    assert report.dropped_posts > 0
+    assert text.count("タイトル: ") == report.posts - report.dropped_posts
+    assert report.comments_kept + report.comments_dropped == 15
+    assert report.tokens_used <= 100
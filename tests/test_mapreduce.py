@@ -0,0 +1,103 @@
+import json
+import threading
+
+import pytest
+
+from main import AIClient, Application, PromptInputBuilder, RedditComment, RedditPost, SummaryRenderer
+
+
+class TopicClient(AIClient):
+    engine = "openai"
+
+    def __init__(self, reduce_reply):
+        self.model_name = "topic-model"
+        self.reduce_reply = reduce_reply
+        self.topic_inputs = []
+        self.reduce_inputs = []
+        self._lock = threading.Lock()
+
+    def summarize_text(self, subreddit, text):
+        raise NotImplementedError
+
+    def summarize_topic(self, subreddit, post_text):
+        with self._lock:
+            self.topic_inputs.append(post_text)
+        self._report_usage(f"r/{subreddit}", 10, 10)
+        title = post_text.split("タイトル: ", 1)[1].split("\n", 1)[0]
+        return f"タイトル: 「{title}」\n【ずんだもん】{title} の話なのだ" + "。" * 1000
+
+    def complete(self, messages, json_output=False):
+        self.reduce_inputs.append(messages)
+        self._report_usage("reduce", 10, 10)
+        return self.reduce_reply
+
+
+class OutOfOrderReddit:
+    """コメントの取得が投稿順とは逆に完了する RedditClient"""
+
+    def __init__(self, posts):
+        self.posts = posts
+
+    def iter_posts(self, subreddit_name, limit):
+        yield from reversed(list(enumerate(self.posts[:limit])))
+
+
+def make_post(index):
+    comments = [
+        RedditComment(f"c{index}-{n}", f"user{n}", f"コメント {n} " + "あ" * 300, 100 - n, 0.0)
+        for n in range(40)
+    ]
+    return RedditPost(f"p{index}", f"投稿{index}", f"https://example.com/{index}", 0.0, 10, 40, "本文" * 500, comments)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("MAPREDUCE_POST_TOKEN_BUDGET", "1500")
+    monkeypatch.setenv("MAPREDUCE_EXCERPT_CHARS", "200")
+    monkeypatch.setenv("AI_ENGINE", "openai")
+    monkeypatch.delenv("AI_MODEL", raising=False)
+    application = Application.__new__(Application)
+    application.ai_client = TopicClient(
+        json.dumps({"digest": ["一", "二", "三"], "closing": "ずんだもん: おしまいなのだ"}, ensure_ascii=False)
+    )
+    application.reddit_client = OutOfOrderReddit([make_post(index) for index in range(4)])
+    return application
+
+
+def test_each_post_is_mapped_alone_within_its_token_budget(app):
+    app.summarize_mapreduce("python", 4)
+    estimator = PromptInputBuilder(engine="openai")
+    assert len(app.ai_client.topic_inputs) == 4
+    for post_text in app.ai_client.topic_inputs:
+        assert post_text.count("タイトル: ") == 1
+        assert estimator.estimate_tokens(post_text) <= 1500
+
+
+def test_topics_keep_post_order_and_reduce_sees_only_excerpts(app):
+    summary, model_name, posts = app.summarize_mapreduce("python", 4)
+
+    assert [post.id for post in posts] == ["p0", "p1", "p2", "p3"]
+    positions = [summary.details.index(f"タイトル: 「投稿{index}」") for index in range(4)]
+    assert positions == sorted(positions)
+
+    [messages] = app.ai_client.reduce_inputs
+    excerpts = messages[-1]["content"].split("\n---\n")
+    assert len(excerpts) == 4
+    assert all(len(excerpt) <= 200 for excerpt in excerpts)
+
+    assert summary.digest == ["一", "二", "三"]
+    assert summary.details.startswith(SummaryRenderer.speaker_tag("めたん"))
+    assert summary.details.endswith(SummaryRenderer.speaker_tag("ずんだもん") + "おしまいなのだ")
+    assert model_name == "topic-model"
+
+
+def test_no_posts_returns_nothing(app):
+    app.reddit_client = OutOfOrderReddit([])
+    assert app.summarize_mapreduce("python", 4) == (None, "topic-model", [])
+
+
+def test_reduce_repairs_a_short_digest(app):
+    replies = iter(['{"digest": ["一"], "closing": "またね"}', '{"digest": ["a", "b", "c"]}'])
+    app.ai_client.complete = lambda messages, json_output=False: next(replies)
+    summary = app.ai_client.reduce_topics("python", ["タイトル: 「x」\n【めたん】x"])
+    assert summary.digest == ["a", "b", "c"]
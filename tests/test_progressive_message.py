@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from main import AIClient, Application, ProgressiveMessage
+
+
+class FakeNotifier:
+    """10 文字ごとに分割し、スレッドの返信を ts ごとに保持する SlackNotifier の代わり"""
+
+    channel = "#general"
+
+    def __init__(self):
+        self.replies = {}
+        self.fail_updates = False
+        self.fail_deletes = False
+
+    def split_message(self, text):
+        return [text[start:start + 10] for start in range(0, len(text), 10)] or [""]
+
+    def send_message(self, text, thread_ts=None, channel=None):
+        ts = f"ts{len(self.replies) + 1}"
+        self.replies[ts] = text
+        return ts
+
+    def update_message(self, ts, text, channel=None):
+        if self.fail_updates:
+            return False
+        self.replies[ts] = text
+        return True
+
+    def delete_message(self, ts, channel=None):
+        if self.fail_deletes:
+            return False
+        del self.replies[ts]
+        return True
+
+
+@pytest.fixture
+def notifier():
+    return FakeNotifier()
+
+
+def test_final_update_deletes_replies_beyond_the_final_text(notifier):
+    progress = ProgressiveMessage(notifier, "thread", min_interval=0)
+    assert progress.update("あ" * 35)
+    assert len(notifier.replies) == 4
+
+    assert progress.update("い" * 12, force=True)
+
+    assert notifier.replies == {"ts1": "い" * 10, "ts2": "いい"}
+    assert progress.message_ts == ["ts1", "ts2"]
+    assert not any("▌" in text for text in notifier.replies.values())
+
+
+def test_final_update_reports_replies_it_could_not_delete(notifier):
+    progress = ProgressiveMessage(notifier, "thread", min_interval=0)
+    progress.update("あ" * 35)
+    notifier.fail_deletes = True
+
+    assert not progress.update("い" * 12, force=True)
+
+
+def test_final_update_reports_a_failed_write(notifier):
+    progress = ProgressiveMessage(notifier, "thread", min_interval=0)
+    progress.update("あ" * 5)
+    notifier.fail_updates = True
+
+    assert not progress.update("い" * 5, force=True)
+
+
+class StreamingClient(AIClient):
+    engine = "fake"
+    model_name = "fake-1"
+
+    def summarize_text(self, subreddit, text):
+        raise NotImplementedError
+
+    def complete(self, messages, json_output=False):
+        raise NotImplementedError
+
+    def stream_summary(self, subreddit, text):
+        summary = {"digest": ["一", "二", "三"], "details": "【めたん】" + "会話" * 20}
+        reply = json.dumps(summary, ensure_ascii=False)
+        for start in range(0, len(reply), 8):
+            yield reply[start:start + 8]
+
+
+def test_streaming_returns_false_when_the_final_update_fails(notifier, monkeypatch):
+    monkeypatch.setenv("SLACK_UPDATE_INTERVAL", "0")
+    monkeypatch.delenv("SLACK_EMOJI_NAMES", raising=False)
+    app = Application.__new__(Application)
+    app.ai_client = StreamingClient()
+    app.slack_notifier = notifier
+    app.emoji_channels = set()
+    app.archive_dir = None
+
+    assert app.summarize_and_post_streaming("python", "本文")
+
+    notifier.fail_updates = True
+    assert not app.summarize_and_post_streaming("python", "本文")
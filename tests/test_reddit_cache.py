@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+from main import RedditCache, RedditClient, RedditComment, RedditPost
+
+
+def make_post(post_id="p1", num_comments=2, comments=()):
+    url = f"https://example.com/{post_id}"
+    return RedditPost(post_id, "タイトル", url, 0.0, 10, num_comments, "", list(comments))
+
+
+def make_cache(tmp_path, **ttls):
+    options = {"listing_ttl": 900, "comments_ttl": 3600, "max_age": 86400, **ttls}
+    return RedditCache(path=str(tmp_path / "reddit.sqlite3"), **options)
+
+
+def expire_comments(cache, seconds):
+    with cache._conn:
+        cache._conn.execute("UPDATE posts SET comments_fetched_at = ?", (time.time() - seconds,))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return make_cache(tmp_path)
+
+
+def test_comments_are_merged_across_refreshes(cache):
+    first = make_post(comments=[
+        RedditComment("c1", "alice", "最初のコメント", 5, 100.0),
+        RedditComment("c2", "bob", "二番目のコメント", 3, 200.0),
+    ])
+    cache.upsert_post(first)
+    assert cache.merge_comments(first) == 2
+
+    # 再取得ではスコアと本文の変化を反映し、新しいコメントだけを追加として数える
+    refreshed = make_post(num_comments=3, comments=[
+        RedditComment("c1", "alice", "[deleted]", 9, 100.0),
+        RedditComment("c3", "carol", "新しいコメント", 1, 300.0),
+    ])
+    cache.upsert_post(refreshed)
+    assert cache.merge_comments(refreshed) == 1
+
+    post = cache.get_post("p1")
+    assert post.num_comments == 3
+    assert [(c.id, c.body, c.score) for c in post.comments] == [
+        ("c1", "[deleted]", 9),
+        ("c2", "二番目のコメント", 3),
+        ("c3", "新しいコメント", 1),
+    ]
+    assert cache.last_comment_utc("p1") == 300.0
+
+
+def test_comments_fresh_checks_the_comment_count_once_the_ttl_expires(cache):
+    assert not cache.comments_fresh("p1", 2)
+    post = make_post(num_comments=2)
+    cache.upsert_post(post)
+    cache.merge_comments(post)
+
+    assert cache.comments_fresh("p1", 2)
+    assert cache.comments_fresh("p1", 5)
+
+    expire_comments(cache, 7200)
+    assert cache.comments_fresh("p1", 2)
+    assert not cache.comments_fresh("p1", 5)
+
+    expire_comments(cache, 90000)
+    assert not cache.comments_fresh("p1", 2)
+
+
+def test_zero_ttls_disable_the_cache(tmp_path):
+    cache = make_cache(tmp_path, listing_ttl=0, comments_ttl=0)
+    cache.put_listing("python", "week", ["p1"], 1)
+    post = make_post(num_comments=2)
+    cache.upsert_post(post)
+    cache.merge_comments(post)
+
+    assert cache.get_listing("python", "week", 1) is None
+    assert not cache.comments_fresh("p1", 2)
+
+
+def test_short_listings_are_reused_only_when_more_posts_were_requested(cache):
+    cache.put_listing("Tiny", "week", ["p1", "p2"], 8)
+    assert cache.get_listing("tiny", "week", 8) == ["p1", "p2"]
+    assert cache.get_listing("tiny", "week", 1) == ["p1"]
+
+    cache.put_listing("tiny", "week", ["p1", "p2"], 2)
+    assert cache.get_listing("tiny", "week", 8) is None
+    assert cache.get_listing("tiny", "week", 2) == ["p1", "p2"]
+
+
+class CountingFetcher:
+    """投稿一覧とコメントの取得回数を数える RedditJSONFetcher の代わり"""
+
+    limits = {"remaining": None, "reset_timestamp": None, "used": None}
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.listing_calls = 0
+        self.comment_calls = 0
+
+    def listing(self, subreddit_name, limit, time_filter):
+        self.listing_calls += 1
+        return self.posts[:limit]
+
+    def comments(self, post_id):
+        self.comment_calls += 1
+        return [RedditComment(f"{post_id}-c", "user", "コメント", 1, 100.0)]
+
+
+def test_small_subreddit_is_served_from_the_cache_on_the_next_run(tmp_path, monkeypatch):
+    monkeypatch.setenv("REDDIT_FETCHER", "raw")
+    monkeypatch.setenv("REDDIT_CACHE_ENABLED", "true")
+    monkeypatch.setenv("REDDIT_CACHE_PATH", str(tmp_path / "reddit.sqlite3"))
+    monkeypatch.setenv("SEEN_INDEX_ENABLED", "false")
+    client = RedditClient()
+    # 期間内の投稿が要求数 (3 件) より少ないサブレディット
+    client.raw = fetcher = CountingFetcher([make_post("p1", 1), make_post("p2", 1)])
+
+    first = client.fetch_posts("tiny", 3)
+    second = client.fetch_posts("tiny", 3)
+
+    assert [post.id for post in first] == [post.id for post in second] == ["p1", "p2"]
+    assert [len(post.comments) for post in second] == [1, 1]
+    assert (fetcher.listing_calls, fetcher.comment_calls) == (1, 2)
@@ -0,0 +1,81 @@
+import pytest
+
+from main import RedditSummary, SummaryRenderer
+
+DETAILS = "\n".join(
+    [
+        "【めたん】今週の r/python を紹介していくわ。",
+        "---",
+        "タイトル: 「Python 3.13 リリース」",
+        "URL: https://example.com/py313?a=1&b=2",
+        "【ずんだもん】速くなったのだ <b>すごい</b>",
+        "四国めたん: フルネームでも読めるわね",
+        "【東北きりたん】表記ゆれも揃えます",
+        "---",
+        "【ずんだもん】おしまいなのだ",
+    ]
+)
+
+
+def test_plain_replaces_tags_with_names():
+    rendered = SummaryRenderer("plain").render_details(DETAILS)
+    assert rendered.splitlines() == [
+        "めたん: 今週の r/python を紹介していくわ。",
+        "---",
+        "タイトル: 「Python 3.13 リリース」",
+        "URL: https://example.com/py313?a=1&b=2",
+        "ずんだもん: 速くなったのだ <b>すごい</b>",
+        "めたん: フルネームでも読めるわね",
+        "きりたん: 表記ゆれも揃えます",
+        "---",
+        "ずんだもん: おしまいなのだ",
+    ]
+
+
+def test_slack_emoji_uses_emoji_and_keeps_unknown_speakers_readable():
+    renderer = SummaryRenderer("slack_emoji")
+    rendered = renderer.render_details(DETAILS + "\n【ナレーター】以上です")
+    assert ":zundamon: 速くなったのだ <b>すごい</b>" in rendered
+    assert ":shikoku-metan: フルネームでも読めるわね" in rendered
+    assert ":tohoku-kiritan: 表記ゆれも揃えます" in rendered
+    assert rendered.endswith("ナレーター: 以上です")
+
+
+def test_markdown_uses_headings_links_and_paragraphs():
+    rendered = SummaryRenderer("markdown").render_details(DETAILS)
+    paragraphs = rendered.split("\n\n")
+    assert "### Python 3.13 リリース" in paragraphs
+    assert "<https://example.com/py313?a=1&b=2>" in paragraphs
+    assert "**ずんだもん**: おしまいなのだ" in paragraphs
+    assert all(paragraph.strip() for paragraph in paragraphs)
+
+
+def test_html_escapes_model_output():
+    rendered = SummaryRenderer("html").render_details(DETAILS)
+    assert "<p><strong>ずんだもん</strong>: 速くなったのだ &lt;b&gt;すごい&lt;/b&gt;</p>" in rendered
+    assert '<a href="https://example.com/py313?a=1&amp;b=2">' in rendered
+    assert "<h3>Python 3.13 リリース</h3>" in rendered
+    assert rendered.count("<hr>") == 2
+    assert "<b>" not in rendered
+
+
+@pytest.mark.parametrize("output_format", SummaryRenderer.FORMATS)
+def test_partial_tag_at_the_end_of_a_stream_is_hidden(output_format):
+    renderer = SummaryRenderer(output_format)
+    complete = renderer.render_details("【ずんだもん】こんにちはなのだ")
+    assert renderer.render_details("【ずんだもん】こんにちはなのだ\n【めた") == complete
+
+
+@pytest.mark.parametrize("output_format", SummaryRenderer.FORMATS)
+def test_render_document_includes_digest_details_and_model(output_format):
+    summary = RedditSummary(digest=["要点1", "要点2", "要点3"], details=DETAILS)
+    document = SummaryRenderer(output_format).render_document("python", summary, "model-<x>")
+    assert "今週の r/python" in document
+    assert all(line in document for line in summary.digest)
+    assert "おしまいなのだ" in document
+    assert ("model-&lt;x&gt;" if output_format == "html" else "model-<x>") in document
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        SummaryRenderer("rtf")
@@ -0,0 +1,76 @@
+import pytest
+
+from main import AIClient, RedditSummary, RoutingAIClient
+
+
+class ModelClient(AIClient):
+    engine = "openai"
+
+    def __init__(self, model_name, summary_reply='{"digest": ["a", "b", "c"], "details": "d"}'):
+        self.model_name = model_name
+        self.summary_reply = summary_reply
+        self.completions = 0
+
+    def summarize_text(self, subreddit, text):
+        self._report_usage(f"r/{subreddit}", 100, 10)
+        return self.parse_summary_text(self.summary_reply), self.model_name
+
+    def complete(self, messages, json_output=False):
+        self.completions += 1
+        self._report_usage("complete", 10, 10)
+        return '{"digest": ["r1", "r2", "r3"]}'
+
+
+def test_parse_tiers_sorts_limits_and_puts_unbounded_last():
+    assert RoutingAIClient.parse_tiers(" *=gpt-4.1 , 20000=gpt-4o,6000=gpt-4o-mini,") == [
+        (6000, "gpt-4o-mini"),
+        (20000, "gpt-4o"),
+        (None, "gpt-4.1"),
+    ]
+
+
+def test_parse_tiers_accepts_an_empty_value():
+    assert RoutingAIClient.parse_tiers("") == []
+
+
+@pytest.mark.parametrize("value", ["8000", "8000=", "many=gpt-4o"])
+def test_parse_tiers_rejects_malformed_entries(value):
+    with pytest.raises(ValueError):
+        RoutingAIClient.parse_tiers(value)
+
+
+def test_parse_prices_defaults_completion_to_prompt_price():
+    assert RoutingAIClient.parse_prices("gpt-4o-mini=0.15/0.6, local=0") == {
+        "gpt-4o-mini": (0.15, 0.6),
+        "local": (0.0, 0.0),
+    }
+
+
+def test_last_tier_must_be_unbounded():
+    with pytest.raises(ValueError):
+        RoutingAIClient([(100, ModelClient("small"))], log_path="")
+
+
+def test_select_routes_by_estimated_tokens():
+    small, large = ModelClient("small"), ModelClient("large")
+    router = RoutingAIClient([(100, small), (None, large)], log_path="")
+    assert router.select("a" * 100)[1] is small
+    assert router.select("a" * 1000)[1] is large
+
+
+def test_summary_keeps_the_selected_models_digest_without_extra_calls():
+    small, digest = ModelClient("small"), ModelClient("digest")
+    router = RoutingAIClient([(None, small)], digest_client=digest, log_path="")
+    summary, model_name = router.summarize_text("python", "本文")
+    assert summary == RedditSummary(digest=["a", "b", "c"], details="d")
+    assert model_name == "small"
+    assert small.completions == digest.completions == 0
+
+
+def test_missing_digest_is_repaired_once_by_the_digest_model():
+    small = ModelClient("small", summary_reply='{"details": "d"}')
+    digest = ModelClient("digest")
+    router = RoutingAIClient([(None, small)], digest_client=digest, log_path="")
+    summary, _ = router.summarize_text("python", "本文")
+    assert summary.digest == ["r1", "r2", "r3"]
+    assert (small.completions, digest.completions) == (0, 1)
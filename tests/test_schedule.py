@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def schedule_env(monkeypatch):
+    for key in list(os.environ):
+        if key.startswith(("REPORT_TIME_", "SUBREDDITS_", "SLACK_CHANNEL_")):
+            monkeypatch.delenv(key)
+    return monkeypatch
+
+
+def test_subreddits_split_on_any_whitespace(schedule_env):
+    schedule_env.setenv("REPORT_TIME_A_UTC", "9:30")
+    schedule_env.setenv("SUBREDDITS_A", "  python  rust\tgolang ")
+
+    [slot] = main.load_schedule()
+
+    assert (slot.hour, slot.minute) == (9, 30)
+    assert slot.subreddits == ["python", "rust", "golang"]
+
+
+@pytest.mark.parametrize("value", ["24", "-1", "9:60", "nine"])
+def test_out_of_range_time_is_rejected_at_load(schedule_env, value):
+    schedule_env.setenv("REPORT_TIME_A_UTC", value)
+
+    with pytest.raises(ValueError, match="REPORT_TIME_A_UTC"):
+        main.load_schedule()
+
+
+class FakeApplication:
+    batch_api = False
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def scheduler(schedule_env):
+    schedule_env.setattr(main, "load_dotenv", lambda override=False: None)
+    schedule_env.setattr(main, "Application", FakeApplication)
+    schedule_env.setattr(main.signal, "signal", lambda signum, handler: None)
+    return main.Scheduler()
+
+
+def test_reload_closes_the_replaced_application(scheduler):
+    old_app = scheduler.app
+    scheduler.reload()
+    assert old_app.closed
+    assert scheduler.app is not old_app and not scheduler.app.closed
+
+
+def test_reload_keeps_the_application_when_it_cannot_be_rebuilt(scheduler, monkeypatch):
+    old_app = scheduler.app
+
+    def broken():
+        raise ValueError("設定エラー")
+
+    monkeypatch.setattr(main, "Application", broken)
+    scheduler.reload()
+    assert scheduler.app is old_app and not old_app.closed
+
+
+def test_signal_after_the_flag_checks_is_not_lost(scheduler, monkeypatch):
+    def next_run(after):
+        # フラグの確認後、待機に入る前に SIGTERM が届いた場合
+        scheduler._handle_signal(main.signal.SIGTERM, None)
+        return None, []
+
+    monkeypatch.setattr(scheduler, "next_run", next_run)
+    worker = main.threading.Thread(target=scheduler.run_forever, daemon=True)
+    worker.start()
+    worker.join(timeout=5)
+    assert not worker.is_alive()
@@ -0,0 +1,215 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from main import (
+    Application,
+    BatchJob,
+    MetricsExporter,
+    RedditClient,
+    RedditComment,
+    RedditPost,
+    SeenPostIndex,
+)
+
+ARTICLE = "https://example.com/news/rust-2024?id=42"
+
+
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        ARTICLE,
+        "http://example.com/news/rust-2024?id=42",
+        "https://www.example.com/news/rust-2024/?id=42",
+        "https://EXAMPLE.com/news/rust-2024?utm_source=reddit&id=42&fbclid=abc",
+        " https://m.example.com/news/rust-2024?id=42&ref=share ",
+    ],
+)
+def test_normalize_url_ignores_scheme_prefixes_tracking_and_slashes(url):
+    assert SeenPostIndex.normalize_url(url) == SeenPostIndex.normalize_url(ARTICLE)
+
+
+def test_normalize_url_keeps_meaningful_differences():
+    normalized = SeenPostIndex.normalize_url(ARTICLE)
+    assert SeenPostIndex.normalize_url("https://example.com/news/rust-2024?id=43") != normalized
+    assert SeenPostIndex.normalize_url("https://example.com/News/rust-2024?id=42") != normalized
+    assert SeenPostIndex.normalize_url("https://other.com/news/rust-2024?id=42") != normalized
+
+
+def test_normalize_url_sorts_query_parameters():
+    assert SeenPostIndex.normalize_url("https://a.com/p?b=2&a=1") == SeenPostIndex.normalize_url(
+        "https://a.com/p?a=1&b=2"
+    )
+
+
+def test_simhash_is_stable_and_fits_a_signed_64_bit_integer():
+    text = "Rust 2024 edition is released with async closures and new lints"
+    value = SeenPostIndex.simhash(text)
+    assert value == SeenPostIndex.simhash(text)
+    assert -(1 << 63) <= value < 1 << 63
+
+
+def test_simhash_matches_near_duplicates_within_the_default_distance():
+    body = (
+        "\nThe release notes list async closures, a new set of default lints, the reserved gen keyword, "
+        "faster incremental builds and improved diagnostics for lifetime errors across the compiler."
+    )
+    original = "Rust 2024 edition is released with async closures, new lints and faster builds" + body
+    reworded = "The Rust 2024 edition is released: async closures, new lints and faster builds!" + body
+    unrelated = (
+        "Show HN: a tiny static site generator written in Go with live reload support\n"
+        "It renders markdown, watches files and serves pages locally with hot module replacement."
+    )
+    assert hamming(SeenPostIndex.simhash(original), SeenPostIndex.simhash(reworded)) <= 3
+    assert hamming(SeenPostIndex.simhash(original), SeenPostIndex.simhash(unrelated)) > 3
+
+
+def test_simhash_uses_bigrams_for_japanese_and_normalizes_width():
+    assert SeenPostIndex.simhash("ずんだ餅の新作が発売されました") is not None
+    assert SeenPostIndex.simhash("ＲＵＳＴ　２０２４ edition is released today") == SeenPostIndex.simhash(
+        "rust 2024 edition is released today"
+    )
+
+
+def test_simhash_skips_texts_with_too_few_features():
+    assert SeenPostIndex.simhash("短い") is None
+    assert SeenPostIndex.simhash("just three words") is None
+
+
+BODY = (
+    "The release notes list async closures, a new set of default lints, the reserved gen keyword, "
+    "faster incremental builds and improved diagnostics for lifetime errors across the compiler."
+)
+TITLE = "Rust 2024 edition is released with async closures, new lints and faster builds"
+
+
+def make_post(**fields):
+    defaults = {"id": "z9", "url": "https://other.com/x", "title": "無関係な投稿のタイトルです", "selftext": ""}
+    return SimpleNamespace(**{**defaults, **fields})
+
+
+@pytest.fixture
+def index(tmp_path):
+    return SeenPostIndex(path=str(tmp_path / "seen.sqlite3"), max_age=3600, max_distance=3)
+
+
+def test_find_reports_why_a_post_was_seen(index):
+    index.mark("rust", [make_post(id="a1", url=ARTICLE, title=TITLE, selftext=BODY)])
+
+    assert index.find("programming", make_post(id="a1")) == "id"
+    assert index.find(
+        "programming", make_post(url="http://www.example.com/news/rust-2024/?id=42&utm_medium=x")
+    ) == "url"
+    assert index.find("programming", make_post(title="The " + TITLE + "!", selftext=BODY)) == "simhash"
+    assert index.find("programming", make_post()) is None
+
+
+def test_simhash_does_not_match_recurring_threads_in_the_same_subreddit(tmp_path):
+    # 距離を緩めても、同じサブレディットの定期スレッドは simhash で照合しない
+    index = SeenPostIndex(path=str(tmp_path / "seen.sqlite3"), max_age=3600, max_distance=10)
+    body = "Post anything about the language here: questions, projects, articles and news from this week."
+    index.mark("rust", [make_post(
+        id="w1", url="https://reddit.com/r/rust/w1", title="Weekly Discussion Thread – October 12", selftext=body
+    )])
+    next_week = make_post(
+        id="w2", url="https://reddit.com/r/rust/w2", title="Weekly Discussion Thread – October 19", selftext=body
+    )
+    assert index.find("rust", next_week) is None
+    assert index.find("programming", next_week) == "simhash"
+
+
+def test_claimed_posts_are_skipped_until_released(index):
+    shared = make_post(id="a1", url=ARTICLE)
+    assert index.claim("rust", shared) is None
+    assert index.claim("programming", make_post(id="b1", url=ARTICLE + "&utm_source=x")) == "url"
+    assert index.claim("programming", shared) == "id"
+    assert index.claim("rust", make_post(id="a2", url=ARTICLE)) == "url"
+
+    index.release("programming")
+    assert index.claim("programming", shared) == "id"
+    index.release("rust", ["a1"])
+    assert index.claim("programming", shared) is None
+
+
+def test_mark_turns_a_claim_into_a_record(index):
+    post = make_post(id="a1", url=ARTICLE)
+    assert index.claim("rust", post) is None
+    index.mark("rust", [post])
+    index.release("rust")
+    assert index.find("programming", post) == "id"
+
+
+class SharedListingFetcher:
+    """サブレディットごとの投稿一覧を返す RedditJSONFetcher の代わり"""
+
+    limits = {"remaining": None, "reset_timestamp": None, "used": None}
+
+    def __init__(self, listings):
+        self.listings = listings
+
+    def listing(self, subreddit_name, limit, time_filter):
+        # 両方のジョブが投稿一覧を取得してから選別に進むようにする
+        self.barrier.wait(timeout=5)
+        return self.listings[subreddit_name][:limit]
+
+    def comments(self, post_id):
+        return [RedditComment(f"{post_id}-c", "user", "コメント", 1, 0.0)]
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv("REDDIT_FETCHER", "raw")
+    monkeypatch.setenv("REDDIT_CACHE_ENABLED", "false")
+    monkeypatch.setenv("SEEN_INDEX_ENABLED", "true")
+    monkeypatch.setenv("SEEN_INDEX_PATH", str(tmp_path / "seen.sqlite3"))
+    monkeypatch.delenv("METRICS_JSONL_PATH", raising=False)
+    monkeypatch.delenv("METRICS_PROM_PATH", raising=False)
+    application = Application.__new__(Application)
+    application.ai_client = SimpleNamespace(engine="fake", model_name="fake-1")
+    application.reddit_client = RedditClient()
+    application.metrics_exporter = MetricsExporter()
+    application.summary_mode = "single"
+    application.streaming = False
+    application.batch_api = False
+    application.summarized = []
+    application.summarize = lambda subreddit, text: (application.summarized.append((subreddit, text)), "fake-1")
+    application.post = lambda subreddit, summary, model_name, channel: True
+    return application
+
+
+def post_record(post_id, url):
+    return RedditPost(post_id, f"{post_id} のタイトル", url, 0.0, 10, 1, "")
+
+
+def test_run_batch_summarizes_a_shared_url_only_once(app):
+    fetcher = SharedListingFetcher({
+        "rust": [post_record("r1", ARTICLE), post_record("r2", "https://example.com/rust-only")],
+        "programming": [
+            post_record("p1", "https://www.example.com/news/rust-2024/?id=42"),
+            post_record("p2", "https://example.com/programming-only"),
+            post_record("p3", ARTICLE + "&ref=share"),
+        ],
+    })
+    fetcher.barrier = threading.Barrier(2)
+    app.reddit_client.raw = fetcher
+
+    results = app.run_batch([BatchJob(subreddit="rust", limit=2), BatchJob(subreddit="programming", limit=2)])
+
+    assert all(result.ok for result in results)
+    texts = "\n".join(text for _, text in app.summarized)
+    assert texts.count("example.com/news/rust-2024") == 1
+    assert "rust-only" in texts and "programming-only" in texts
+
+
+def test_failed_posts_are_released_for_the_next_run(app):
+    app.reddit_client.raw = SharedListingFetcher({"rust": [post_record("r1", ARTICLE)]})
+    app.reddit_client.raw.barrier = threading.Barrier(1)
+    app.post = lambda subreddit, summary, model_name, channel: False
+
+    assert app.process("rust", 1) is False
+    assert app.reddit_client.seen_index.claim("programming", post_record("p1", ARTICLE)) is None
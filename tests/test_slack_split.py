@@ -0,0 +1,57 @@
+import pytest
+
+from main import SlackNotifier
+
+SEPARATORS = ("\n---\n", "\n", "")
+
+
+@pytest.fixture
+def notifier(monkeypatch):
+    def make(limit):
+        monkeypatch.setenv("SLACK_MAX_MESSAGE_CHARS", str(limit))
+        return SlackNotifier()
+    return make
+
+
+def assert_reassembles(text, chunks):
+    """チャンクを順に並べると、分割位置の区切り以外は元のテキストと一致すること"""
+    position = 0
+    for index, chunk in enumerate(chunks):
+        if index:
+            separator = next(s for s in SEPARATORS if text.startswith(s + chunk, position))
+            position += len(separator)
+        assert text.startswith(chunk, position)
+        position += len(chunk)
+    assert position == len(text)
+
+
+@pytest.mark.parametrize("limit", [3500, 4000, 40000])
+def test_text_at_the_limit_is_sent_as_one_message(notifier, limit):
+    text = "あ" * limit
+    assert notifier(limit).split_message(text) == [text]
+
+
+@pytest.mark.parametrize("limit", [3500, 4000, 40000])
+def test_text_over_the_limit_is_split_within_the_limit(notifier, limit):
+    topic = "【ずんだもん】" + "ずんだ餅は最高なのだ。" * 40
+    text = "\n---\n".join([topic] * (limit // len(topic) * 3))
+    chunks = notifier(limit).split_message(text)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= limit for chunk in chunks)
+    assert_reassembles(text, chunks)
+
+
+def test_topics_are_kept_whole_when_they_fit(notifier):
+    topics = [f"タイトル: 「{index}」\n" + "発言" * 400 for index in range(6)]
+    chunks = notifier(3500).split_message("\n---\n".join(topics))
+    for chunk in chunks:
+        assert all(topic in topics for topic in chunk.split("\n---\n"))
+
+
+def test_oversized_topic_falls_back_to_lines_then_characters(notifier):
+    text = "短い行\n" + "長" * 9000 + "\n最後の行"
+    chunks = notifier(3500).split_message(text)
+    assert all(len(chunk) <= 3500 for chunk in chunks)
+    assert chunks[0] == "短い行"
+    assert chunks[-1].endswith("\n最後の行")
+    assert_reassembles(text, chunks)
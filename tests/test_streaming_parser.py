@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from main import StreamingSummaryParser
+
+SUMMARY = {
+    "digest": ["要点 \"1\"", "要点 2", "要点 3 ]"],
+    "details": "【めたん】改行\nと \"引用\" と \\ と 絵文字 🎉 を含む会話なのよ",
+}
+
+
+def feed_in_chunks(text, size):
+    parser = StreamingSummaryParser()
+    snapshots = []
+    for start in range(0, len(text), size):
+        parser.feed(text[start:start + size])
+        snapshots.append((parser.digest, parser.details))
+    return parser, snapshots
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_digest_and_details_are_split_for_any_chunking(size):
+    text = json.dumps(SUMMARY, ensure_ascii=False)
+    parser, _ = feed_in_chunks(text, size)
+    assert parser.digest == SUMMARY["digest"]
+    assert parser.details == SUMMARY["details"]
+    assert parser.details_complete
+
+
+def test_digest_is_available_before_details_start():
+    text = json.dumps(SUMMARY, ensure_ascii=False)
+    parser = StreamingSummaryParser()
+    parser.feed(text[:text.index('"details"')])
+    assert parser.digest == SUMMARY["digest"]
+    assert parser.details == ""
+
+
+def test_details_grow_monotonically_without_partial_escapes():
+    text = json.dumps(SUMMARY)  # \uXXXX エスケープを含む
+    _, snapshots = feed_in_chunks(text, 1)
+    details = [details for _, details in snapshots]
+    for before, after in zip(details, details[1:]):
+        assert after.startswith(before)
+    assert details[-1] == SUMMARY["details"]
+
+
+def test_details_before_digest_still_yields_both():
+    text = json.dumps({"details": SUMMARY["details"], "digest": SUMMARY["digest"]}, ensure_ascii=False)
+    parser, _ = feed_in_chunks(text, 5)
+    assert parser.details == SUMMARY["details"]
+    assert parser.digest == SUMMARY["digest"]
+
+
+def test_unclosed_digest_stays_pending():
+    parser = StreamingSummaryParser()
+    parser.feed('{"digest": ["a", "b"')
+    assert parser.digest is None
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+
+from main import AIClient, Application, BatchJob, MetricsExporter, RedditPost, SummaryBatchStore
+
+REPLY = '{"digest": ["a", "b", "c"], "details": "d"}'
+
+
+class FakeBatchClient(AIClient):
+    engine = "fake"
+    model_name = "fake-batch"
+    SUPPORTS_BATCH = True
+
+    def __init__(self):
+        self.submitted = []
+        self.batches = {}
+
+    def summarize_text(self, subreddit, text):
+        raise NotImplementedError
+
+    def complete(self, messages, json_output=False):
+        raise NotImplementedError
+
+    def submit_summary_batch(self, requests):
+        batch_id = f"batch-{len(self.submitted) + 1}"
+        self.submitted.append(requests)
+        self.batches[batch_id] = ("in_progress", None)
+        return batch_id
+
+    def retrieve_summary_batch(self, batch_id):
+        return self.batches[batch_id]
+
+    def parse_batch_result(self, subreddit, result):
+        return self.parse_summary_text(result)
+
+
+class FakeReddit:
+    def __init__(self):
+        self.fetched = []
+        self.marked = []
+        self.released = []
+
+    def fetch_posts(self, subreddit_name, limit):
+        self.fetched.append(subreddit_name)
+        url = f"https://example.com/{subreddit_name}"
+        return [RedditPost(f"{subreddit_name}-1", "タイトル", url, 0.0, 1, 0, "")]
+
+    def build_input(self, subreddit_name, posts):
+        return f"r/{subreddit_name} の投稿"
+
+    def mark_seen(self, subreddit_name, posts):
+        self.marked.append((subreddit_name, [post.id for post in posts]))
+
+    def release_seen(self, subreddit_name, posts=None):
+        self.released.append((subreddit_name, [post.id for post in posts or []]))
+
+
+@pytest.fixture
+def app(tmp_path):
+    application = Application.__new__(Application)
+    application.ai_client = application.batch_client = FakeBatchClient()
+    application.reddit_client = FakeReddit()
+    application.batch_api = True
+    application.batch_store = SummaryBatchStore(path=str(tmp_path / "batches.sqlite3"))
+    application.metrics_exporter = MetricsExporter(jsonl_path=str(tmp_path / "metrics.jsonl"))
+    application.posted = []
+
+    def post(subreddit, summary, model_name, channel):
+        application.posted.append((subreddit, summary, model_name, channel))
+        return True
+
+    application.post = post
+    return application
+
+
+def item_states(store):
+    return dict(store._conn.execute("SELECT custom_id, state FROM summary_batch_items").fetchall())
+
+
+def metric_records(app):
+    try:
+        with open(app.metrics_exporter.jsonl_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def complete(app, batch_id, outputs):
+    app.batch_client.batches[batch_id] = ("completed", outputs)
+
+
+def test_pending_requests_are_posted_once_the_batch_completes(app):
+    results = app.run_batch([BatchJob(subreddit="python", channel="#py")])
+    assert [result.ok for result in results] == [True]
+    [requests] = app.batch_client.submitted
+    [custom_id] = requests
+    # 登録だけでは実行として計測しない
+    assert metric_records(app) == []
+
+    assert app.poll_summary_batches() == []
+    assert item_states(app.batch_store) == {custom_id: "pending"}
+
+    complete(app, "batch-1", {custom_id: REPLY})
+    [result] = app.poll_summary_batches()
+
+    assert result.ok and result.subreddit == "python"
+    assert item_states(app.batch_store) == {custom_id: "posted"}
+    assert app.batch_store.pending_batches() == []
+    [(subreddit, summary, model_name, channel)] = app.posted
+    assert (subreddit, summary.digest, model_name, channel) == ("python", ["a", "b", "c"], "fake-batch", "#py")
+    assert app.reddit_client.marked == [("python", ["python-1"])]
+    [record] = metric_records(app)
+    assert (record["subreddit"], record["ok"]) == ("python", True)
+    assert "parse" in record["stages"]
+
+
+def test_a_failed_response_marks_only_that_request_failed(app):
+    app.run_batch([BatchJob(subreddit="python"), BatchJob(subreddit="rust")])
+    [requests] = app.batch_client.submitted
+    python_id, rust_id = sorted(requests)
+    complete(app, "batch-1", {python_id: REPLY, rust_id: None})
+
+    results = {result.subreddit: result for result in app.poll_summary_batches()}
+
+    assert results["python"].ok
+    assert not results["rust"].ok and "バッチの応答がありません" in results["rust"].error
+    assert item_states(app.batch_store) == {python_id: "posted", rust_id: "failed"}
+    assert app.reddit_client.released == [("rust", ["rust-1"])]
+    assert {record["subreddit"]: record["ok"] for record in metric_records(app)} == {
+        "python": True, "rust": False,
+    }
+
+
+def test_subreddits_with_a_pending_batch_are_not_submitted_again(app):
+    app.run_batch([BatchJob(subreddit="python")])
+    results = app.run_batch([BatchJob(subreddit="Python"), BatchJob(subreddit="rust")])
+
+    assert [result.ok for result in results] == [True, True]
+    assert app.reddit_client.fetched == ["python", "rust"]
+    [second] = app.batch_client.submitted[1:]
+    assert [custom_id.split("-")[0] for custom_id in second] == ["rust"]
+    assert len(app.batch_store.pending_batches()) == 2
@@ -0,0 +1,87 @@
+import unicodedata
+
+import pytest
+
+from main import AIClient, CachedAIClient, RedditSummary, SummaryCache
+
+
+class CountingClient(AIClient):
+    engine = "fake"
+
+    def __init__(self, model_name="fake-1", digest=("a", "b", "c")):
+        self.model_name = model_name
+        self.digest = list(digest)
+        self.calls = 0
+
+    def summarize_text(self, subreddit, text):
+        self.calls += 1
+        return RedditSummary(digest=self.digest, details=text), self.model_name
+
+    def complete(self, messages, json_output=False):
+        raise NotImplementedError
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SummaryCache(path=str(tmp_path / "summaries.sqlite3"), max_age=3600, max_entries=10)
+
+
+def test_make_key_ignores_unicode_form_line_endings_and_trailing_spaces():
+    text = "タイトル: ポケモン  \r\nコメント\r\n"
+    variants = [
+        text,
+        unicodedata.normalize("NFD", text),
+        "タイトル: ポケモン\nコメント",
+        "\nタイトル: ポケモン\t\nコメント   \n\n",
+    ]
+    keys = {SummaryCache.make_key(text=variant, model="m") for variant in variants}
+    assert len(keys) == 1
+
+
+def test_make_key_is_independent_of_argument_order():
+    assert SummaryCache.make_key(text="x", engine="openai", model="m") == SummaryCache.make_key(
+        model="m", engine="openai", text="x"
+    )
+
+
+def test_cache_key_changes_with_everything_that_affects_the_summary(monkeypatch, cache):
+    monkeypatch.setenv("CONVERSATION_LENGTH", "15")
+    client = CachedAIClient(CountingClient(), cache=cache)
+    base = client.cache_key("Python", "本文")
+
+    assert client.cache_key("python", "本文") == base
+    assert client.cache_key("rust", "本文") != base
+    assert client.cache_key("python", "別の本文") != base
+    assert CachedAIClient(CountingClient("fake-2"), cache=cache).cache_key("python", "本文") != base
+
+    monkeypatch.setenv("CONVERSATION_LENGTH", "20")
+    assert client.cache_key("python", "本文") != base
+    monkeypatch.setenv("CONVERSATION_LENGTH", "15")
+
+    monkeypatch.setattr(CountingClient, "PROMPT_TEMPLATE_VERSION", "test-next")
+    assert client.cache_key("python", "本文") != base
+
+
+def test_repeat_summaries_are_served_from_the_cache(cache):
+    inner = CountingClient()
+    client = CachedAIClient(inner, cache=cache)
+    first = client.summarize_text("python", "本文")
+    second = client.summarize_text("python", "本文\r\n")
+    assert second == first
+    assert inner.calls == 1
+
+
+def test_bypass_skips_reads_but_still_stores(cache):
+    inner = CountingClient()
+    CachedAIClient(inner, cache=cache, bypass=True).summarize_text("python", "本文")
+    CachedAIClient(inner, cache=cache, bypass=True).summarize_text("python", "本文")
+    CachedAIClient(inner, cache=cache).summarize_text("python", "本文")
+    assert inner.calls == 2
+
+
+def test_placeholder_digests_are_not_cached(cache):
+    inner = CountingClient(digest=AIClient.PLACEHOLDER_DIGEST)
+    client = CachedAIClient(inner, cache=cache)
+    client.summarize_text("python", "本文")
+    client.summarize_text("python", "本文")
+    assert inner.calls == 2
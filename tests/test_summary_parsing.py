@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from main import AIClient, repair_json_object
+
+
+class FakeClient(AIClient):
+    model_name = "fake-1"
+
+    def __init__(self, digest_reply='{"digest": ["r1", "r2", "r3"]}'):
+        self.digest_reply = digest_reply
+        self.completions = []
+
+    def summarize_text(self, subreddit, text):
+        raise NotImplementedError
+
+    def complete(self, messages, json_output=False):
+        self.completions.append(messages)
+        return self.digest_reply
+
+
+VALID = {"digest": ["一行目", "二行目", "三行目"], "details": "【ずんだもん】こんにちはなのだ\n---"}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        json.dumps(VALID, ensure_ascii=False),
+        "```json\n" + json.dumps(VALID, ensure_ascii=False) + "\n```",
+        "要約は以下の通りです。\n" + json.dumps(VALID, ensure_ascii=False) + "\n以上です。",
+    ],
+    ids=["plain", "fenced", "prose"],
+)
+def test_repair_accepts_wrapped_objects(text):
+    assert repair_json_object(text) == VALID
+
+
+def test_repair_escapes_raw_newlines_and_tabs_in_strings():
+    text = '{"digest": ["a", "b", "c"], "details": "1行目\n2行目\tタブ"}'
+    assert repair_json_object(text)["details"] == "1行目\n2行目\tタブ"
+
+
+def test_repair_drops_trailing_commas_and_stray_closers():
+    text = '{"digest": ["a", "b", "c",], "details": "x",]}'
+    assert repair_json_object(text) == {"digest": ["a", "b", "c"], "details": "x"}
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"digest": ["a", "b", "c"], "details": "途中で', {"digest": ["a", "b", "c"], "details": "途中で"}),
+        ('{"digest": ["a", "b"', {"digest": ["a", "b"]}),
+        ('{"digest": ["a", "b", "c"], "details"', {"digest": ["a", "b", "c"]}),
+        ('{"digest": ["a", "b", "c"], "details": ', {"digest": ["a", "b", "c"]}),
+        ('{"details": "改行\\', {"details": "改行"}),
+        ('{"details": "\\u30', {"details": ""}),
+    ],
+    ids=["open_string", "open_array", "dangling_key", "dangling_colon", "cut_escape", "cut_unicode"],
+)
+def test_repair_closes_truncated_output(text, expected):
+    assert repair_json_object(text) == expected
+
+
+@pytest.mark.parametrize("text", ["JSON ではない応答", '["a", "b"]'])
+def test_repair_rejects_non_objects(text):
+    with pytest.raises(ValueError):
+        repair_json_object(text)
+
+
+def test_parse_summary_text_uses_valid_json_without_extra_calls():
+    client = FakeClient()
+    summary = client.parse_summary_text(json.dumps(VALID, ensure_ascii=False))
+    assert summary.digest == VALID["digest"]
+    assert client.completions == []
+
+
+def test_parse_summary_text_splits_a_string_digest_into_lines():
+    client = FakeClient()
+    summary = client.parse_summary_text('{"digest": "一\\n二\\n\\n三", "details": "d"}')
+    assert summary.digest == ["一", "二", "三"]
+    assert client.completions == []
+
+
+def test_parse_summary_text_repairs_only_a_missing_digest():
+    client = FakeClient()
+    summary = client.parse_summary_text('{"details": "会話だけ"}')
+    assert summary.digest == ["r1", "r2", "r3"]
+    assert summary.details == "会話だけ"
+    assert len(client.completions) == 1
+
+
+def test_parse_summary_text_falls_back_to_placeholder_when_repair_fails():
+    client = FakeClient(digest_reply="壊れた応答")
+    summary = client.parse_summary_text("JSON ではない応答")
+    assert tuple(summary.digest) == AIClient.PLACEHOLDER_DIGEST
+    assert summary.details == "JSON ではない応答"
+